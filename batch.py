@@ -0,0 +1,335 @@
+from __future__ import print_function
+import os, pdb, sys, time, signal, traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    from . import jwstsim, manifest, profiling, memo as memo_cache, shard as shard_module
+    from . import schedule as schedule_module
+    from .store import ResultStore
+except ImportError:
+    import jwstsim, manifest, profiling
+    import memo as memo_cache
+    import shard as shard_module
+    import schedule as schedule_module
+    from store import ResultStore
+
+"""
+Routines for running jwstsim over many planets in parallel. The work is
+split into ( planet, instrument mode, filter ) tasks which are farmed out
+to a pool of worker processes. Each task runs with an optional timeout
+and any failure is recorded without stopping the rest of the sweep.
+"""
+
+# Worker process settings, set by init_worker():
+WORKER = {}
+
+
+class TaskTimeout( Exception ):
+    pass
+
+
+def run( planets, tepcat, inst_modes='all', nworkers=None, timeout=None, backend=None, \
+         outdir='.', sat_level=80, sat_unit='%', noise_floor_ppm=20, manifest_path=None, \
+         memo=False, store_dir=None, trace_path=None, profiler=None, shard=None, costs=None, \
+         resolutions=None, order=None, priority='sn_tr' ):
+    """
+    Runs PandExo for every combination of planet and instrument mode.
+
+    nworkers is the number of worker processes (default is the number of
+    CPUs); if nworkers=1 the tasks are run serially in the current process.
+    timeout is the maximum time allowed per task in seconds. backend is the
+    name of a module to use in place of pandexo.engine.justdoit, e.g. the
+    'fakejdi' stand-in.
+
+    If manifest_path is provided, each finished task is recorded in that
+    sweep manifest (see manifest.py) and tasks already completed with the
+    same inputs, PandExo version and output settings in a previous run are
+    not repeated. If memo is True, PandExo results are also cached by input
+    content (see memo.py), which catches repeated simulations across
+    different planets and sweeps. If store_dir
+    is provided, the outputs are appended to that result store (see store.py)
+    instead of being written as text files under outdir. If resolutions is
+    provided, the noise spectra are saved binned to each of those
+    resolutions rather than at native resolution (see binning.py).
+
+    If trace_path is provided, the time spent in each stage of each task is
+    appended to that JSON-lines trace and summarised at the end, and if
+    profiler is 'cprofile' or 'pyinstrument' each task is also profiled
+    (see profiling.py).
+
+    If shard is [ k, nshards ], only the tasks assigned to shard k are run,
+    so that a sweep can be split across several machines (see shard.py).
+    The tasks are partitioned by a stable hash, or balanced using costs if
+    provided, e.g. from schedule.estimate_costs() on earlier manifests.
+
+    If order is 'cost', the tasks are dispatched longest first, and if it
+    is 'priority' the planets are also taken in tiers of decreasing
+    priority, a tepcat key such as 'sn_tr' or a list of keys, so the most
+    promising planets finish first (see schedule.py). The costs are learned
+    from manifest_path and trace_path if not provided, and the predicted
+    makespan is printed before the tasks start.
+
+    Returns a list of records, one per task, each a dictionary with keys
+    'planet', 'mode', 'filter', 'status', 'runtime', 'cpu', 'maxrss_mb',
+    'outputs', 'memo' and 'error', where 'runtime' and 'cpu' are the wall
+    and CPU time of the task, 'maxrss_mb' is the peak memory of the process
+    that ran it and 'memo' is 'hit' or 'miss' when the result cache is used.
+    The status is one of 'done', 'cached', 'failed', 'timeout' or 'skipped'.
+    """
+    if ( order is not None )*( order not in schedule_module.ORDERS ):
+        raise ValueError( 'order must be None or one of {0}'.format( schedule_module.ORDERS ) )
+    if backend is not None:
+        jwstsim.set_backend( backend )
+    if outdir=='.':
+        outdir = os.getcwd()
+    previous = profiling.enable( trace_path=trace_path, profiler=profiler )
+    try:
+        inst_modes = jwstsim.get_inst_modes( inst_modes )
+        if nworkers is None:
+            nworkers = os.cpu_count()
+        ledger = {}
+        if manifest_path is not None:
+            ledger = manifest.load( manifest_path )
+
+        # Prepare the PandExo inputs for each task, checking the manifest:
+        t0 = time.time()
+        records = []
+        tasks = []
+        # Outputs also depend on the PandExo version and how they are saved:
+        version = memo_cache.backend_version( jwstsim.get_jdi() )
+        outmode = 'text' if store_dir is None else 'store'
+        zs = jwstsim.prepare_exo_dicts( tepcat, planets, sat_level=sat_level, sat_unit=sat_unit, \
+                                        noise_floor_ppm=noise_floor_ppm )
+        alltasks = list_tasks( planets, inst_modes )
+        if shard is not None:
+            alltasks = shard_module.select( alltasks, shard[0], shard[1], costs=costs )
+        for task in alltasks:
+            planet = task[0]
+            z = zs.get( planet, None )
+            if z is None:
+                record = new_record( task )
+                record['status'] = 'skipped'
+                record['error'] = 'Could not match {0} to any TEPCat planets'.format( planet )
+                records += [ record ]
+                continue
+            exo, spechash = memo_cache.content_inputs( z )
+            task += [ z, manifest.hash_inputs( exo, task[1], task[2], spechash, version, outmode, resolutions ) ]
+            key = manifest.task_key( *task[:3] )
+            if manifest.is_done( ledger, key, task[4] ):
+                record = new_record( task )
+                record['status'] = 'cached'
+                record['outputs'] = ledger[key]['outputs']
+                records += [ record ]
+                continue
+            tasks += [ task ]
+        ntasks = len( tasks )
+        if shard is not None:
+            print( '\nShard {0} of {1}: {2} tasks'.format( shard[0], shard[1], len( alltasks ) ) )
+        if order is not None:
+            # The pool takes tasks in submission order:
+            if costs is None:
+                costs = schedule_module.estimate_costs( manifest_paths=manifest_path, trace_paths=trace_path )
+            priorities = None
+            if order=='priority':
+                priorities = schedule_module.get_priorities( tepcat, keys=priority )
+            tasks = schedule_module.order_tasks( tasks, costs=costs, priorities=priorities )
+            schedule_module.report( tasks, costs, nworkers, priorities=priorities )
+        print( '\n{0}\nRunning {1} tasks ({2} planets, {3} already done or skipped) on {4} workers\n{0}\n'\
+               .format( 50*'#', ntasks, len( planets ), len( records ), nworkers ) )
+
+        simkw = { 'outdir':outdir, 'timeout':timeout, 'memo':memo, 'store':( store_dir is not None ), \
+                  'resolutions':resolutions }
+        nprev = len( records )
+        store = None
+        if store_dir is not None:
+            store = ResultStore( store_dir )
+        pending = [] # manifest entries waiting for the store to be flushed
+
+        def finish( record, task ):
+            if ( store is not None )*( record['status']=='done' ):
+                results = record.pop( 'result' )
+                record['outputs'] = [ store_dir ]
+                pending.append( [ record, task ] )
+                flushed = False
+                with profiling.stage( 'write', mode=task[1], filter=task[2] ):
+                    for label, wav, err, obspar in results:
+                        if store.append( task[0], label, wav, err, obspar ):
+                            flushed = True
+                if flushed:
+                    for p in pending:
+                        finish_task( p[0], p[1], manifest_path )
+                    del pending[:]
+            else:
+                finish_task( record, task, manifest_path )
+            records.append( record )
+            report_progress( record, len( records )-nprev, ntasks, t0 )
+            return None
+
+        try:
+            if nworkers==1:
+                init_worker( backend, simkw )
+                for task in tasks:
+                    finish( run_task( task ), task )
+            else:
+                with ProcessPoolExecutor( max_workers=nworkers, initializer=init_worker, \
+                                          initargs=( backend, simkw ) ) as pool:
+                    futures = {}
+                    for task in tasks:
+                        futures[pool.submit( run_task, task )] = task
+                    for f in as_completed( futures ):
+                        try:
+                            record = f.result()
+                        except Exception as err:
+                            # Worker process died, e.g. killed by the OS:
+                            record = new_record( futures[f] )
+                            record['error'] = repr( err )
+                        finish( record, futures[f] )
+        finally:
+            if store is not None:
+                store.flush()
+                for p in pending:
+                    finish_task( p[0], p[1], manifest_path )
+
+        summarise( records, time.time()-t0 )
+        if trace_path is not None:
+            profiling.summarise( trace_path )
+        return records
+    finally:
+        profiling.disable( previous )
+
+
+def list_tasks( planets, inst_modes ):
+    """
+    Returns a list of [ planet, inst_mode, filter ] tasks.
+    """
+    tasks = []
+    for planet in planets:
+        for m in jwstsim.list_mode_tasks( inst_modes ):
+            tasks += [ [ str( planet ), m[0], m[1] ] ]
+    return tasks
+
+
+def init_worker( backend, simkw ):
+    """
+    Sets up the PandExo backend and output settings in a worker process,
+    so they are not sent with every task. PandExo is imported here rather
+    than in the first task, so that it does not count towards its runtime.
+    """
+    if backend is not None:
+        jwstsim.set_backend( backend )
+    jwstsim.get_jdi()
+    WORKER['simkw'] = simkw
+    return None
+
+
+def new_record( task ):
+    """
+    Returns a task record with status 'failed' and no outputs.
+    """
+    return { 'planet':task[0], 'mode':task[1], 'filter':task[2], 'status':'failed', \
+             'runtime':0., 'cpu':0., 'maxrss_mb':None, 'outputs':[], 'memo':None, 'error':None }
+
+
+def finish_task( record, task, manifest_path ):
+    """
+    Appends a finished task record to the manifest, if there is one.
+    """
+    if manifest_path is None:
+        return None
+    entry = { 'key':manifest.task_key( *task[:3] ), 'hash':task[4], \
+              'time':time.strftime( '%Y-%m-%dT%H:%M:%S' ) }
+    for k in [ 'planet', 'mode', 'filter', 'status', 'runtime', 'cpu', 'maxrss_mb', 'outputs', 'error' ]:
+        entry[k] = record[k]
+    manifest.append( manifest_path, entry )
+    return None
+
+
+def run_task( task ):
+    """
+    Runs a single [ planet, inst_mode, filter, exo_dict, hash ] task in a
+    worker process, catching any exception so that one failed task does not
+    stop the sweep.
+    """
+    planet, inst_mode, filt, z = task[:4]
+    simkw = WORKER['simkw']
+    record = new_record( task )
+    timeout = simkw['timeout']
+    if timeout is not None:
+        signal.signal( signal.SIGALRM, alarm_handler )
+    label = '{0}.{1}'.format( planet, jwstsim.get_onames( inst_mode, filt )[0][:-len( '.txt' )] )
+    rec = { 'wall':0., 'cpu':0., 'maxrss_mb':None }
+    try:
+        with profiling.stage( 'task', planet=planet, mode=inst_mode, filter=filt ) as rec, \
+             profiling.profile( label ):
+            if timeout is not None:
+                signal.setitimer( signal.ITIMER_REAL, timeout )
+            nhits = memo_cache.STATS['hits']
+            y = jwstsim.simulate_mode( z, inst_mode, filt, memo=simkw['memo'] )
+            if simkw['store']==True:
+                # Send the results back to be appended to the result store:
+                stem = label.split( '.', 1 )[1]
+                obspar = jwstsim.get_obspar( y )
+                spectra = jwstsim.get_spectra( y, resolutions=simkw['resolutions'], \
+                                               noise_floor_ppm=z['observation']['noise_floor'] )
+                record['result'] = [ [ stem+s[0], s[1], s[2], obspar ] for s in spectra ]
+            else:
+                odirfull = jwstsim.get_outdir( planet, outdir=simkw['outdir'] )
+                record['outputs'] = list( jwstsim.save_mode( y, inst_mode, filt, odirfull, \
+                                                             resolutions=simkw['resolutions'], \
+                                                             noise_floor_ppm=z['observation']['noise_floor'] ) )
+            record['status'] = 'done'
+            if simkw['memo']==True:
+                if memo_cache.STATS['hits']>nhits:
+                    record['memo'] = 'hit'
+                else:
+                    record['memo'] = 'miss'
+    except TaskTimeout:
+        record['status'] = 'timeout'
+        record['error'] = 'Exceeded {0} s'.format( timeout )
+    except Exception:
+        record['error'] = traceback.format_exc()
+    finally:
+        if timeout is not None:
+            signal.setitimer( signal.ITIMER_REAL, 0 )
+    record['runtime'] = rec['wall']
+    record['cpu'] = rec['cpu']
+    record['maxrss_mb'] = rec['maxrss_mb']
+    return record
+
+
+def alarm_handler( signum, frame ):
+    raise TaskTimeout()
+
+
+def report_progress( record, k, ntasks, t0 ):
+    """
+    Prints a progress line with the elapsed time and estimated time remaining.
+    """
+    elapsed = time.time()-t0
+    eta = elapsed*( ntasks-k )/float( k )
+    label = record['mode']
+    if record['filter'] is not None:
+        label = '{0} ({1})'.format( label, record['filter'] )
+    print( '[{0}/{1}] {2} {3}: {4} in {5:.1f} s | elapsed {6:.1f} min, ETA {7:.1f} min'\
+           .format( k, ntasks, record['planet'], label, record['status'], \
+                    record['runtime'], elapsed/60., eta/60. ) )
+    return None
+
+
+def summarise( records, elapsed ):
+    """
+    Prints the number of tasks with each status and lists the failures.
+    """
+    statuses = np.array( [ r['status'] for r in records ] )
+    print( '\n{0}\nFinished {1} tasks in {2:.2f} minutes'.format( 50*'#', len( records ), elapsed/60. ) )
+    for s in [ 'done', 'cached', 'skipped', 'timeout', 'failed' ]:
+        print( '... {0}: {1}'.format( s, ( statuses==s ).sum() ) )
+    nhits = len( [ r for r in records if r['memo']=='hit' ] )
+    nmisses = len( [ r for r in records if r['memo']=='miss' ] )
+    if nhits+nmisses>0:
+        print( '... result cache: {0} hits, {1} misses'.format( nhits, nmisses ) )
+    for r in records:
+        if r['status'] in [ 'failed', 'timeout' ]:
+            print( '\n*** {0} {1} {2}:\n{3}'.format( r['planet'], r['mode'], r['filter'], r['error'] ) )
+    print( '{0}\n'.format( 50*'#' ) )
+    return None
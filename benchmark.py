@@ -0,0 +1,437 @@
+from __future__ import print_function
+import os, sys, time, tempfile, shutil, json, platform, contextlib, argparse, subprocess
+import numpy as np
+import tepcat
+
+"""
+Timing benchmarks for the pandexo_prep routines, run on synthetic TEPCat
+tables so that results are reproducible and can be scaled up:
+
+  python benchmark.py [--scales 1 10 100] [--scenarios import read load merge config sweep]
+                      [--latency 0.01] [--nworkers 4] [--output benchmark_results.jsonl]
+
+At scale 1 the synthetic tables have the same number of rows as the real
+TEPCat tables. The scenarios are:
+
+  import --> time to import each module in a fresh interpreter, flagging
+             any that pull in PandExo or matplotlib at import time
+  read   --> columnar reader versus the original line-by-line loop
+  load   --> tepcat.load() from the text tables and from the binary cache
+  merge  --> tepcat.merge() of the parsed tables
+  config --> jwstsim.prepare_exo_dicts() for every planet
+  sweep  --> batch.run() over the first sweep_planets planets, using the
+             fakejdi stand-in for PandExo with the specified latency
+
+Each result is appended as one JSON line to the output file, tagged with
+the run time, host and library versions, so that runs can be compared over
+time with compare().
+"""
+
+SCENARIOS = [ 'import', 'read', 'load', 'merge', 'config', 'sweep' ]
+NROWS1 = 1500 # rows in tepcat1.txt at scale 1
+NROWS2 = 660 # rows in tepcat2.txt at scale 1
+SWEEP_MODES = [ 'NIRSpec G395H', 'NIRSpec G140M', 'NIRISS SOSS', 'MIRI LRS' ]
+IMPORT_MODULES = [ 'tepcat', 'catalogue', 'screen', 'jwstsim', 'hstsim', 'batch' ]
+HEAVY_MODULES = [ 'pandexo', 'matplotlib' ] # should only be imported when first used
+
+# Rows for the reference planet, which tepcat.load() needs to normalise the
+# signal metrics:
+REF_ROW1 = 'WASP-121          TEP   07 10 24.06  -39 05 50.6  10.52   9.37  0.12     1.6   ' \
+           '2456635.70832   0.00011    1.2749255    0.0000023    2016MNRAS.458.4025D \n'
+REF_ROW2 = 'WASP-121            6460 140 140  +0.13  0.09  0.09   1.353  0.080  0.079   ' \
+           '1.458  0.030  0.030   4.242  0.011  0.012   0.437  0.008  0.009     1.275      ' \
+           '0.0    0.07     0.0  0.02544 0.00049 0.00050    1.183   0.064   0.062    1.865   ' \
+           '0.044   0.044    9.40  0.37  0.37   0.183  0.016  0.016  2358   52   52  ' \
+           '2016MNRAS.458.4025D   2016MNRAS.458.4025D\n'
+
+
+def main( scales=[ 1, 10, 100 ], scenarios=SCENARIOS, nrepeat=3, latency=0.01, nworkers=None, \
+          sweep_planets=20, sweep_modes=SWEEP_MODES, opath='benchmark_results.jsonl', seed=0 ):
+    """
+    Runs the benchmark scenarios on synthetic TEPCat tables at each scale,
+    printing the timings and appending them to opath. Returns the list of
+    result records.
+    """
+    for s in scenarios:
+        if s not in SCENARIOS:
+            raise ValueError( 'scenarios must be from {0}'.format( ', '.join( SCENARIOS ) ) )
+    opath = os.path.abspath( opath )
+    run_id = time.strftime( '%Y-%m-%dT%H:%M:%S' )
+    results = []
+    cwd = os.getcwd()
+    for scale in scales:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.chdir( tmpdir )
+            nrows = generate_tepcat( tmpdir, scale=scale, seed=seed )
+            print( '\n{0}\nBenchmarks at scale {1}x ({2} + {3} rows)\n{0}'\
+                   .format( 50*'#', scale, nrows[0], nrows[1] ) )
+            for s in scenarios:
+                if s=='import':
+                    outp = bench_import( nrepeat )
+                elif s=='read':
+                    outp = bench_read( nrepeat )
+                elif s=='load':
+                    outp = bench_load( nrepeat )
+                elif s=='merge':
+                    outp = bench_merge( nrepeat )
+                elif s=='config':
+                    outp = bench_config( nrepeat )
+                elif s=='sweep':
+                    outp = bench_sweep( latency, nworkers, sweep_planets, sweep_modes )
+                for r in outp:
+                    r.update( { 'run':run_id, 'scale':scale, 'nrows1':nrows[0], \
+                                'nrows2':nrows[1] } )
+                    r.update( get_environment() )
+                    print( '{0:20s} best {1:10.4f} s  mean {2:10.4f} s'\
+                           .format( r['scenario'], r['best_s'], r['mean_s'] ) )
+                    append_result( opath, r )
+                    results += [ r ]
+        finally:
+            os.chdir( cwd )
+            shutil.rmtree( tmpdir )
+    print( '\nSaved {0} results to {1}\n'.format( len( results ), opath ) )
+    return results
+
+
+def bench_import( nrepeat, modules=IMPORT_MODULES ):
+    """
+    Times importing each module in a fresh interpreter, which is what each
+    worker process pays at startup when processes are spawned rather than
+    forked, and records any heavy modules that the import pulls in.
+    """
+    srcdir = os.path.dirname( os.path.abspath( __file__ ) )
+    env = dict( os.environ )
+    env['PYTHONPATH'] = os.pathsep.join( [ srcdir, env.get( 'PYTHONPATH', '' ) ] )
+    code = 'import sys, time, json\nt1 = time.time()\nimport {0}\nt2 = time.time()\n' \
+           'print( json.dumps( [ t2-t1, [ m for m in {1} if m in sys.modules ] ] ) )'
+    results = []
+    for m in modules:
+        times = []
+        for i in range( nrepeat ):
+            outp = subprocess.check_output( [ sys.executable, '-c', code.format( m, HEAVY_MODULES ) ], \
+                                            env=env )
+            t, heavy = json.loads( outp.decode( 'utf-8' ).strip().split( '\n' )[-1] )
+            times += [ t ]
+        r = new_result( 'import_{0}'.format( m ), times )
+        r['heavy_modules'] = heavy
+        if len( heavy )>0:
+            print( 'WARNING: importing {0} also imports {1}'.format( m, ', '.join( heavy ) ) )
+        results += [ r ]
+    return results
+
+
+def bench_read( nrepeat ):
+    """
+    Times the columnar TEPCat reader and the original line-by-line loop.
+    """
+    t_loop = timeit( lambda: ( loop_read_tepcat1( 'tepcat1.txt' ), \
+                               loop_read_tepcat2( 'tepcat2.txt' ) ), nrepeat )
+    t_cols = timeit( lambda: ( tepcat.read_tepcat1( 'tepcat1.txt' ), \
+                               tepcat.read_tepcat2( 'tepcat2.txt' ) ), nrepeat )
+    return [ new_result( 'read_loop', t_loop ), new_result( 'read', t_cols ) ]
+
+
+def bench_load( nrepeat ):
+    """
+    Times tepcat.load() without the cache and with a warm cache.
+    """
+    kw = { 'download_latest':False, 'quiet':True }
+    t_text = timeit( lambda: tepcat.load( cache=False, **kw ), nrepeat, quiet=True )
+    with silence():
+        tepcat.load( cache=True, **kw ) # write the cache
+    t_cache = timeit( lambda: tepcat.load( cache=True, **kw ), nrepeat, quiet=True )
+    return [ new_result( 'load', t_text ), new_result( 'load_cached', t_cache ) ]
+
+
+def bench_merge( nrepeat ):
+    """
+    Times tepcat.merge() on the parsed tables.
+    """
+    cat1 = tepcat.read_tepcat1( 'tepcat1.txt' )
+    cat2 = tepcat.read_tepcat2( 'tepcat2.txt' )
+    t = timeit( lambda: tepcat.merge( cat2, cat1, quiet=True ), nrepeat, quiet=True )
+    return [ new_result( 'merge', t ) ]
+
+
+def bench_config( nrepeat ):
+    """
+    Times building the PandExo exoplanet dictionaries for every planet.
+    """
+    jwstsim = import_sim( 'jwstsim' )
+    with silence():
+        z = tepcat.load( download_latest=False, quiet=True, cache=False )
+    n = len( z['names'] )
+    t = timeit( lambda: jwstsim.prepare_exo_dicts( z ), nrepeat )
+    r = new_result( 'config', t )
+    r['nplanets'] = n
+    r['per_planet_s'] = [ v/float( n ) for v in t ]
+    return [ r ]
+
+
+def bench_sweep( latency, nworkers, nplanets, inst_modes ):
+    """
+    Times a full batch sweep with the fakejdi stand-in taking latency
+    seconds per PandExo call. The sweep is run once, as it is the slowest
+    scenario.
+    """
+    batch = import_sim( 'batch' )
+    import fakejdi
+    fakejdi.set_latency( latency )
+    with silence():
+        z = tepcat.load( download_latest=False, quiet=True, cache=False )
+    planets = z['names'][:nplanets]
+    odir = os.path.join( os.getcwd(), 'sweep' )
+    t1 = time.time()
+    with silence():
+        records = batch.run( planets, z, inst_modes=inst_modes, nworkers=nworkers, \
+                             backend='fakejdi', outdir=odir )
+    t = [ time.time()-t1 ]
+    r = new_result( 'sweep', t )
+    r['ntasks'] = len( records )
+    r['ndone'] = len( [ rec for rec in records if rec['status']=='done' ] )
+    r['tasks_per_s'] = len( records )/t[0]
+    r['latency_s'] = latency
+    r['nworkers'] = nworkers if nworkers is not None else os.cpu_count()
+    return [ r ]
+
+
+def import_sim( name ):
+    """
+    Imports jwstsim or batch, registering the fakejdi stand-in as PandExo
+    if PandExo is not installed.
+    """
+    try:
+        import pandexo.engine.justdoit
+    except ImportError:
+        import fakejdi
+        fakejdi.install()
+    return __import__( name )
+
+
+def new_result( scenario, times ):
+    """
+    Returns a result record for a list of repeat timings in seconds.
+    """
+    return { 'scenario':scenario, 'best_s':min( times ), 'mean_s':float( np.mean( times ) ), \
+             'nrepeat':len( times ), 'times_s':list( times ) }
+
+
+def get_environment():
+    """
+    Returns the host and library versions to tag results with.
+    """
+    return { 'host':platform.node(), 'python':platform.python_version(), \
+             'numpy':np.__version__, 'ncpu':os.cpu_count() }
+
+
+def append_result( opath, r ):
+    """
+    Appends a result record to the JSON-lines results file.
+    """
+    with open( opath, 'a' ) as f:
+        f.write( json.dumps( r, default=float )+'\n' )
+    return None
+
+
+def compare( opath='benchmark_results.jsonl' ):
+    """
+    Prints the best time of each scenario and scale in the latest run
+    recorded in opath next to the previous run, with their ratio.
+    Returns a dictionary keyed by [ scenario, scale ] giving the
+    [ previous, latest ] best times.
+    """
+    runs = {}
+    with open( opath, 'r' ) as f:
+        for line in f:
+            try:
+                r = json.loads( line )
+            except ValueError:
+                continue
+            runs.setdefault( r['run'], {} )[( r['scenario'], r['scale'] )] = r['best_s']
+    order = sorted( runs.keys() )
+    latest = runs[order[-1]]
+    previous = {}
+    if len( order )>1:
+        previous = runs[order[-2]]
+    print( '\nLatest run {0} compared to {1}:'.format( order[-1], \
+                                                      order[-2] if len( order )>1 else 'none' ) )
+    outp = {}
+    for k in sorted( latest.keys() ):
+        tprev = previous.get( k, np.nan )
+        outp[k] = [ tprev, latest[k] ]
+        print( '{0:20s} {1:6d}x  {2:10.4f} s --> {3:10.4f} s  ({4:.2f}x)'\
+               .format( k[0], k[1], tprev, latest[k], latest[k]/tprev ) )
+    return outp
+
+
+def generate_tepcat( outdir, scale=1, seed=0 ):
+    """
+    Writes synthetic tepcat1.txt and tepcat2.txt files to outdir with the
+    same column layout as the real TEPCat tables, containing about NROWS1
+    and NROWS2 rows times scale. The systems have physically consistent
+    stellar, orbital and transit properties. About 5% of the tepcat2
+    systems have no tepcat1 entry and a few have missing masses, radii or
+    eccentricities (-1), as in the real tables. The reference planet
+    tepcat.REF_PLANET is always included. Returns the numbers of rows
+    written to each file.
+    """
+    rng = np.random.RandomState( seed )
+    n2 = NROWS2*scale-1
+    n1 = NROWS1*scale-1
+    names = np.array( [ 'SYN-{0:07d}'.format( i ) for i in range( max( [ n1, n2 ] ) ) ] )
+
+    # Stellar properties:
+    teff = rng.uniform( 3000, 7000, n2 )
+    feh = rng.normal( 0, 0.2, n2 )
+    mstar = np.clip( ( teff/5772. )**1.8, 0.1, 2.0 )
+    rstar = mstar**0.8
+    logg = 4.438+np.log10( mstar/rstar**2. )
+    rhostar = mstar/rstar**3.
+    # Orbital and planet properties:
+    porb = 10**rng.uniform( np.log10( 0.5 ), np.log10( 50 ), n2 )
+    ecc = np.where( rng.uniform( 0, 1, n2 )<0.2, rng.uniform( 0, 0.3, n2 ), 0 )
+    ecc[rng.uniform( 0, 1, n2 )<0.1] = -1
+    a_au = ( ( porb/365.25 )**2.*mstar )**( 1./3 )
+    mplanet = 10**rng.uniform( -2, 1, n2 )
+    rplanet = rng.uniform( 0.2, 1.8, n2 )
+    gplanet = 24.79*mplanet/rplanet**2.
+    rhoplanet = mplanet/rplanet**3.
+    teq = teff*np.sqrt( rstar/( 2*a_au*215.032 ) )
+    for x in [ mplanet, rplanet ]:
+        x[rng.uniform( 0, 1, n2 )<0.03] = -1
+    # Observables:
+    vmag = rng.uniform( 8, 16, n1 )
+    kmag = vmag-1.2
+    kmag[:n2] = vmag[:n2]-1.2-0.8*( 6000-teff )/1000.
+    aRs = np.ones( n1 )*10.
+    aRs[:n2] = a_au*215.032/rstar
+    k = np.ones( n1 )*0.1
+    k[:n2] = np.abs( rplanet )*0.10045/rstar
+    b = rng.uniform( 0, 0.8, n1 )
+    p1 = 10**rng.uniform( np.log10( 0.5 ), np.log10( 50 ), n1 )
+    p1[:n2] = porb
+    arg = np.clip( np.sqrt( np.clip( ( 1+k )**2.-b**2., 0, None ) )/aRs, 0, 1 )
+    tdur = p1/np.pi*np.arcsin( arg )
+    tdepth = 100*k**2.
+    # Drop some tepcat2 systems from tepcat1 to exercise the merge:
+    keep1 = np.ones( n1, dtype=bool )
+    keep1[:n2] = ( rng.uniform( 0, 1, n2 )>0.05 )
+
+    ref = '2000SYN....000..000S'
+    with open( os.path.join( outdir, 'tepcat2.txt' ), 'w' ) as f:
+        f.write( '# System  Teff  FeH  M1  R1  logg1  rho1  Porb  eccentricity  sep  M2  R2  g2  rho2  Teq  Discovery-ref  Recent-ref\n' )
+        f.write( REF_ROW2 )
+        for i in range( n2 ):
+            f.write( '{0:20s}{1:6.0f} 50 50  {2:+.2f}  0.05  0.05   {3:.3f}  0.010  0.010   '\
+                     '{4:.3f}  0.010  0.010   {5:.3f}  0.010  0.010   {6:.3f}  0.010  0.010  '\
+                     '{7:.6f}  {8:.3f}  0.010  0.010  {9:.5f}  0.00010  0.00010  {10:.3f}  0.010  0.010  '\
+                     '{11:.3f}  0.010  0.010  {12:.2f}  0.10  0.10  {13:.3f}  0.010  0.010  '\
+                     '{14:.0f}  20  20  {15}  {15}\n'\
+                     .format( names[i], teff[i], feh[i], mstar[i], rstar[i], logg[i], rhostar[i], \
+                              porb[i], ecc[i], a_au[i], mplanet[i], rplanet[i], gplanet[i], \
+                              rhoplanet[i], teq[i], ref ) )
+    with open( os.path.join( outdir, 'tepcat1.txt' ), 'w' ) as f:
+        f.write( '# System  Type  RA  Dec  V-mag  K-mag  Tlength  Tdepth  T0  Porb  Ephemeris-reference\n' )
+        f.write( REF_ROW1 )
+        for i in np.flatnonzero( keep1 ):
+            f.write( '{0:18s}TEP   00 00 00.00  +00 00 00.0  {1:5.2f}  {2:5.2f}  {3:.4f}  {4:.4f}  '\
+                     '2456000.00000  0.00010  {5:.7f}  0.0000010  {6}\n'\
+                     .format( names[i], vmag[i], kmag[i], tdur[i], tdepth[i], p1[i], ref ) )
+    return [ 1+int( keep1.sum() ), 1+n2 ]
+
+
+def timeit( func, nrepeat, quiet=False ):
+    """
+    Returns the list of wall times in seconds for nrepeat calls of func.
+    If quiet is True, anything printed by func is discarded.
+    """
+    times = []
+    for i in range( nrepeat ):
+        t1 = time.time()
+        if quiet==True:
+            with silence():
+                func()
+        else:
+            func()
+        t2 = time.time()
+        times += [ t2-t1 ]
+    return times
+
+
+@contextlib.contextmanager
+def silence():
+    """
+    Context manager discarding anything printed inside it.
+    """
+    with open( os.devnull, 'w' ) as f:
+        with contextlib.redirect_stdout( f ):
+            yield
+
+
+def loop_read_tepcat1( fpath ):
+    """
+    The original line-by-line reader for tepcat1.txt, kept as a reference.
+    """
+    ifile1 = open( fpath, 'r' )
+    header1 = ifile1.readline() # skip first header line
+    names1 = []
+    vmags1 = []
+    kmags1 = []
+    tdurs1 = []
+    tdepths1 = []
+    periods1 = []
+    for line in ifile1:
+        z = line.split()
+        names1 += [ str( z[0] ) ]
+        vmags1 += [ float( z[8] ) ]
+        kmags1 += [ float( z[9] ) ]
+        tdurs1 += [ float( z[10] ) ]
+        tdepths1 += [ float( z[11] ) ]
+        periods1 += [ float( z[14] ) ]
+    ifile1.close()
+    return [ np.array( names1 ), np.array( vmags1 ), np.array( kmags1 ), \
+             np.array( tdurs1 ), np.array( tdepths1 ), np.array( periods1 ) ]
+
+
+def loop_read_tepcat2( fpath ):
+    """
+    The original line-by-line reader for tepcat2.txt, kept as a reference.
+    """
+    ifile2 = open( fpath, 'r' )
+    header2 = ifile2.readline() # skip first header line
+    cols = [ [] for i in range( 12 ) ]
+    for line in ifile2:
+        z = line.split()
+        mstar_i = float( z[7] )
+        rstar_i = float( z[10] )
+        mplanet_i = float( z[26] )
+        rplanet_i = float( z[29] )
+        if ( mstar_i>0 )*( rstar_i>0 )*( mplanet_i>0 )*( rplanet_i>0 ):
+            cols[0] += [ str( z[0] ) ]
+            for k, ix in enumerate( [ 1, 2, 7, 10, 11, 23, 26, 29, 32, 35, 38 ] ):
+                cols[k+1] += [ float( z[ix] ) ]
+    ifile2.close()
+    return [ np.array( c ) for c in cols ]
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser( description='pandexo_prep timing benchmarks' )
+    parser.add_argument( '--scales', type=int, nargs='+', default=[ 1, 10, 100 ] )
+    parser.add_argument( '--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS )
+    parser.add_argument( '--nrepeat', type=int, default=3 )
+    parser.add_argument( '--latency', type=float, default=0.01, \
+                         help='seconds per fake PandExo call in the sweep scenario' )
+    parser.add_argument( '--nworkers', type=int, default=None )
+    parser.add_argument( '--sweep-planets', type=int, default=20 )
+    parser.add_argument( '--output', default='benchmark_results.jsonl' )
+    parser.add_argument( '--compare', action='store_true', \
+                         help='compare the latest two runs in the output file and exit' )
+    args = parser.parse_args()
+    if args.compare==True:
+        compare( args.output )
+    else:
+        main( scales=args.scales, scenarios=args.scenarios, nrepeat=args.nrepeat, \
+              latency=args.latency, nworkers=args.nworkers, sweep_planets=args.sweep_planets, \
+              opath=args.output )
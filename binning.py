@@ -0,0 +1,107 @@
+from __future__ import print_function
+import os, pdb, sys
+import numpy as np
+
+"""
+Routines for binning simulated noise spectra to a lower resolution before
+they are written. The bins are given either as a constant resolving power
+R = wave/dwave or as explicit bin edges, and every bin is evaluated at once
+from cumulative sums over the native-resolution points. Each bin holds the
+mean of the N transit depths falling in it, so its uncertainty is the
+quadrature sum of the native errors divided by N.
+
+The resolutions to produce are given as a list whose entries can be:
+
+  None            --> the native resolution, i.e. no binning
+  R               --> constant resolving power R, e.g. 100
+  [ name, edges ] --> the bin edges in micron, labelled by name
+"""
+
+
+def get_edges( wmin, wmax, R ):
+    """
+    Returns bin edges in micron covering wmin to wmax at constant resolving
+    power R, i.e. each bin has width wave/R at its centre.
+    """
+    if R<=0:
+        raise ValueError( 'R must be positive' )
+    ratio = ( 2.*R+1 )/( 2.*R-1 ) # edge ratio giving centre/width = R
+    nbins = int( np.ceil( np.log( wmax/float( wmin ) )/np.log( ratio ) ) )
+    return wmin*( ratio**np.arange( nbins+1 ) )
+
+
+def rebin( wave, err, edges ):
+    """
+    Bins a spectrum with the specified edges, returning the mean wavelength,
+    binned error and number of native points of each bin. Bins containing
+    no points are omitted. See rebin_many().
+    """
+    return rebin_many( wave, err, [ edges ] )[0]
+
+
+def rebin_many( wave, err, edges_list ):
+    """
+    Bins a spectrum with each set of edges in edges_list, sharing the
+    cumulative sums between them. Returns a list of [ wave, err, npts ]
+    arrays, one per set of edges, where the binned error of a bin with N
+    points is sqrt( sum( err**2 ) )/N.
+    """
+    wave = np.asarray( wave, dtype=float )
+    err = np.asarray( err, dtype=float )
+    order = np.argsort( wave, kind='stable' )
+    wave = wave[order]
+    err = err[order]
+    cwave = np.concatenate( [ [ 0. ], np.cumsum( wave ) ] )
+    cvar = np.concatenate( [ [ 0. ], np.cumsum( err**2. ) ] )
+    outp = []
+    for edges in edges_list:
+        ixs = np.searchsorted( wave, np.asarray( edges, dtype=float ), side='left' )
+        npts = np.diff( ixs )
+        keep = ( npts>0 )
+        i1 = ixs[:-1][keep]
+        i2 = ixs[1:][keep]
+        n = npts[keep].astype( float )
+        wbin = ( cwave[i2]-cwave[i1] )/n
+        ebin = np.sqrt( cvar[i2]-cvar[i1] )/n
+        outp += [ [ wbin, ebin, npts[keep] ] ]
+    return outp
+
+
+def get_label( resolution ):
+    """
+    Returns the file name suffix for a resolution: '' for native resolution,
+    '-R<R>' for a resolving power and '-<name>' for named bin edges.
+    """
+    if resolution is None:
+        return ''
+    if np.isscalar( resolution ):
+        return '-R{0:g}'.format( resolution )
+    return '-{0}'.format( resolution[0] )
+
+
+def bin_resolutions( wave, err, resolutions ):
+    """
+    Returns a list of [ suffix, wave, err ] spectra, one per entry of
+    resolutions (see the module description), with the suffix given by
+    get_label(). All binned versions come from a single pass over the
+    native spectrum.
+    """
+    wave = np.asarray( wave, dtype=float )
+    err = np.asarray( err, dtype=float )
+    edges_list = []
+    for resolution in resolutions:
+        if resolution is None:
+            continue
+        if np.isscalar( resolution ):
+            edges_list += [ get_edges( wave.min(), wave.max()*( 1+1e-12 ), resolution ) ]
+        else:
+            edges_list += [ resolution[1] ]
+    binned = rebin_many( wave, err, edges_list )
+    outp = []
+    for resolution in resolutions:
+        if resolution is None:
+            outp += [ [ '', wave, err ] ]
+        else:
+            wbin, ebin, npts = binned.pop( 0 )
+            outp += [ [ get_label( resolution ), wbin, ebin ] ]
+    return outp
@@ -0,0 +1,153 @@
+from __future__ import print_function
+import os, pdb, sys
+import numpy as np
+try:
+    from . import tepcat as tepcat_module
+except ImportError:
+    import tepcat as tepcat_module
+
+"""
+Catalogue type backed by a single numpy structured array, as an alternative
+to the dictionary of parallel arrays returned by tepcat.load(). Columns are
+accessed by name as before, e.g. cat['kmags'], but rows can also be looked
+up by planet name in O(1) time via an index, e.g. cat.planet( 'WASP-121' ).kmags,
+without scanning the whole catalogue with a boolean mask.
+"""
+
+
+def load( **kwargs ):
+    """
+    Loads the TEPCat catalogue with tepcat.load() and returns it as a Catalogue.
+    """
+    return Catalogue.from_dict( tepcat_module.load( **kwargs ) )
+
+
+class Catalogue( object ):
+    """
+    Planet catalogue stored as one structured array. Indexing with a field
+    name returns that column (a view, not a copy); indexing with an integer
+    returns a Planet record; indexing with a boolean mask, slice or integer
+    array returns a new Catalogue with the selected rows. len() gives the
+    number of planets and iterating yields Planet records.
+    """
+
+    def __init__( self, data ):
+        self.data = data
+        self.index = {}
+        for i, name in enumerate( data['names'].tolist() ):
+            if name not in self.index:
+                self.index[name] = i
+
+    @classmethod
+    def from_dict( cls, tepcat ):
+        """
+        Builds a Catalogue from a dictionary of equal-length arrays.
+        """
+        keys = list( tepcat.keys() )
+        dtype = np.dtype( [ ( k, np.asarray( tepcat[k] ).dtype ) for k in keys ] )
+        data = np.empty( len( tepcat[keys[0]] ), dtype=dtype )
+        for k in keys:
+            data[k] = tepcat[k]
+        return cls( data )
+
+    def __len__( self ):
+        return len( self.data )
+
+    def __iter__( self ):
+        for i in range( len( self.data ) ):
+            yield Planet( self.data, i )
+
+    def __contains__( self, name ):
+        return name in self.index
+
+    def __getitem__( self, key ):
+        if isinstance( key, str ):
+            return self.data[key]
+        if isinstance( key, ( int, np.integer ) ):
+            if key<0:
+                key += len( self.data )
+            return Planet( self.data, key )
+        return Catalogue( self.data[key] )
+
+    def keys( self ):
+        """
+        Returns the list of column names.
+        """
+        return list( self.data.dtype.names )
+
+    def values( self ):
+        return [ self.data[k] for k in self.keys() ]
+
+    def items( self ):
+        return [ ( k, self.data[k] ) for k in self.keys() ]
+
+    def as_dict( self ):
+        """
+        Returns the catalogue as a dictionary of column views, in the format
+        returned by tepcat.load().
+        """
+        return dict( self.items() )
+
+    def row( self, name ):
+        """
+        Returns the row index of the named planet, raising a KeyError if it
+        is not in the catalogue.
+        """
+        return self.index[name]
+
+    def planet( self, name ):
+        """
+        Returns the Planet record for the named planet.
+        """
+        return Planet( self.data, self.index[name] )
+
+    def filter( self, mask ):
+        """
+        Returns a new Catalogue containing the rows where mask is True.
+        """
+        return Catalogue( self.data[np.asarray( mask, dtype=bool )] )
+
+    def sort( self, key, descending=True ):
+        """
+        Returns a new Catalogue sorted by the specified column.
+        """
+        ixs = np.argsort( self.data[key] )
+        if descending==True:
+            ixs = ixs[::-1]
+        return Catalogue( self.data[ixs] )
+
+
+class Planet( object ):
+    """
+    Lightweight view of one catalogue row. Fields can be accessed as
+    attributes, e.g. p.kmags, or by name, e.g. p['kmags'], and are read
+    directly from the catalogue array without copying the row.
+    """
+    __slots__ = [ 'data', 'ix' ]
+
+    def __init__( self, data, ix ):
+        self.data = data
+        self.ix = ix
+
+    def __getattr__( self, name ):
+        if name in Planet.__slots__:
+            raise AttributeError( name )
+        try:
+            return self.data[name][self.ix]
+        except ( ValueError, KeyError ):
+            raise AttributeError( name )
+
+    def __getitem__( self, name ):
+        return self.data[name][self.ix]
+
+    def keys( self ):
+        return list( self.data.dtype.names )
+
+    def as_dict( self ):
+        """
+        Returns the row as a dictionary of Python scalars.
+        """
+        return dict( zip( self.keys(), self.data[self.ix].tolist() ) )
+
+    def __repr__( self ):
+        return 'Planet( {0} )'.format( self.data['names'][self.ix] )
@@ -0,0 +1,184 @@
+from __future__ import print_function
+import os, pdb, sys, copy, hashlib, tempfile
+import numpy as np
+
+"""
+Routines for preparing PandExo input dictionaries in bulk. The catalogue
+columns are converted once and the PandExo templates returned by
+load_exo_dict() and load_mode_dict() are loaded once per process and
+copied for each task, which removes the per-task setup overhead when
+sweeping over many planets and modes.
+"""
+
+# PandExo templates loaded in the current process, keyed by
+# [ backend module name, template name ]:
+TEMPLATES = {}
+
+# Shared directory for planet spectrum files read by PandExo:
+SPECTRA_DIR = os.environ.get( 'PANDEXO_PREP_SPECTRA_DIR', \
+                              os.path.join( os.path.expanduser( '~' ), '.cache', 'pandexo_prep', 'spectra' ) )
+NULLSPEC_NPTS = 10000 # number of points in the null spectrum
+NULLSPEC_RANGE = [ 0.2, 40 ] # null spectrum wavelength range in micron
+
+# Catalogue fields that enter the JWST exoplanet dictionaries, so the
+# PandExo results of a planet only change if one of these does:
+EXO_FIELDS = [ 'kmags', 'tstar', 'metalstar', 'loggstar', 'tdurs' ]
+
+# Planet spectra prepared in the current process, as [ wave, spectrum ]
+# arrays keyed by name, and their file paths keyed by content hash:
+SPECTRA = {}
+SPECTRUM_PATHS = {}
+
+
+def build_index( names ):
+    """
+    Returns a dictionary mapping each name to its row index. If a name
+    occurs more than once, the first row is used.
+    """
+    index = {}
+    for i, name in enumerate( np.asarray( names ).tolist() ):
+        if name not in index:
+            index[name] = i
+    return index
+
+
+def get_exo_template( jdi ):
+    """
+    Returns a copy of the PandExo exoplanet dictionary template.
+    """
+    key = ( jdi.__name__, 'exo' )
+    if key not in TEMPLATES:
+        TEMPLATES[key] = jdi.load_exo_dict()
+    return copy.deepcopy( TEMPLATES[key] )
+
+
+def get_mode_dict( jdi, inst_mode ):
+    """
+    Returns a copy of the PandExo instrument dictionary for a mode.
+    """
+    key = ( jdi.__name__, inst_mode )
+    if key not in TEMPLATES:
+        TEMPLATES[key] = jdi.load_mode_dict( inst_mode )
+    return copy.deepcopy( TEMPLATES[key] )
+
+
+def get_nullspec():
+    """
+    Returns the wavelength (micron) and spectrum arrays of the null planet
+    spectrum, generated once per process.
+    """
+    if 'null' not in SPECTRA:
+        wave = np.linspace( NULLSPEC_RANGE[0], NULLSPEC_RANGE[1], NULLSPEC_NPTS )
+        SPECTRA['null'] = [ wave, np.zeros( NULLSPEC_NPTS ) ]
+    return SPECTRA['null']
+
+
+def get_nullpath( spectra_dir=None ):
+    """
+    Returns the path of the null spectrum file in the shared spectra directory,
+    writing it if it does not exist yet. See get_spectrum_path().
+    """
+    if spectra_dir is None:
+        spectra_dir = SPECTRA_DIR
+    key = ( os.path.abspath( spectra_dir ), 'null' )
+    if ( key not in SPECTRUM_PATHS )+( os.path.isfile( SPECTRUM_PATHS.get( key, '' ) )==False ):
+        wave, spectrum = get_nullspec()
+        SPECTRUM_PATHS[key] = get_spectrum_path( wave, spectrum, spectra_dir=spectra_dir, label='null' )
+    return SPECTRUM_PATHS[key]
+
+
+def spectrum_hash( wave, spectrum ):
+    """
+    Returns the hash of a planet spectrum's contents.
+    """
+    outp = np.column_stack( [ np.asarray( wave, dtype=float ), np.asarray( spectrum, dtype=float ) ] )
+    return hashlib.sha1( outp.tobytes() ).hexdigest()
+
+
+def get_spectrum_path( wave, spectrum, spectra_dir=None, label='spec' ):
+    """
+    Returns the path of a two-column text file containing the specified
+    planet spectrum, for use as the PandExo exopath. Files are named by the
+    hash of their contents and written to spectra_dir (default SPECTRA_DIR)
+    only if they do not already exist, via a temporary file renamed into
+    place, so each spectrum is written once and shared by every process and
+    working directory without write races.
+    """
+    if spectra_dir is None:
+        spectra_dir = SPECTRA_DIR
+    key = ( os.path.abspath( spectra_dir ), spectrum_hash( wave, spectrum ) )
+    fpath = SPECTRUM_PATHS.get( key, os.path.join( key[0], '{0}-{1}.txt'.format( label, key[1][:16] ) ) )
+    if os.path.isfile( fpath )==False:
+        if os.path.isdir( key[0] )==False:
+            try:
+                os.makedirs( key[0] )
+            except OSError:
+                # Created by another process in the meantime:
+                if os.path.isdir( key[0] )==False:
+                    raise
+        fd, tmppath = tempfile.mkstemp( dir=key[0], prefix='.tmp-', suffix='.txt' )
+        with os.fdopen( fd, 'w' ) as f:
+            np.savetxt( f, np.column_stack( [ wave, spectrum ] ) )
+        os.replace( tmppath, fpath )
+    SPECTRUM_PATHS[key] = fpath
+    return fpath
+
+
+def build_exo_dicts( jdi, tepcat, planets=None, sat_level=80, sat_unit='%', \
+                     noise_floor_ppm=20, exopath=None, index=None ):
+    """
+    Returns a dictionary of PandExo exoplanet dictionaries for JWST
+    simulations, keyed by planet name, for the specified planets (default
+    is all planets in the catalogue). Planets not in the catalogue are
+    omitted. exopath is the planet spectrum file to use for every planet, or
+    a [ wave, spectrum ] pair of arrays to be written once to the shared
+    spectra directory with get_spectrum_path(); the default is the null
+    spectrum. index is an optional name to row index from build_index(); if tepcat is
+    a catalogue.Catalogue, its own index is used.
+    """
+    if index is None:
+        index = getattr( tepcat, 'index', None )
+    if index is None:
+        index = build_index( tepcat['names'] )
+    if planets is None:
+        planets = tepcat['names']
+    if exopath is None:
+        exopath = get_nullpath()
+    elif isinstance( exopath, str )==False:
+        exopath = get_spectrum_path( exopath[0], exopath[1] )
+    cols = {}
+    for k in EXO_FIELDS:
+        cols[k] = np.asarray( tepcat[k], dtype=float ).tolist()
+
+    # Prepare the PandExo inputs that are the same for every planet:
+    template = get_exo_template( jdi )
+    template['observation']['sat_level'] = sat_level # default to 80% for basic run
+    template['observation']['sat_unit'] = sat_unit
+    template['observation']['noccultations'] = 1 # number of transits
+    template['observation']['R'] = None # do not pre-bin the output spectra
+    template['observation']['baseline'] = 1.0 # out-of-transit baseline quantity
+    template['observation']['baseline_unit'] ='frac' # baseline quantity is fraction of time in transit versus out
+    template['observation']['noise_floor'] = noise_floor_ppm # noise floor in p.p.m.
+    template['star']['type'] = 'phoenix' # use the provided Phoenix spectra
+    template['star']['ref_wave'] = 2.22 # K band central wavelength in micron
+    template['star']['r_unit'] = 'R_sun' # stellar radius unit
+    template['planet']['r_unit'] = 'R_jup' # planet radius unit
+    template['planet']['w_unit'] = 'um' # wavelength unit is micron; other options include 'Angs', secs" (for phase curves)
+    template['planet']['f_unit'] = 'fp/f*' # options are 'rp^2/r*^2' or 'fp/f*'
+    template['planet']['td_unit'] = 'd' # transit duration unit
+    template['planet']['exopath'] = exopath
+
+    # Fill in the planet-specific values:
+    zs = {}
+    for planet in np.asarray( planets ).tolist():
+        if planet not in index:
+            continue
+        ix = index[planet]
+        z = copy.deepcopy( template )
+        z['star']['mag'] = cols['kmags'][ix] # stellar magnitude
+        z['star']['temp'] = cols['tstar'][ix] # stellar effective temperature in Kelvin
+        z['star']['metal'] = cols['metalstar'][ix] # stellar metallicity as log10( [Fe/H] )
+        z['star']['logg'] = cols['loggstar'][ix] # stellar surface gravity as log10( g (c.g.s.) )
+        z['planet']['transit_duration'] = cols['tdurs'][ix] # transit duration in days
+        zs[planet] = z
+    return zs
@@ -0,0 +1,218 @@
+from __future__ import print_function
+import copy, os, sys, time, types
+import numpy as np
+
+"""
+Lightweight stand-in for pandexo.engine.justdoit, for testing the batch
+routines without PandExo installed. It implements the subset of the
+justdoit interface used by jwstsim and hstsim and returns result
+dictionaries with the same keys and array shapes as PandExo, filled with
+a crude photon-noise model. Use it via jwstsim.set_backend( 'fakejdi' ).
+
+Each run_pandexo call sleeps for LATENCY seconds, varied randomly by up to
+a fraction JITTER either way. Both can be set with set_latency() or with the
+FAKEJDI_LATENCY and FAKEJDI_JITTER environment variables. To use it as a
+drop-in replacement where PandExo is not installed, call install() before
+importing jwstsim or hstsim.
+"""
+
+LATENCY = float( os.environ.get( 'FAKEJDI_LATENCY', 0 ) )
+JITTER = float( os.environ.get( 'FAKEJDI_JITTER', 0 ) )
+
+# Instrument modes as [ wavelength min (micron), wavelength max (micron),
+# number of native resolution points, K magnitude saturation limit ]:
+MODES = { 'WFC3 G141':[ 1.1, 1.7, 14, 6.0 ], \
+          'MIRI LRS':[ 5.0, 12.0, 150, 4.5 ], \
+          'NIRISS SOSS':[ 0.6, 2.8, 2000, 8.5 ], \
+          'NIRSpec G140M':[ 0.7, 1.27, 700, 7.5 ], \
+          'NIRSpec G140H':[ 0.7, 1.27, 2000, 7.0 ], \
+          'NIRSpec G235M':[ 1.66, 3.07, 700, 7.0 ], \
+          'NIRSpec G235H':[ 1.66, 3.07, 2000, 6.5 ], \
+          'NIRSpec G395M':[ 2.87, 5.1, 700, 6.0 ], \
+          'NIRSpec G395H':[ 2.87, 5.1, 2000, 5.5 ], \
+          'NIRSpec Prism':[ 0.6, 5.3, 400, 10.5 ], \
+          'NIRCam F322W2':[ 2.4, 4.0, 1600, 5.0 ], \
+          'NIRCam F444W':[ 3.9, 5.0, 1200, 4.5 ] }
+FILTERS = { 'f070lp':[ 0.7, 1.27 ], 'f100lp':[ 0.97, 1.84 ] }
+
+# Observing mode of each instrument, which PandExo gives as the 'mode' of
+# the instrument configuration (and as 'Mode' in the result inputs):
+OBS_MODES = { 'nirspec':'bots', 'niriss':'soss', 'nircam':'ssgrism', 'miri':'lrsslitless', \
+              'wfc3':'spectroscopy' }
+
+ALL = dict( [ ( k, False ) for k in MODES.keys() ] )
+
+
+def set_latency( latency, jitter=0 ):
+    """
+    Sets the time in seconds taken by each run_pandexo call and its random
+    fractional variation, for this process and any worker processes
+    started afterwards.
+    """
+    global LATENCY, JITTER
+    LATENCY = float( latency )
+    JITTER = float( jitter )
+    os.environ['FAKEJDI_LATENCY'] = str( LATENCY )
+    os.environ['FAKEJDI_JITTER'] = str( JITTER )
+    return None
+
+
+def install():
+    """
+    Registers this module as pandexo.engine.justdoit (with an empty
+    pandexo.engine.justplotit), so that modules importing PandExo use the
+    stand-in. Only affects the current process.
+    """
+    for name in [ 'pandexo', 'pandexo.engine', 'pandexo.engine.justplotit' ]:
+        if name not in sys.modules:
+            sys.modules[name] = types.ModuleType( name )
+    sys.modules['pandexo.engine.justdoit'] = sys.modules[__name__]
+    sys.modules['pandexo'].engine = sys.modules['pandexo.engine']
+    sys.modules['pandexo.engine'].justdoit = sys.modules[__name__]
+    sys.modules['pandexo.engine'].justplotit = sys.modules['pandexo.engine.justplotit']
+    return None
+
+
+def load_exo_dict():
+    """
+    Returns an exoplanet input dictionary with the PandExo structure.
+    """
+    z = { 'calculation':'scale', \
+          'url':'', \
+          'observation':{ 'sat_level':80, 'sat_unit':'%', 'noccultations':1, \
+                          'R':None, 'baseline':1.0, 'baseline_unit':'frac', \
+                          'noise_floor':0 }, \
+          'star':{ 'type':'phoenix', 'mag':None, 'ref_wave':None, 'temp':None, \
+                   'metal':None, 'logg':None, 'radius':None, 'r_unit':None }, \
+          'planet':{ 'type':'user', 'exopath':None, 'w_unit':None, 'f_unit':None, \
+                     'transit_duration':None, 'td_unit':None } }
+    return z
+
+
+def load_mode_dict( inst ):
+    """
+    Returns an instrument dictionary with the PandExo structure.
+    """
+    if inst not in MODES:
+        raise KeyError( 'Unknown instrument mode {0}'.format( inst ) )
+    instrument, disperser = inst.lower().split( ' ' )
+    d = { 'configuration':{ 'instrument':{ 'instrument':instrument, 'mode':OBS_MODES[instrument], \
+                                           'aperture':'default', 'disperser':disperser, \
+                                           'filter':None }, \
+                            'detector':{ 'subarray':'default', 'readmode':'default', \
+                                         'nexp':1, 'ngroup':'optimize', 'nint':1 } }, \
+          'strategy':{ 'method':'specti', 'calculateRamp':False, 'useFirstOrbit':False, \
+                       'norbits':None, 'nchan':None, 'schedulability':100, \
+                       'scanDirection':'Forward' }, \
+          'mode':inst }
+    if 'G140' in inst:
+        d['configuration']['instrument']['filter'] = 'f070lp'
+    return d
+
+
+def run_pandexo( exo, inst, param_space=0, param_range=0, save_file=True, \
+                 output_path=os.getcwd(), output_file='', verbose=True ):
+    """
+    Returns a PandExo-shaped result dictionary for the specified inputs.
+    The inst argument can be a list containing one mode name or an
+    instrument dictionary returned by load_mode_dict().
+    """
+    if LATENCY>0:
+        time.sleep( LATENCY*( 1+JITTER*np.random.uniform( -1, 1 ) ) )
+    if isinstance( inst, dict ):
+        d = copy.deepcopy( inst )
+    else:
+        d = load_mode_dict( inst[0] )
+    mode = d['mode']
+    if mode=='WFC3 G141':
+        return run_wfc3( exo, d )
+    wmin, wmax, npts, ksat = MODES[mode]
+    filt = d['configuration']['instrument']['filter']
+    if filt in FILTERS:
+        wmin, wmax = FILTERS[filt]
+    wave = np.linspace( wmin, wmax, npts )
+    err = calc_error( exo, wave, npts )
+    floor = 1e-6*float( exo['observation']['noise_floor'] )
+    err_w_floor = np.maximum( err, floor )
+    saturated = ( exo['star']['mag']<ksat )
+    y = {}
+    y['FinalSpectrum'] = { 'wave':wave, 'spectrum':np.zeros( npts ), \
+                           'error_w_floor':err_w_floor, \
+                           'spectrum_w_rand':err_w_floor*np.random.randn( npts ) }
+    y['RawData'] = { 'wave':wave, 'error_no_floor':err }
+    y['warning'] = { 'Num Groups Reset?':'All good', \
+                     'Group Number Too Low?':'All good', \
+                     'Group Number Too High?':'All good', \
+                     'Non linear?':'All good', \
+                     'Saturated?':'All good', \
+                     '% full well high?':'All good' }
+    if saturated:
+        y['warning']['Saturated?'] = 'Full saturation:\n There are 1 pixels saturated at the end of the first group.'
+    y['input'] = { 'Instrument':d['configuration']['instrument']['instrument'].upper(), \
+                   'Mode':d['configuration']['instrument']['mode'], \
+                   'Aperture':d['configuration']['instrument']['aperture'], \
+                   'Disperser':d['configuration']['instrument']['disperser'], \
+                   'Subarray':d['configuration']['detector']['subarray'], \
+                   'Readmode':d['configuration']['detector']['readmode'], \
+                   'Filter':filt, \
+                   'Primary/Secondary':'fp/f*' }
+    tdur = 24*3600.*float( exo['planet']['transit_duration'] )
+    ngroup = max( [ 2, int( 10*( exo['star']['mag']-ksat ) ) ] )
+    y['timing'] = { 'Transit Duration':tdur/3600., \
+                    'Seconds per Frame':1.0, \
+                    'Time/Integration incl reset (sec)':float( ngroup+1 ), \
+                    'APT: Num Groups per Integration':ngroup, \
+                    'Num Integrations Out of Transit':int( tdur/( ngroup+1 ) ), \
+                    'Num Integrations In Transit':int( tdur/( ngroup+1 ) ), \
+                    'APT: Num Integrations per Occultation':int( 2*tdur/( ngroup+1 ) ), \
+                    'Observing Efficiency (%)':100.*ngroup/( ngroup+1 ), \
+                    'Transit+Baseline, no overhead (hrs)':2*tdur/3600., \
+                    'Number of Transits':exo['observation']['noccultations'] }
+    return y
+
+
+def run_wfc3( exo, d ):
+    """
+    Returns a PandExo-shaped HST WFC3 result dictionary.
+    """
+    nchan = d['strategy']['nchan']
+    if nchan is None:
+        nchan = 14
+    norbits = d['strategy']['norbits']
+    if norbits is None:
+        norbits = 4
+    binwave = np.linspace( 1.1, 1.7, nchan+1 )
+    binwave = 0.5*( binwave[1:]+binwave[:-1] )
+    nuse = norbits-int( d['strategy']['useFirstOrbit']==False )
+    err = 1e-4*( 10**( 0.2*( exo['star']['mag']-6 ) ) )*np.sqrt( nchan/14./max( [ nuse, 1 ] ) )
+    duty = { 'GRISM512':60., 'GRISM256':70., 'GRISM128':75. }.get( \
+             d['configuration']['detector']['subarray'], 60. )
+    if d['strategy']['scanDirection']=='Round Trip':
+        duty += 10.
+    y = {}
+    y['planet_spec'] = { 'binwave':binwave, 'error':err, 'binspec':np.zeros( nchan ) }
+    y['wfc3_TExoNS'] = { 'info':{ 'Number of HST orbits':norbits, \
+                                  'Use first orbit':d['strategy']['useFirstOrbit'], \
+                                  'WFC3 parameters: NSAMP':8, \
+                                  'WFC3 parameters: SAMP_SEQ':'SPARS10', \
+                                  'exposure time':89.0, \
+                                  'Recommended scan rate (arcsec/s)':0.1, \
+                                  'Scan height (pixels)':100., \
+                                  'Maximum pixel fluence (electrons)':30000., \
+                                  'Estimated duty cycle (outside of Earth occultation)':duty, \
+                                  'Transit depth uncertainty(ppm)':1e6*err, \
+                                  'Number of channels':nchan, \
+                                  'Number of Transits':1, \
+                                  'Start observations between orbital phases':'0.9-0.95' } }
+    return y
+
+
+def calc_error( exo, wave, npts ):
+    """
+    Crude photon-noise transit depth uncertainty per native resolution
+    element, scaling with K magnitude, wavelength and transit duration.
+    """
+    kmag = float( exo['star']['mag'] )
+    tdur = float( exo['planet']['transit_duration'] )
+    sigma = 1e-4*( 10**( 0.2*( kmag-8 ) ) )*np.sqrt( npts/500. )*np.sqrt( 0.1/tdur )
+    return sigma*np.sqrt( wave/wave.min() )
@@ -0,0 +1,301 @@
+from __future__ import print_function
+import os, pdb, sys, time, signal, traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    from . import hstsim, manifest, batch, profiling
+except ImportError:
+    import hstsim, manifest, batch, profiling
+
+"""
+Routines for running hstsim over a grid of HST WFC3 observation setups,
+i.e. every combination of planet, scan direction, subarray, number of
+spectroscopic channels and first-orbit choice. The grid is expanded and
+equivalent configurations (e.g. repeated grid values, or two planets with
+identical PandExo inputs) are run only once, on a pool of worker processes.
+The results are collected into a single table with the transit depth
+uncertainty per channel, number of orbits and duty cycle of each setup.
+"""
+
+SCANS = [ 'Round Trip', 'Forward' ]
+SUBARRAYS = [ 'GRISM512', 'GRISM256', 'GRISM128' ]
+
+# Accepted spellings of the scan directions:
+SCAN_ALIASES = { 'round trip':'Round Trip', 'roundtrip':'Round Trip', 'rt':'Round Trip', \
+                 'forward':'Forward', 'f':'Forward' }
+
+# Table columns in output order:
+TABLE_KEYS = [ 'planet', 'scan', 'subarray', 'nchan', 'useFirstOrbit', 'status', 'ppm', \
+               'norbits', 'duty_cycle', 'nsamp', 'samp_seq', 'exptime', 'runtime' ]
+
+# Worker process settings, set by init_worker():
+WORKER = {}
+
+
+def run_grid( planetdicts, scans=[ 'Round Trip' ], subarrays=[ 'GRISM512' ], nchans=[ 14 ], \
+              useFirstOrbit=[ False ], inst_mode='WFC3 G141', nworkers=None, timeout=None, \
+              backend=None, outdir=None, sat_level=80, sat_unit='%', noise_floor_ppm=20, \
+              table_path=None ):
+    """
+    Runs PandExo for every combination of planet and WFC3 setup.
+
+    planetdicts is a list of planet dictionaries in the format used by
+    hstsim.main() (or a single one). scans, subarrays, nchans and
+    useFirstOrbit are lists of the values to explore. nworkers is the
+    number of worker processes (default is the number of CPUs); if
+    nworkers=1 the configurations are run serially in the current process.
+    timeout is the maximum time allowed per PandExo run in seconds and
+    backend is the name of a module to use in place of
+    pandexo.engine.justdoit, e.g. the 'fakejdi' stand-in.
+
+    If outdir is provided, the noise spectrum and observation parameters
+    of each configuration are also saved under outdir/<planet>/, with the
+    number of channels included in the file names; equivalent
+    configurations are only saved once, under the first planet that uses
+    them. If table_path is provided, the results table is saved there with
+    save_table().
+
+    Returns the results table as a dictionary of arrays with keys given
+    by TABLE_KEYS, one row per grid point. The status of each row is
+    'done', 'failed' or 'timeout'.
+    """
+    if backend is not None:
+        hstsim.set_backend( backend )
+    if isinstance( planetdicts, dict ):
+        planetdicts = [ planetdicts ]
+    if nworkers is None:
+        nworkers = os.cpu_count()
+    t0 = time.time()
+    grid = expand_grid( planetdicts, scans=scans, subarrays=subarrays, nchans=nchans, \
+                        useFirstOrbit=useFirstOrbit, inst_mode=inst_mode, sat_level=sat_level, \
+                        sat_unit=sat_unit, noise_floor_ppm=noise_floor_ppm )
+    tasks = dedupe( grid )
+    print( '\n{0}\nRunning {1} WFC3 configurations ({2} grid points) on {3} workers\n{0}\n'\
+           .format( 50*'#', len( tasks ), len( grid ), nworkers ) )
+
+    simkw = { 'outdir':outdir, 'timeout':timeout }
+    results = {}
+    if nworkers==1:
+        init_worker( backend, simkw )
+        for task in tasks:
+            results[task['hash']] = run_config( task )
+            report_progress( task, results[task['hash']], len( results ), len( tasks ) )
+    else:
+        with ProcessPoolExecutor( max_workers=nworkers, initializer=init_worker, \
+                                  initargs=( backend, simkw ) ) as pool:
+            futures = {}
+            for task in tasks:
+                futures[pool.submit( run_config, task )] = task
+            for f in as_completed( futures ):
+                task = futures[f]
+                try:
+                    result = f.result()
+                except Exception as err:
+                    # Worker process died, e.g. killed by the OS:
+                    result = new_result()
+                    result['error'] = repr( err )
+                results[task['hash']] = result
+                report_progress( task, result, len( results ), len( tasks ) )
+
+    table = build_table( grid, results )
+    statuses = table['status']
+    print( '\n{0}\nFinished {1} configurations in {2:.2f} minutes'\
+           .format( 50*'#', len( tasks ), ( time.time()-t0 )/60. ) )
+    for s in [ 'done', 'timeout', 'failed' ]:
+        print( '... {0}: {1}'.format( s, ( statuses==s ).sum() ) )
+    for h in results:
+        if results[h]['status']!='done':
+            print( '\n*** {0}:\n{1}'.format( h, results[h]['error'] ) )
+    print( '{0}\n'.format( 50*'#' ) )
+    if table_path is not None:
+        save_table( table, table_path )
+    return table
+
+
+def expand_grid( planetdicts, scans=[ 'Round Trip' ], subarrays=[ 'GRISM512' ], nchans=[ 14 ], \
+                 useFirstOrbit=[ False ], inst_mode='WFC3 G141', sat_level=80, sat_unit='%', \
+                 noise_floor_ppm=20 ):
+    """
+    Returns a list of grid points, one per combination of planet and setup,
+    each a dictionary with keys 'planet', 'scan', 'subarray', 'nchan',
+    'useFirstOrbit', 'inst_mode', 'z' (the PandExo exoplanet dictionary),
+    'norb' and 'hash'. Grid values are put in canonical form and repeated
+    values are dropped, so each setup appears once per planet. The hash
+    identifies the PandExo inputs, so grid points with the same hash are
+    equivalent.
+    """
+    scans = unique( [ get_scan( s ) for s in scans ] )
+    subarrays = unique( [ str( s ).upper() for s in subarrays ] )
+    for s in subarrays:
+        if s not in SUBARRAYS:
+            raise ValueError( 'subarray must be one of {0}'.format( ', '.join( SUBARRAYS ) ) )
+    nchans = unique( [ int( n ) for n in nchans ] )
+    useFirstOrbit = unique( [ bool( u ) for u in useFirstOrbit ] )
+    grid = []
+    labels = []
+    for planetdict in planetdicts:
+        if planetdict['name'] in labels:
+            continue # same planet listed twice
+        labels += [ planetdict['name'] ]
+        z, norb = hstsim.prepare_exo_dict( planetdict, sat_level=sat_level, sat_unit=sat_unit, \
+                                           noise_floor_ppm=noise_floor_ppm )
+        for scan in scans:
+            for subarray in subarrays:
+                for nchan in nchans:
+                    for u in useFirstOrbit:
+                        point = { 'planet':planetdict['name'], 'scan':scan, 'subarray':subarray, \
+                                  'nchan':nchan, 'useFirstOrbit':u, 'inst_mode':inst_mode, \
+                                  'z':z, 'norb':norb }
+                        point['hash'] = manifest.hash_inputs( z, inst_mode, scan, subarray, \
+                                                              nchan, u, norb )
+                        grid += [ point ]
+    return grid
+
+
+def dedupe( grid ):
+    """
+    Returns the grid points with distinct hashes, keeping the first of
+    each set of equivalent configurations.
+    """
+    tasks = []
+    hashes = set()
+    for point in grid:
+        if point['hash'] not in hashes:
+            hashes.add( point['hash'] )
+            tasks += [ point ]
+    return tasks
+
+
+def unique( values ):
+    """
+    Returns the distinct values in a list, preserving their order.
+    """
+    outp = []
+    for v in values:
+        if v not in outp:
+            outp += [ v ]
+    return outp
+
+
+def get_scan( scan ):
+    """
+    Returns the scan direction in the form expected by PandExo.
+    """
+    try:
+        return SCAN_ALIASES[str( scan ).lower()]
+    except KeyError:
+        raise ValueError( 'scan must be Round Trip or Forward' )
+
+
+def init_worker( backend, simkw ):
+    """
+    Sets up the PandExo backend and output settings in a worker process.
+    """
+    if backend is not None:
+        hstsim.set_backend( backend )
+    hstsim.get_jdi()
+    WORKER['simkw'] = simkw
+    return None
+
+
+def new_result():
+    """
+    Returns a result dictionary with status 'failed' and no values.
+    """
+    return { 'status':'failed', 'ppm':np.nan, 'norbits':-1, 'duty_cycle':np.nan, \
+             'nsamp':-1, 'samp_seq':'', 'exptime':np.nan, 'runtime':0., 'outputs':[], \
+             'error':None }
+
+
+def run_config( task ):
+    """
+    Runs PandExo for a single grid point in a worker process, catching any
+    exception so that one failed configuration does not stop the grid.
+    """
+    simkw = WORKER['simkw']
+    result = new_result()
+    t1 = time.time()
+    timeout = simkw['timeout']
+    if timeout is not None:
+        signal.signal( signal.SIGALRM, batch.alarm_handler )
+        signal.setitimer( signal.ITIMER_REAL, timeout )
+    try:
+        setup = { 'subarray':task['subarray'], 'useFirstOrbit':task['useFirstOrbit'], \
+                  'scan':task['scan'], 'nchan':task['nchan'] }
+        oname = hstsim.get_onames( task['inst_mode'], **setup )[0][:-len( '.txt' )]
+        with profiling.profile( '{0}.{1}'.format( task['planet'], oname ) ):
+            y = hstsim.simulate_config( task['z'], task['inst_mode'], norb=task['norb'], **setup )
+            result.update( hstsim.get_info( y ) )
+            if simkw['outdir'] is not None:
+                odirfull = os.path.join( simkw['outdir'], task['planet'] )
+                if os.path.isdir( odirfull )==False:
+                    try:
+                        os.makedirs( odirfull )
+                    except OSError:
+                        # Created by another process in the meantime:
+                        if os.path.isdir( odirfull )==False:
+                            raise
+                result['outputs'] = list( hstsim.save_config( y, task['inst_mode'], odirfull, \
+                                                              label_nchan=True, **setup ) )
+        result['status'] = 'done'
+    except batch.TaskTimeout:
+        result['status'] = 'timeout'
+        result['error'] = 'Exceeded {0} s'.format( timeout )
+    except Exception:
+        result['error'] = traceback.format_exc()
+    finally:
+        if timeout is not None:
+            signal.setitimer( signal.ITIMER_REAL, 0 )
+    result['runtime'] = time.time()-t1
+    return result
+
+
+def report_progress( task, result, k, ntasks ):
+    """
+    Prints a progress line for a finished configuration.
+    """
+    print( '[{0}/{1}] {2} {3} {4} nchan={5} useFirstOrbit={6}: {7} in {8:.1f} s'\
+           .format( k, ntasks, task['planet'], task['scan'], task['subarray'], task['nchan'], \
+                    task['useFirstOrbit'], result['status'], result['runtime'] ) )
+    return None
+
+
+def build_table( grid, results ):
+    """
+    Returns the results table for the grid points as a dictionary of arrays,
+    with equivalent grid points sharing the result of the configuration
+    that was run.
+    """
+    rows = []
+    for point in grid:
+        row = {}
+        row.update( results[point['hash']] )
+        for k in [ 'planet', 'scan', 'subarray', 'nchan', 'useFirstOrbit' ]:
+            row[k] = point[k]
+        rows += [ row ]
+    table = {}
+    for k in TABLE_KEYS:
+        table[k] = np.array( [ row[k] for row in rows ] )
+    return table
+
+
+def save_table( table, opath ):
+    """
+    Saves a results table as a whitespace-delimited text file with one row
+    per grid point and a header line giving the column names. Scan
+    directions are written without spaces, e.g. 'RoundTrip'.
+    """
+    n = len( table['planet'] )
+    with open( opath, 'w' ) as f:
+        f.write( '# {0}\n'.format( ' '.join( TABLE_KEYS ) ) )
+        for i in range( n ):
+            f.write( '{0} {1} {2} {3:.0f} {4} {5} {6:.2f} {7:.0f} {8:.2f} {9:.0f} {10} {11:.2f} {12:.3f}\n'\
+                     .format( table['planet'][i].replace( ' ', '_' ), \
+                              table['scan'][i].replace( ' ', '' ), \
+                              table['subarray'][i], table['nchan'][i], \
+                              table['useFirstOrbit'][i], table['status'][i], \
+                              table['ppm'][i], table['norbits'][i], table['duty_cycle'][i], \
+                              table['nsamp'][i], table['samp_seq'][i] or '-', \
+                              table['exptime'][i], table['runtime'][i] ) )
+    print( 'Saved grid results: {0}'.format( opath ) )
+    return None
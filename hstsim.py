@@ -1,10 +1,19 @@
 from __future__ import print_function
-import os, pdb, sys, time
+import os, pdb, sys, time, copy, importlib
 import numpy as np
-import pandexo.engine.justdoit as jdi
-import pandexo.engine.justplotit as jpi
-import matplotlib.pyplot as plt
+try:
+    from . import config, profiling
+    from . import tepcat as tepcat_module
+except ImportError:
+    import config, profiling
+    import tepcat as tepcat_module
 
+# PandExo justdoit module (or a stand-in set by set_backend()), imported on
+# first use by get_jdi() so that importing this module stays fast:
+BACKEND = 'pandexo.engine.justdoit'
+jdi = None
+
+HST_ORB_PERIOD_DAYS = 96./60./24.
 
 
 def main( planetdict, sat_level=80, sat_unit='%', noise_floor_ppm=20, \
@@ -32,7 +41,60 @@ def main( planetdict, sat_level=80, sat_unit='%', noise_floor_ppm=20, \
     #    return None
 
     # Prepare the PandExo inputs:
-    z = jdi.load_exo_dict()
+    z, norb = prepare_exo_dict( planetdict, sat_level=sat_level, sat_unit=sat_unit, \
+                                noise_floor_ppm=noise_floor_ppm )
+
+    # Run PandExo over requested instrument modes:
+    if inst_modes=='all':
+        inst_modes = [ 'WFC3 G141' ]  # G102 not implemented?
+    nmodes = len( inst_modes )
+
+    if nmodes==1:
+        modestr = '{0} instrument mode:\n'.format( nmodes )
+    else:
+        modestr = '{0} instrument modes:\n'.format( nmodes )
+    for m in inst_modes: modestr += '{0}, '.format( m )
+    print( '\n{0}\nRunning PandExo for {1}\n{2}\n{0}\n'.format( 50*'#', planet_label, modestr[:-2] ) )
+
+    for k in range( nmodes ):
+        y = simulate_config( z, inst_modes[k], subarray=subarray, useFirstOrbit=useFirstOrbit, \
+                             scan=scan, nchan=nchan, norb=norb )
+        save_config( y, inst_modes[k], odirfull, subarray=subarray, useFirstOrbit=useFirstOrbit, \
+                     scan=scan, nchan=nchan )
+
+    t2 = time.time()
+    print( 'Total time taken = {0:.2f} minutes'.format( (t2-t1)/60. ) )
+    return None
+
+
+def set_backend( module_name ):
+    """
+    Replaces the PandExo justdoit module used by this module, e.g. with
+    a stand-in such as 'fakejdi' for testing.
+    """
+    global BACKEND, jdi
+    BACKEND = module_name
+    jdi = importlib.import_module( module_name )
+    return jdi
+
+
+def get_jdi():
+    """
+    Returns the PandExo justdoit module, importing it on the first call.
+    """
+    global jdi
+    if jdi is None:
+        jdi = importlib.import_module( BACKEND )
+    return jdi
+
+
+def prepare_exo_dict( planetdict, sat_level=80, sat_unit='%', noise_floor_ppm=20 ):
+    """
+    Returns the PandExo exoplanet dictionary for the planet described by
+    planetdict, and the number of HST orbits needed to cover twice the
+    transit duration. The planetdict is not modified.
+    """
+    z = config.get_exo_template( get_jdi() )
     z['observation']['sat_level'] = sat_level # default to 80% for basic run
     z['observation']['sat_unit'] = sat_unit
     z['observation']['noccultations'] = 1 # number of transits
@@ -40,72 +102,232 @@ def main( planetdict, sat_level=80, sat_unit='%', noise_floor_ppm=20, \
     z['observation']['baseline'] = 1.0 # out-of-transit baseline quantity
     z['observation']['baseline_unit'] ='frac' # baseline quantity is fraction of time in transit versus out
     z['observation']['noise_floor'] = noise_floor_ppm # noise floor in p.p.m.
-    z['star'] = planetdict['star']
-    z['planet'] = planetdict['planet']
+    z['star'] = copy.deepcopy( planetdict['star'] )
+    z['planet'] = copy.deepcopy( planetdict['planet'] )
     z['planet']['type'] = 'constant'
-    HST_ORB_PERIOD_DAYS = 96./60./24.
     tobs_days = 2*z['planet']['transit_duration']
     norb = int( np.ceil( tobs_days/HST_ORB_PERIOD_DAYS ) )
     
-    # Use a null spectrum for the planet:
+    # Use a null spectrum for the planet, shared by all processes:
     z['planet']['exopath'] = get_nullpath()
-    if os.path.isfile( z['planet']['exopath'] )==False:
-        generate_nullspec()
+    return z, norb
 
-    # Run PandExo over requested instrument modes:
-    if inst_modes=='all':
-        inst_modes = [ 'WFC3 G141' ]  # G102 not implemented?
-    nmodes = len( inst_modes )
 
-    if nmodes==1:
-        modestr = '{0} instrument mode:\n'.format( nmodes )
+def build_planetdicts( tepcat, planets=None, quiet=False, on_clamped='warn' ):
+    """
+    Returns planet dictionaries in the format taken by main(), built in bulk
+    from the TEPCat catalogue for the specified planets (default is all
+    planets in the catalogue), so that HST simulations do not need a hand-
+    written planetdict. The transit depth is taken from the observed depth
+    where available (otherwise RpRs^2) and the inclination is derived from
+    the transit duration, depth, period and aRs with tepcat.calc_inclination().
+    Missing eccentricities are taken to be zero and the argument of
+    periastron is set to 90 degrees, as TEPCat does not provide it.
+
+    Where the transit duration is longer than a central transit allows,
+    the inclination is clamped to 90 degrees. If on_clamped is 'warn' these
+    planets are kept, with the reason listed under planetdict['warnings'];
+    if it is 'flag' they are treated as planets that cannot be completed.
+
+    Returns a dictionary of planet dictionaries keyed by planet name, and a
+    dictionary giving the reason each remaining planet could not be
+    completed (not in the catalogue, or missing/unphysical values).
+    """
+    if on_clamped not in [ 'warn', 'flag' ]:
+        raise ValueError( 'on_clamped must be warn or flag' )
+    names = np.asarray( tepcat['names'] )
+    if planets is None:
+        planets = names
+    planets = np.asarray( planets ).astype( names.dtype )
+    index = getattr( tepcat, 'index', None )
+    if index is None:
+        index = config.build_index( names )
+    found = np.array( [ p in index for p in planets.tolist() ], dtype=bool )
+    ixs = np.array( [ index[p] for p in planets[found].tolist() ], dtype=int )
+
+    # Compute the quantities for all of the planets at once:
+    cols = {}
+    for k in [ 'kmags', 'tstar', 'metalstar', 'loggstar', 'rstar', 'rplanet', 'tdurs', \
+               'tdepths', 'periods', 'aRs', 'RpRs', 'ecc' ]:
+        cols[k] = np.asarray( tepcat[k], dtype=float )[ixs]
+    depth = np.where( cols['tdepths']>0, 1e-2*cols['tdepths'], cols['RpRs']**2. ) # TEPCat depth in %
+    ecc = np.clip( cols['ecc'], 0, None )
+    incl, clamped = tepcat_module.calc_inclination( cols['tdurs'], cols['periods'], cols['aRs'], \
+                                                    np.sqrt( depth ), ecc=ecc, w_deg=90, \
+                                                    return_clamped=True )
+
+    # Flag planets that cannot be completed:
+    reasons = np.zeros( len( ixs ), dtype=object )
+    reasons[:] = ''
+    for k in [ 'kmags', 'tstar', 'rstar', 'rplanet', 'tdurs', 'periods', 'aRs' ]:
+        bad = ( np.isfinite( cols[k] )==False )+( cols[k]<=0 )
+        reasons[bad] += 'missing {0}; '.format( k )
+    bad = ( np.isfinite( incl )==False )*( reasons=='' )
+    reasons[bad] += 'transit duration inconsistent with period and aRs; '
+    clamp_msg = 'transit duration longer than a central transit allows, inclination set to 90 deg'
+    if on_clamped=='flag':
+        reasons[clamped*( reasons=='' )] += '{0}; '.format( clamp_msg )
+
+    planetdicts = {}
+    flagged = {}
+    for p in planets[~found].tolist():
+        flagged[p] = 'not in catalogue'
+    for i, p in enumerate( planets[found].tolist() ):
+        if reasons[i]!='':
+            flagged[p] = reasons[i][:-2]
+            continue
+        planetdict = { 'name':p, 'star':{}, 'planet':{} }
+        planetdict['star']['type'] = 'phoenix' # use the provided Phoenix spectra
+        planetdict['star']['mag'] = cols['kmags'][i] # stellar magnitude
+        planetdict['star']['ref_wave'] = 2.22 # K band central wavelength in micron
+        planetdict['star']['temp'] = cols['tstar'][i] # stellar effective temperature in Kelvin
+        planetdict['star']['metal'] = cols['metalstar'][i] # stellar metallicity as log10( [Fe/H] )
+        planetdict['star']['logg'] = cols['loggstar'][i] # stellar surface gravity as log10( g (c.g.s.) )
+        planetdict['star']['radius'] = cols['rstar'][i]
+        planetdict['star']['r_unit'] = 'R_sun' # stellar radius unit
+        planetdict['planet']['transit_duration'] = cols['tdurs'][i] # transit duration in days
+        planetdict['planet']['depth'] = depth[i]
+        planetdict['planet']['period'] = cols['periods'][i] # planet orbital period in days
+        planetdict['planet']['i'] = incl[i]
+        planetdict['planet']['ars'] = cols['aRs'][i]
+        planetdict['planet']['ecc'] = ecc[i]
+        planetdict['planet']['w'] = 90.
+        planetdict['planet']['radius'] = cols['rplanet'][i]
+        planetdict['planet']['r_unit'] = 'R_jup' # planet radius unit
+        planetdict['planet']['w_unit'] = 'um' # wavelength unit is micron
+        planetdict['planet']['f_unit'] = 'rp^2/r*^2' # options are 'rp^2/r*^2' or 'fp/f*'
+        planetdict['planet']['td_unit'] = 'd' # transit duration unit
+        planetdict['warnings'] = []
+        if clamped[i]:
+            planetdict['warnings'] += [ clamp_msg ]
+        planetdicts[p] = planetdict
+    if quiet==False:
+        print( 'Built HST planet dictionaries for {0} of {1} planets'.format( len( planetdicts ), \
+                                                                          len( planets ) ) )
+        for p in flagged:
+            print( '... could not complete {0}: {1}'.format( p, flagged[p] ) )
+        for p in planetdicts:
+            for w in planetdicts[p]['warnings']:
+                print( '... warning for {0}: {1}'.format( p, w ) )
+    return planetdicts, flagged
+
+
+def get_scanlabel( scan ):
+    """
+    Returns the short label used in output file names for a scan direction.
+    """
+    if scan=='Round Trip':
+        return 'RTscan'
+    elif scan=='Forward':
+        return 'Fscan'
     else:
-        modestr = '{0} instrument modes:\n'.format( nmodes )
-    for m in inst_modes: modestr += '{0}, '.format( m )
-    print( '\n{0}\nRunning PandExo for {1}\n{2}\n{0}\n'.format( 50*'#', planet_label, modestr[:-2] ) )
+        raise ValueError( 'scan must be Round Trip or Forward' )
 
-    for k in range( nmodes ):
-        s1 = inst_modes[k].replace( ' ', '-' )
-        if useFirstOrbit==True:
-            s2 = 'keepFirstOrbit'
-        else:
-            s2 = 'dropFirstOrbit'
-        if scan=='Round Trip':
-            s3 = 'RTscan'
-        elif scan=='Forward':
-            s3 = 'Fscan'
-        else:
-            pdb.set_trace()
-        oname = '{0}.{1}.{2}.{3}.txt'.format( s1, subarray, s2, s3 )
-        oname_obs = oname.replace( '.txt', '.obspar.txt' )
-        opath = os.path.join( odirfull, oname )
-        opath_obs = os.path.join( odirfull, oname_obs)
-        wfc3 = jdi.load_mode_dict( inst_modes[k] )
-        wfc3['configuration']['detector']['subarray'] = subarray
-        wfc3['strategy']['calculateRamp'] = useFirstOrbit
-        wfc3['strategy']['useFirstOrbit'] = useFirstOrbit
-        if norb is not 'optimize':
-            wfc3['strategy']['norbits'] = norb
-        if useFirstOrbit==True:
-            wfc3['strategy']['norbits'] = norb
-        else:
-            wfc3['strategy']['norbits'] = norb+1
-        wfc3['strategy']['nchan'] = nchan
-        wfc3['strategy']['schedulability'] = 100
-        wfc3['strategy']['scanDirection'] = scan
-        y = jdi.run_pandexo( z, wfc3, save_file=False )
-        #pdb.set_trace()
-        #y = jdi.run_pandexo( z, [inst_modes[k]], save_file=False )
-        wav = y['planet_spec']['binwave']
-        err = (1e6)*y['planet_spec']['error']*np.ones( nchan )
+
+def get_onames( inst_mode, subarray='GRISM512', useFirstOrbit=False, scan='Round Trip', \
+                nchan=None ):
+    """
+    Returns the file names for the noise and observation parameter outputs.
+    The number of channels is only included in the names if nchan is given.
+    """
+    s1 = inst_mode.replace( ' ', '-' )
+    if useFirstOrbit==True:
+        s2 = 'keepFirstOrbit'
+    else:
+        s2 = 'dropFirstOrbit'
+    s3 = get_scanlabel( scan )
+    oname = '{0}.{1}.{2}.{3}'.format( s1, subarray, s2, s3 )
+    if nchan is not None:
+        oname = '{0}.nchan{1:.0f}'.format( oname, nchan )
+    return '{0}.txt'.format( oname ), '{0}.obspar.txt'.format( oname )
+
+
+def get_mode_dict( inst_mode, subarray='GRISM512', useFirstOrbit=False, scan='Round Trip', \
+                   nchan=14, norb=4 ):
+    """
+    Returns the PandExo instrument dictionary for the specified WFC3 setup,
+    where norb is the number of orbits covering the observation excluding
+    the discarded first orbit.
+    """
+    wfc3 = config.get_mode_dict( get_jdi(), inst_mode )
+    wfc3['configuration']['detector']['subarray'] = subarray
+    wfc3['strategy']['calculateRamp'] = useFirstOrbit
+    wfc3['strategy']['useFirstOrbit'] = useFirstOrbit
+    if useFirstOrbit==True:
+        wfc3['strategy']['norbits'] = norb
+    else:
+        wfc3['strategy']['norbits'] = norb+1
+    wfc3['strategy']['nchan'] = nchan
+    wfc3['strategy']['schedulability'] = 100
+    wfc3['strategy']['scanDirection'] = scan
+    return wfc3
+
+
+def simulate_config( z, inst_mode, subarray='GRISM512', useFirstOrbit=False, scan='Round Trip', \
+                     nchan=14, norb=4 ):
+    """
+    Runs PandExo for a single WFC3 setup and returns the PandExo output
+    dictionary.
+    """
+    get_scanlabel( scan ) # check the scan direction before running
+    wfc3 = get_mode_dict( inst_mode, subarray=subarray, useFirstOrbit=useFirstOrbit, \
+                          scan=scan, nchan=nchan, norb=norb )
+    with profiling.stage( 'run_pandexo', mode=inst_mode, subarray=subarray, scan=scan, \
+                          nchan=nchan, useFirstOrbit=useFirstOrbit ):
+        y = get_jdi().run_pandexo( z, wfc3, save_file=False )
+    return y
+
+
+def save_config( y, inst_mode, odirfull, subarray='GRISM512', useFirstOrbit=False, \
+                 scan='Round Trip', nchan=14, label_nchan=False ):
+    """
+    Saves the noise spectrum and observation parameters from a PandExo
+    output dictionary to text files in the odirfull directory. If
+    label_nchan is True, the number of channels is included in the file
+    names. Returns the output paths.
+    """
+    if label_nchan==True:
+        oname, oname_obs = get_onames( inst_mode, subarray=subarray, useFirstOrbit=useFirstOrbit, \
+                                       scan=scan, nchan=nchan )
+    else:
+        oname, oname_obs = get_onames( inst_mode, subarray=subarray, useFirstOrbit=useFirstOrbit, \
+                                       scan=scan )
+    opath = os.path.join( odirfull, oname )
+    opath_obs = os.path.join( odirfull, oname_obs)
+    with profiling.stage( 'write', mode=inst_mode ):
+        wav, err = get_noise( y, nchan )
         outp = np.column_stack( [ wav, err ] )
         np.savetxt( opath, outp )
         print( '\nSaved noise: {0}'.format( opath, 50*'#' ) )
         save_obspar( opath_obs, y )
+    return opath, opath_obs
 
-    t2 = time.time()
-    print( 'Total time taken = {0:.2f} minutes'.format( (t2-t1)/60. ) )
-    return None
+
+def get_noise( y, nchan ):
+    """
+    Returns the channel wavelengths (micron) and noise per channel (ppm)
+    from a PandExo WFC3 output.
+    """
+    wav = y['planet_spec']['binwave']
+    err = (1e6)*y['planet_spec']['error']*np.ones( nchan )
+    return wav, err
+
+
+def get_info( y ):
+    """
+    Returns the main numbers from a PandExo WFC3 output as a dictionary
+    with keys 'ppm' (transit depth uncertainty per channel), 'norbits',
+    'duty_cycle' (%), 'nsamp', 'samp_seq' and 'exptime' (s).
+    """
+    info = y['wfc3_TExoNS']['info']
+    outp = {}
+    outp['ppm'] = float( info['Transit depth uncertainty(ppm)'] )
+    outp['norbits'] = int( info['Number of HST orbits'] )
+    outp['duty_cycle'] = float( info['Estimated duty cycle (outside of Earth occultation)'] )
+    outp['nsamp'] = int( info['WFC3 parameters: NSAMP'] )
+    outp['samp_seq'] = str( info['WFC3 parameters: SAMP_SEQ'] )
+    outp['exptime'] = float( info['exposure time'] )
+    return outp
 
 
 def save_obspar( opath, y ):
@@ -153,17 +375,13 @@ def save_obspar( opath, y ):
 
 def generate_nullspec():
     """
-    Generates a null spectrum and saves it in the working directory.
+    Writes the null spectrum to the shared spectra directory if it is not
+    there yet and returns its path (see config.get_nullpath()).
     """
-    n = int( 1e4 )
-    x = np.linspace( 0.2, 40, n )
-    y = np.zeros( n )
-    nullpath = get_nullpath()
-    np.savetxt( nullpath, np.column_stack( [ x, y ] ) )
-    return nullpath
+    return config.get_nullpath()
 
 def get_nullpath():
     """
-    Returns the path of the null spectrum.
+    Returns the path of the null spectrum, creating it if necessary.
     """
-    return os.path.join( os.getcwd(), 'zeros.txt' )
+    return config.get_nullpath()
@@ -1,67 +1,41 @@
 from __future__ import print_function
-import os, pdb, sys, time
+import os, pdb, sys, time, importlib
 import numpy as np
-import pandexo.engine.justdoit as jdi
-import pandexo.engine.justplotit as jpi
-import matplotlib.pyplot as plt
+try:
+    from . import config, profiling, binning, memo as memo_cache
+except ImportError:
+    import config, profiling, binning
+    import memo as memo_cache
 
+# PandExo justdoit module (or a stand-in set by set_backend()), imported on
+# first use by get_jdi() so that importing this module stays fast:
+BACKEND = 'pandexo.engine.justdoit'
+jdi = None
 
 
 def main( planet_label, tepcat, sat_level=80, sat_unit='%', noise_floor_ppm=20, \
-          inst_modes='all', outdir='.' ):
+          inst_modes='all', outdir='.', memo=False, resolutions=None ):
     """
     Routine called by the run_jwst.py script to run PandExo over specified 
-    modes for specified planet.
+    modes for specified planet. If memo is True, PandExo results are cached
+    on disk and reused for identical inputs (see memo.py). If resolutions
+    is provided, the noise spectra are saved binned to each of those
+    resolutions (see save_mode()).
     """
     t1 = time.time()
 
     # Prepare the output directory:
-    cwd = os.getcwd()
-    if outdir=='.':
-        outdir = cwd
-    odirfull = os.path.join( outdir, planet_label )
-    if os.path.isdir( odirfull )==False:
-        os.makedirs( odirfull )
+    odirfull = get_outdir( planet_label, outdir=outdir )
 
-    # Identify the tepcat index:
-    ix = ( tepcat['names']==planet_label )
-    if ix.sum()==0:
+    # Prepare the PandExo inputs:
+    z = prepare_exo_dict( planet_label, tepcat, sat_level=sat_level, sat_unit=sat_unit, \
+                          noise_floor_ppm=noise_floor_ppm )
+    if z is None:
         print( 'Could not match {0} to any TEPCat planets - skipping'.format( planet_label ) )
         return None
 
-    # Prepare the PandExo inputs:
-    z = jdi.load_exo_dict()
-    z['observation']['sat_level'] = sat_level # default to 80% for basic run
-    z['observation']['sat_unit'] = sat_unit
-    z['observation']['noccultations'] = 1 # number of transits
-    z['observation']['R'] = None # do not pre-bin the output spectra
-    z['observation']['baseline'] = 1.0 # out-of-transit baseline quantity
-    z['observation']['baseline_unit'] ='frac' # baseline quantity is fraction of time in transit versus out
-    z['observation']['noise_floor'] = noise_floor_ppm # noise floor in p.p.m.
-    z['star']['type'] = 'phoenix' # use the provided Phoenix spectra 
-    z['star']['mag'] = float( tepcat['kmags'][ix] ) # stellar magnitude
-    z['star']['ref_wave'] = 2.22 # K band central wavelength in micron
-    z['star']['temp'] = float( tepcat['tstar'][ix] ) # stellar effective temperature in Kelvin
-    z['star']['metal'] = float( tepcat['metalstar'][ix] ) # stellar metallicity as log10( [Fe/H] )
-    z['star']['logg'] = float( tepcat['loggstar'][ix] ) # stellar surface gravity as log10( g (c.g.s.) )
-    z['star']['r_unit'] = 'R_sun' # stellar radius unit
-    z['planet']['r_unit'] = 'R_jup' # planet radius unit
-    z['planet']['w_unit'] = 'um' # wavelength unit is micron; other options include 'Angs', secs" (for phase curves)
-    z['planet']['f_unit'] = 'fp/f*' # options are 'rp^2/r*^2' or 'fp/f*'
-    #z['planet']['transit_duration'] = float( tepcat['tdurs'][ix] )*24.*60.*60. # transit duration in seconds
-    #z['planet']['td_unit'] = 's' # transit duration unit
-    z['planet']['transit_duration'] = float( tepcat['tdurs'][ix] ) # transit duration in days
-    z['planet']['td_unit'] = 'd' # transit duration unit
-    
-    # Use a null spectrum for the planet:
-    z['planet']['exopath'] = get_nullpath()
-    if os.path.isfile( z['planet']['exopath'] )==False:
-        generate_nullspec()
-
     # Run PandExo over requested instrument modes:
-    if inst_modes=='all':
-        inst_modes = list( jdi.ALL.keys() )
-        inst_modes.remove( 'WFC3 G141' ) # remove HST modes
+    inst_modes = get_inst_modes( inst_modes )
     nmodes = len( inst_modes )
 
     if nmodes==1:
@@ -71,43 +45,238 @@ def main( planet_label, tepcat, sat_level=80, sat_unit='%', noise_floor_ppm=20,
     for m in inst_modes: modestr += '{0}, '.format( m )
     print( '\n{0}\nRunning PandExo for {1}\n{2}\n{0}\n'.format( 50*'#', planet_label, modestr[:-2] ) )
 
-    for k in range( nmodes ):
-        # G140 has two filters, need to run the second (non-default) manually; the first
-        # is run by default when inst_modes[k] string passed to run_pandexo() below:
-        if 'G140' in inst_modes[k]:
-            # G140 non-default:
-            g140 = jdi.load_mode_dict(inst_modes[k])
-            g140['configuration']['instrument']['filter'] = 'f100lp'
-            oname = '{0}-F100LP.txt'.format( inst_modes[k].replace( ' ', '-' ) )
-            oname_obs = '{0}-F100LP.obspar.txt'.format( inst_modes[k].replace( ' ', '-' ) )
-            opath = os.path.join( odirfull, oname )
-            opath_obs = os.path.join( odirfull, oname_obs)
-            y = jdi.run_pandexo( z, g140, save_file=False )
-            wav = y['FinalSpectrum']['wave']
-            err = y['FinalSpectrum']['error_w_floor']*( 1e6 )
+    for task in list_mode_tasks( inst_modes ):
+        run_mode( z, task[0], task[1], odirfull, memo=memo, resolutions=resolutions )
+
+    t2 = time.time()
+    print( 'Total time taken = {0:.2f} minutes'.format( (t2-t1)/60. ) )
+    return None
+
+
+def set_backend( module_name ):
+    """
+    Replaces the PandExo justdoit module used by this module, e.g. with
+    a stand-in such as 'fakejdi' for testing.
+    """
+    global BACKEND, jdi
+    BACKEND = module_name
+    jdi = importlib.import_module( module_name )
+    return jdi
+
+
+def get_jdi():
+    """
+    Returns the PandExo justdoit module, importing it on the first call.
+    """
+    global jdi
+    if jdi is None:
+        jdi = importlib.import_module( BACKEND )
+    return jdi
+
+
+def get_outdir( planet_label, outdir='.' ):
+    """
+    Returns the output directory for the specified planet, creating it
+    if necessary.
+    """
+    if outdir=='.':
+        outdir = os.getcwd()
+    odirfull = os.path.join( outdir, planet_label )
+    if os.path.isdir( odirfull )==False:
+        try:
+            os.makedirs( odirfull )
+        except OSError:
+            # Created by another process in the meantime:
+            if os.path.isdir( odirfull )==False:
+                raise
+    return odirfull
+
+
+def get_inst_modes( inst_modes='all' ):
+    """
+    Returns the list of JWST instrument modes to run, expanding 'all'. A
+    single mode can be given as a string. Raises ValueError for modes that
+    are not in the PandExo mode table.
+    """
+    modes = list( get_jdi().ALL.keys() )
+    modes.remove( 'WFC3 G141' ) # remove HST modes
+    if isinstance( inst_modes, str ):
+        inst_modes = [ inst_modes ]
+    inst_modes = list( inst_modes )
+    if inst_modes==[ 'all' ]:
+        return modes
+    unknown = [ m for m in inst_modes if m not in modes ]
+    if len( unknown )>0:
+        raise ValueError( 'Unknown JWST instrument modes: {0}'.format( unknown ) )
+    return inst_modes
+
+
+def list_mode_tasks( inst_modes ):
+    """
+    Returns a list of [ inst_mode, filter ] pairs to run for each planet.
+    G140 has two filters, so the second (non-default) one is run as a
+    separate task with filter 'f100lp'; all other tasks have filter None,
+    meaning the PandExo default.
+    """
+    tasks = []
+    for m in inst_modes:
+        if 'G140' in m:
+            tasks += [ [ m, 'f100lp' ] ]
+        tasks += [ [ m, None ] ]
+    return tasks
+
+
+def prepare_exo_dict( planet_label, tepcat, sat_level=80, sat_unit='%', noise_floor_ppm=20 ):
+    """
+    Returns the PandExo exoplanet dictionary for the specified planet, or
+    None if the planet is not in the catalogue.
+    """
+    zs = prepare_exo_dicts( tepcat, [ planet_label ], sat_level=sat_level, \
+                            sat_unit=sat_unit, noise_floor_ppm=noise_floor_ppm )
+    return zs.get( planet_label, None )
+
+
+def prepare_exo_dicts( tepcat, planets=None, sat_level=80, sat_unit='%', noise_floor_ppm=20, \
+                       index=None ):
+    """
+    Returns a dictionary of PandExo exoplanet dictionaries keyed by planet
+    name, built in bulk for the specified planets (default is all planets).
+    Planets not in the catalogue are omitted. See config.build_exo_dicts().
+    """
+    # Use a null spectrum for the planet, shared by all processes:
+    nullpath = get_nullpath()
+    with profiling.stage( 'config' ):
+        zs = config.build_exo_dicts( get_jdi(), tepcat, planets=planets, sat_level=sat_level, \
+                                     sat_unit=sat_unit, noise_floor_ppm=noise_floor_ppm, \
+                                     exopath=nullpath, index=index )
+    return zs
+
+
+def get_onames( inst_mode, filt=None ):
+    """
+    Returns the file names for the noise and observation parameter outputs.
+    """
+    s = inst_mode.replace( ' ', '-' )
+    if filt is not None:
+        s = '{0}-{1}'.format( s, filt.upper() )
+    elif 'G140' in inst_mode:
+        s = '{0}-F070LP'.format( s )
+    return '{0}.txt'.format( s ), '{0}.obspar.txt'.format( s )
+
+
+def run_mode( z, inst_mode, filt, odirfull, memo=False, resolutions=None ):
+    """
+    Runs PandExo for a single instrument mode and filter (None for the
+    default filter) and saves the outputs to the odirfull directory.
+    If memo is True, the PandExo result cache is used. Returns the output
+    paths.
+    """
+    y = simulate_mode( z, inst_mode, filt, memo=memo )
+    return save_mode( y, inst_mode, filt, odirfull, resolutions=resolutions, \
+                      noise_floor_ppm=z['observation']['noise_floor'] )
+
+
+def simulate_mode( z, inst_mode, filt, memo=False ):
+    """
+    Runs PandExo for a single instrument mode and filter (None for the
+    default filter) and returns the PandExo output dictionary.
+    """
+    if filt is None:
+        inst = [ inst_mode ]
+    else:
+        inst = config.get_mode_dict( get_jdi(), inst_mode )
+        inst['configuration']['instrument']['filter'] = filt
+    with profiling.stage( 'run_pandexo', mode=inst_mode, filter=filt, memo=memo ):
+        if memo==True:
+            y = memo_cache.run_pandexo( get_jdi(), z, inst )
+        else:
+            y = get_jdi().run_pandexo( z, inst, save_file=False )
+    return y
+
+
+def save_mode( y, inst_mode, filt, odirfull, resolutions=None, noise_floor_ppm=0 ):
+    """
+    Saves the noise spectrum and observation parameters from a PandExo
+    output dictionary to text files in the odirfull directory. If
+    resolutions is provided, the noise spectrum is saved at each of those
+    resolutions instead of the native one (see binning.py), with the
+    resolution added to the file name, e.g. NIRSpec-G395H-R100.txt, and
+    noise_floor_ppm should be the noise floor of the simulation (see
+    get_spectra()). Returns the output paths, with the observation
+    parameters last.
+    """
+    oname, oname_obs = get_onames( inst_mode, filt )
+    opath_obs = os.path.join( odirfull, oname_obs)
+    opaths = []
+    with profiling.stage( 'write', mode=inst_mode, filter=filt ):
+        for suffix, wav, err in get_spectra( y, resolutions=resolutions, noise_floor_ppm=noise_floor_ppm ):
+            opath = os.path.join( odirfull, '{0}{1}.txt'.format( oname[:-len( '.txt' )], suffix ) )
             outp = np.column_stack( [ wav, err ] )
             np.savetxt( opath, outp )
             print( '\nSaved noise: {0}'.format( opath, 50*'#' ) )
-            save_obspar( opath_obs, y )
-            # G140 prepare default:
-            oname = '{0}-F070LP.txt'.format( inst_modes[k].replace( ' ', '-' ) )
-            oname_obs = '{0}-F070LP.obspar.txt'.format( inst_modes[k].replace( ' ', '-' ) )
-        else:
-            oname = '{0}.txt'.format( inst_modes[k].replace( ' ', '-' ) )
-            oname_obs = '{0}.obspar.txt'.format( inst_modes[k].replace( ' ', '-' ) )
-        opath = os.path.join( odirfull, oname )
-        opath_obs = os.path.join( odirfull, oname_obs)
-        y = jdi.run_pandexo( z, [inst_modes[k]], save_file=False )
-        wav = y['FinalSpectrum']['wave']
-        err = y['FinalSpectrum']['error_w_floor']*( 1e6 )
-        outp = np.column_stack( [ wav, err ] )
-        np.savetxt( opath, outp )
-        print( '\nSaved noise: {0}'.format( opath, 50*'#' ) )
+            opaths += [ opath ]
         save_obspar( opath_obs, y )
+    return tuple( opaths+[ opath_obs ] )
 
-    t2 = time.time()
-    print( 'Total time taken = {0:.2f} minutes'.format( (t2-t1)/60. ) )
-    return None
+
+def get_noise( y, floor=True ):
+    """
+    Returns the wavelengths (micron) and noise (ppm) from a PandExo output.
+    If floor is False, the noise before the noise floor was applied is
+    returned from PandExo's RawData, raising a ValueError if it is missing
+    or not on the same wavelengths as the output spectrum.
+    """
+    wav = y['FinalSpectrum']['wave']
+    if floor==True:
+        return wav, y['FinalSpectrum']['error_w_floor']*( 1e6 )
+    raw = y.get( 'RawData', {} ).get( 'error_no_floor', None )
+    if raw is None:
+        raise ValueError( 'PandExo output has no RawData error_no_floor' )
+    if np.size( raw )!=np.size( wav ):
+        raise ValueError( 'PandExo RawData error_no_floor has {0} points but the spectrum has {1}'\
+                          .format( np.size( raw ), np.size( wav ) ) )
+    return wav, np.asarray( raw )*( 1e6 )
+
+
+def get_spectra( y, resolutions=None, noise_floor_ppm=0 ):
+    """
+    Returns the noise spectrum from a PandExo output at each of the
+    specified resolutions, as a list of [ suffix, wavelengths (micron),
+    noise (ppm) ] with the file name suffix from binning.get_label(). The
+    default is the native resolution only.
+
+    Binning averages down the noise, so the spectrum is binned before the
+    noise floor is applied and noise_floor_ppm is then applied to each
+    binned spectrum, as PandExo does when it bins its own output.
+    """
+    if resolutions is None:
+        wav, err = get_noise( y )
+        return [ [ '', wav, err ] ]
+    wav, err = get_noise( y, floor=False )
+    spectra = binning.bin_resolutions( wav, err, resolutions )
+    for s in spectra:
+        s[2] = np.maximum( s[2], float( noise_floor_ppm ) )
+    return spectra
+
+
+def get_obspar( y ):
+    """
+    Returns the observation parameters written by save_obspar() as a
+    dictionary with keys 'saturated', 'warnings', 'setup' and 'timing'.
+    """
+    ikeys = [ 'Instrument', 'Mode', 'Aperture', 'Disperser', 'Subarray', 'Readmode', 'Filter' ]
+    obspar = {}
+    obspar['saturated'] = ( y['warning']['Saturated?']!='All good' )
+    obspar['warnings'] = dict( [ ( k, str( v ) ) for k, v in y['warning'].items() ] )
+    obspar['setup'] = dict( [ ( k, str( y['input'][k] ) ) for k in ikeys ] )
+    obspar['timing'] = {}
+    for k, v in y['timing'].items():
+        if hasattr( v, 'tolist' ):
+            v = v.tolist() # numpy scalar
+        if isinstance( v, ( int, float ) )==False:
+            v = str( v )
+        obspar['timing'][k] = v
+    return obspar
 
 
 def save_obspar( opath, y ):
@@ -134,17 +303,13 @@ def save_obspar( opath, y ):
 
 def generate_nullspec():
     """
-    Generates a null spectrum and saves it in the working directory.
+    Writes the null spectrum to the shared spectra directory if it is not
+    there yet and returns its path (see config.get_nullpath()).
     """
-    n = int( 1e4 )
-    x = np.linspace( 0.2, 40, n )
-    y = np.zeros( n )
-    nullpath = get_nullpath()
-    np.savetxt( nullpath, np.column_stack( [ x, y ] ) )
-    return nullpath
+    return config.get_nullpath()
 
 def get_nullpath():
     """
-    Returns the path of the null spectrum.
+    Returns the path of the null spectrum, creating it if necessary.
     """
-    return os.path.join( os.getcwd(), 'zeros.txt' )
+    return config.get_nullpath()
@@ -0,0 +1,97 @@
+from __future__ import print_function
+import os, pdb, sys, time, json, hashlib
+
+"""
+Routines for keeping a sweep manifest, an append-only JSON-lines ledger
+with one line per finished task recording its status, input hash, output
+paths and runtime. When a sweep is rerun with the same manifest, tasks
+that already completed with identical inputs are skipped, while failed
+tasks and tasks whose inputs have changed are run again.
+"""
+
+
+def hash_inputs( *args ):
+    """
+    Returns a hash of the canonical JSON representation of the arguments,
+    which can be any combination of dictionaries, lists, strings and numbers.
+    """
+    s = json.dumps( args, sort_keys=True, default=canonical )
+    return hashlib.sha1( s.encode( 'utf-8' ) ).hexdigest()
+
+def canonical( obj ):
+    """
+    JSON serialiser for objects not handled by the json module, such as
+    numpy scalars and arrays.
+    """
+    if hasattr( obj, 'tolist' ):
+        return obj.tolist()
+    return repr( obj )
+
+
+def task_key( planet, inst_mode, filt ):
+    """
+    Returns the string identifying a task in the manifest.
+    """
+    return '{0}|{1}|{2}'.format( planet, inst_mode, filt )
+
+
+def load( fpath ):
+    """
+    Reads a manifest, returning a dictionary containing the most recent
+    record for each task key. Returns an empty dictionary if the manifest
+    does not exist yet. Incomplete final lines, e.g. from a sweep that was
+    killed mid-write, are ignored.
+    """
+    ledger = {}
+    if os.path.isfile( fpath )==False:
+        return ledger
+    with open( fpath, 'r' ) as f:
+        for line in f:
+            try:
+                record = json.loads( line )
+            except ValueError:
+                continue
+            ledger[record['key']] = record
+    return ledger
+
+
+def append( fpath, record ):
+    """
+    Appends a task record to the manifest, flushing it to disk immediately.
+    """
+    with open( fpath, 'a' ) as f:
+        f.write( json.dumps( record, default=canonical )+'\n' )
+        f.flush()
+        os.fsync( f.fileno() )
+    return None
+
+
+def is_done( ledger, key, inputhash ):
+    """
+    Returns True if the ledger shows the task completed with the same input
+    hash and all of its outputs (files or result store directories) still
+    exist.
+    """
+    if key not in ledger:
+        return False
+    record = ledger[key]
+    if ( record['status']!='done' )+( record['hash']!=inputhash ):
+        return False
+    for opath in record['outputs']:
+        if os.path.exists( opath )==False:
+            return False
+    return True
+
+
+def summarise( fpath ):
+    """
+    Prints the number of tasks in a manifest with each status.
+    """
+    ledger = load( fpath )
+    counts = {}
+    for record in ledger.values():
+        counts[record['status']] = counts.get( record['status'], 0 )+1
+    print( 'Manifest {0}: {1} tasks'.format( fpath, len( ledger ) ) )
+    for k in sorted( counts.keys() ):
+        print( '... {0}: {1}'.format( k, counts[k] ) )
+    return counts
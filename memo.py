@@ -0,0 +1,266 @@
+from __future__ import print_function
+import os, pdb, sys, time, pickle, hashlib, tempfile, copy
+try:
+    from . import manifest
+except ImportError:
+    import manifest
+
+"""
+Content-addressed cache of PandExo results. Each result is stored as a
+pickle file named by the hash of the full exoplanet and instrument input
+dictionaries, the contents of any planet spectrum file they refer to and
+the PandExo version, so an identical simulation is never run twice, whether
+within a sweep or across reruns on different days. The total size of the
+cache is bounded, with the least recently used results evicted first.
+"""
+
+MEMO_DIR = os.environ.get( 'PANDEXO_PREP_MEMO_DIR', \
+                           os.path.join( os.path.expanduser( '~' ), '.cache', 'pandexo_prep', 'results' ) )
+MAX_BYTES = 2*( 1024**3 ) # maximum total size of the cache
+
+# Cache hits and misses in the current process:
+STATS = { 'hits':0, 'misses':0, 'evictions':0 }
+
+# Distribution names of backend packages, where they differ from the package:
+DISTRIBUTIONS = { 'pandexo':'pandexo.engine' }
+
+# File hashes of planet spectra, keyed by [ path, mtime, size ]:
+FILE_HASHES = {}
+
+# Total size in bytes of each cache directory as last scanned, plus the
+# entries this process has written since, so that the directory is only
+# rescanned once the limit may have been reached:
+SIZES = {}
+
+
+def run_pandexo( jdi, exo, inst, memo_dir=None, max_bytes=MAX_BYTES ):
+    """
+    Returns jdi.run_pandexo( exo, inst, save_file=False ), loading the result
+    from the cache if the same inputs have been run before and saving it to
+    the cache otherwise.
+    """
+    if memo_dir is None:
+        memo_dir = MEMO_DIR
+    key = result_key( jdi, exo, inst )
+    y = read( key, memo_dir )
+    if y is not None:
+        STATS['hits'] += 1
+        return y
+    STATS['misses'] += 1
+    y = jdi.run_pandexo( copy.deepcopy( exo ), copy.deepcopy( inst ), save_file=False )
+    fpath = write( key, y, memo_dir )
+    if add_size( memo_dir, fpath )>max_bytes:
+        evict( memo_dir, max_bytes )
+    return y
+
+
+def result_key( jdi, exo, inst ):
+    """
+    Returns the cache key for a PandExo run.
+    """
+    exo, spechash = content_inputs( exo )
+    return manifest.hash_inputs( exo, inst, spechash, backend_version( jdi ) )
+
+
+def content_inputs( exo ):
+    """
+    Returns a copy of the exoplanet input dictionary without the path of its
+    planet spectrum file, and the hash of that file's contents (None if it
+    does not refer to a file), so that hashes of the inputs do not depend on
+    where the file is kept.
+    """
+    exopath = exo.get( 'planet', {} ).get( 'exopath' )
+    spechash = None
+    if ( exopath is not None ) and os.path.isfile( exopath ):
+        spechash = file_hash( exopath )
+        exo = copy.deepcopy( exo )
+        exo['planet']['exopath'] = None # only the contents matter
+    return exo, spechash
+
+
+def backend_version( jdi ):
+    """
+    Returns a string identifying the PandExo module and its version. PandExo
+    does not set __version__, so the version of the installed distribution
+    is used instead (see DISTRIBUTIONS).
+    """
+    name = jdi.__name__
+    version = getattr( jdi, '__version__', None )
+    if version is None:
+        pkg = name.split( '.' )[0]
+        version = package_version( DISTRIBUTIONS.get( pkg, pkg ) )
+    if version is None:
+        version = 'unknown'
+    return '{0}=={1}'.format( name, version )
+
+
+def package_version( dist ):
+    """
+    Returns the version of the installed distribution with the specified
+    name, or None if it is not installed.
+    """
+    try:
+        from importlib import metadata
+    except ImportError: # Python<3.8
+        metadata = None
+    if metadata is not None:
+        try:
+            return metadata.version( dist )
+        except metadata.PackageNotFoundError:
+            return None
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution( dist ).version
+    except Exception:
+        return None
+
+
+def file_hash( fpath ):
+    """
+    Returns the hash of a file's contents, remembering it for as long as the
+    file modification time and size are unchanged.
+    """
+    st = os.stat( fpath )
+    fkey = ( os.path.abspath( fpath ), st.st_mtime, st.st_size )
+    if fkey not in FILE_HASHES:
+        with open( fpath, 'rb' ) as f:
+            FILE_HASHES[fkey] = hashlib.sha1( f.read() ).hexdigest()
+    return FILE_HASHES[fkey]
+
+
+def get_path( key, memo_dir ):
+    """
+    Returns the path of the cache file for the specified key.
+    """
+    return os.path.join( memo_dir, key[:2], '{0}.pkl'.format( key ) )
+
+
+def read( key, memo_dir ):
+    """
+    Returns the cached result for the specified key or None if there is none.
+    The file modification time is updated to mark the entry as recently used.
+    """
+    fpath = get_path( key, memo_dir )
+    try:
+        with open( fpath, 'rb' ) as f:
+            y = pickle.load( f )
+        os.utime( fpath, None )
+    except ( IOError, OSError, EOFError, pickle.UnpicklingError ):
+        return None
+    return y
+
+
+def write( key, y, memo_dir ):
+    """
+    Saves a result to the cache via a temporary file that is renamed into
+    place, so concurrent workers never read a partially written entry.
+    """
+    fpath = get_path( key, memo_dir )
+    odir = os.path.dirname( fpath )
+    if os.path.isdir( odir )==False:
+        try:
+            os.makedirs( odir )
+        except OSError:
+            if os.path.isdir( odir )==False:
+                raise
+    fd, tmppath = tempfile.mkstemp( dir=odir, prefix='.tmp-' )
+    with os.fdopen( fd, 'wb' ) as f:
+        pickle.dump( y, f, protocol=pickle.HIGHEST_PROTOCOL )
+    os.replace( tmppath, fpath )
+    return fpath
+
+
+def list_entries( memo_dir ):
+    """
+    Returns a list of [ path, size_bytes, mtime ] for the cache entries,
+    ordered from least to most recently used.
+    """
+    entries = []
+    if os.path.isdir( memo_dir )==False:
+        return entries
+    for subdir in os.listdir( memo_dir ):
+        sdir = os.path.join( memo_dir, subdir )
+        if os.path.isdir( sdir )==False:
+            continue
+        for fname in os.listdir( sdir ):
+            if fname.endswith( '.pkl' )==False:
+                continue
+            fpath = os.path.join( sdir, fname )
+            try:
+                st = os.stat( fpath )
+            except OSError:
+                continue
+            entries += [ [ fpath, st.st_size, st.st_mtime ] ]
+    entries.sort( key=lambda e: e[2] )
+    return entries
+
+
+def add_size( memo_dir, fpath ):
+    """
+    Adds the size of a newly written entry to the running total for the
+    cache directory, scanning the directory instead the first time, and
+    returns the total. Entries written by other processes are only counted
+    at the next scan, so the cache can briefly exceed its limit by the
+    results of the other workers.
+    """
+    mkey = os.path.abspath( memo_dir )
+    if mkey in SIZES:
+        SIZES[mkey] += os.path.getsize( fpath )
+    else:
+        SIZES[mkey] = sum( [ e[1] for e in list_entries( memo_dir ) ] )
+    return SIZES[mkey]
+
+
+def evict( memo_dir, max_bytes=MAX_BYTES ):
+    """
+    Deletes the least recently used entries until the cache is no larger
+    than max_bytes. Returns the number of entries deleted.
+    """
+    entries = list_entries( memo_dir )
+    total = sum( [ e[1] for e in entries ] )
+    ndel = 0
+    for e in entries:
+        if total<=max_bytes:
+            break
+        try:
+            os.remove( e[0] )
+        except OSError:
+            pass
+        total -= e[1]
+        ndel += 1
+    SIZES[os.path.abspath( memo_dir )] = total
+    STATS['evictions'] += ndel
+    return ndel
+
+
+def info( memo_dir=None ):
+    """
+    Prints and returns the number of entries and total size of the cache,
+    along with the hit/miss statistics for the current process.
+    """
+    if memo_dir is None:
+        memo_dir = MEMO_DIR
+    entries = list_entries( memo_dir )
+    size = sum( [ e[1] for e in entries ] )
+    ncalls = STATS['hits']+STATS['misses']
+    print( 'PandExo result cache {0}: {1} entries, {2:.1f} MB'\
+           .format( memo_dir, len( entries ), size/1024.**2 ) )
+    if ncalls>0:
+        print( '... {0} hits, {1} misses ({2:.0f}% hit rate), {3} evictions'\
+               .format( STATS['hits'], STATS['misses'], 100.*STATS['hits']/ncalls, \
+                        STATS['evictions'] ) )
+    return { 'entries':len( entries ), 'bytes':size, 'hits':STATS['hits'], \
+             'misses':STATS['misses'], 'evictions':STATS['evictions'] }
+
+
+def clear( memo_dir=None ):
+    """
+    Deletes all entries from the cache.
+    """
+    if memo_dir is None:
+        memo_dir = MEMO_DIR
+    for e in list_entries( memo_dir ):
+        os.remove( e[0] )
+    SIZES.pop( os.path.abspath( memo_dir ), None )
+    print( 'Cleared PandExo result cache {0}'.format( memo_dir ) )
+    return None
@@ -0,0 +1,226 @@
+from __future__ import print_function
+import os, pdb, sys, time, json, contextlib
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+"""
+Timing and profiling instrumentation for the simulation pipeline. Stages
+of the pipeline (catalogue download, parse, merge and derive, PandExo input
+building, each run_pandexo call and each output write) are wrapped in
+stage() blocks, which measure the wall time, CPU time and peak resident
+memory of the process. When tracing is enabled, one JSON line per stage
+is appended to the trace file, which can then be summarised with:
+
+  python profiling.py <trace.jsonl>
+
+Tracing is enabled by setting the PANDEXO_PREP_TRACE environment variable
+to the trace file path, or by calling enable( trace_path ). The profile()
+hook additionally runs a block under cProfile or pyinstrument when the
+PANDEXO_PREP_PROFILE environment variable is set to 'cprofile' or
+'pyinstrument', saving one profile per block in PANDEXO_PREP_PROFILE_DIR
+(default 'profiles' in the working directory). Settings are held in
+environment variables so that batch worker processes inherit them.
+"""
+
+TRACE_ENV = 'PANDEXO_PREP_TRACE'
+PROFILE_ENV = 'PANDEXO_PREP_PROFILE'
+PROFILE_DIR_ENV = 'PANDEXO_PREP_PROFILE_DIR'
+ENV_KEYS = [ TRACE_ENV, PROFILE_ENV, PROFILE_DIR_ENV ]
+PROFILERS = [ 'cprofile', 'pyinstrument' ]
+
+
+def enable( trace_path=None, profiler=None, profile_dir=None ):
+    """
+    Turns on tracing to trace_path and, if profiler is 'cprofile' or
+    'pyinstrument', profiling of the profile() blocks, for this process and
+    any worker processes started afterwards. Returns the previous
+    settings, which can be passed to disable() to restore them.
+    """
+    if ( profiler is not None )*( profiler not in PROFILERS ):
+        raise ValueError( 'profiler must be one of {0}'.format( ', '.join( PROFILERS ) ) )
+    previous = dict( [ [ k, os.environ.get( k, None ) ] for k in ENV_KEYS ] )
+    if trace_path is not None:
+        os.environ[TRACE_ENV] = os.path.abspath( trace_path )
+    if profiler is not None:
+        os.environ[PROFILE_ENV] = profiler
+    if profile_dir is not None:
+        os.environ[PROFILE_DIR_ENV] = os.path.abspath( profile_dir )
+    return previous
+
+
+def disable( previous=None ):
+    """
+    Turns off tracing and profiling, or if previous is provided, restores
+    the settings returned by enable().
+    """
+    for k in ENV_KEYS:
+        if ( previous is not None ) and ( previous.get( k, None ) is not None ):
+            os.environ[k] = previous[k]
+        else:
+            os.environ.pop( k, None )
+    return None
+
+
+def get_maxrss():
+    """
+    Returns the peak resident memory of the current process in MB, or
+    None if it cannot be measured on this platform.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    if sys.platform=='darwin':
+        return maxrss/1024.**2 # bytes
+    return maxrss/1024. # kilobytes
+
+
+@contextlib.contextmanager
+def stage( name, **tags ):
+    """
+    Context manager timing a pipeline stage, e.g.
+
+      with profiling.stage( 'run_pandexo', mode='NIRSpec G395H' ) as rec:
+          ...
+
+    On exit, rec holds 'stage', 'wall' and 'cpu' (s), 'maxrss_mb' (peak
+    memory of the process so far), 'ok' (False if an exception was raised)
+    and the tags, and is appended to the trace file if tracing is enabled.
+    """
+    rec = { 'stage':name }
+    rec.update( tags )
+    t1 = time.time()
+    c1 = time.process_time()
+    rec['ok'] = False
+    try:
+        yield rec
+        rec['ok'] = True
+    finally:
+        rec['wall'] = time.time()-t1
+        rec['cpu'] = time.process_time()-c1
+        rec['maxrss_mb'] = get_maxrss()
+        rec['time'] = t1
+        rec['pid'] = os.getpid()
+        trace_path = os.environ.get( TRACE_ENV, None )
+        if trace_path is not None:
+            write( trace_path, rec )
+
+
+def write( trace_path, rec ):
+    """
+    Appends a record to a trace file. Records are written with a single
+    write call, so lines from different processes are not interleaved.
+    """
+    line = json.dumps( rec, default=str )+'\n'
+    with open( trace_path, 'a' ) as f:
+        f.write( line )
+    return None
+
+
+@contextlib.contextmanager
+def profile( label ):
+    """
+    Context manager running a block under the profiler selected by the
+    PANDEXO_PREP_PROFILE environment variable, if any, and saving the
+    result as <label>.prof (cProfile, readable with pstats or snakeviz)
+    or <label>.html (pyinstrument) in the profile directory.
+    """
+    profiler = os.environ.get( PROFILE_ENV, None )
+    if profiler is None:
+        yield None
+        return
+    if profiler not in PROFILERS:
+        raise ValueError( 'PANDEXO_PREP_PROFILE must be one of {0}'.format( ', '.join( PROFILERS ) ) )
+    pdir = os.environ.get( PROFILE_DIR_ENV, os.path.join( os.getcwd(), 'profiles' ) )
+    if os.path.isdir( pdir )==False:
+        try:
+            os.makedirs( pdir )
+        except OSError:
+            # Created by another process in the meantime:
+            if os.path.isdir( pdir )==False:
+                raise
+    fname = ''.join( [ c if ( c.isalnum() or c in '-_.' ) else '_' for c in label ] )
+    if profiler=='cprofile':
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield prof
+        finally:
+            prof.disable()
+            prof.dump_stats( os.path.join( pdir, '{0}.prof'.format( fname ) ) )
+    else:
+        import pyinstrument
+        prof = pyinstrument.Profiler()
+        prof.start()
+        try:
+            yield prof
+        finally:
+            prof.stop()
+            with open( os.path.join( pdir, '{0}.html'.format( fname ) ), 'w' ) as f:
+                f.write( prof.output_html() )
+
+
+def read( trace_path ):
+    """
+    Returns the list of records in a trace file, ignoring incomplete lines.
+    """
+    records = []
+    with open( trace_path, 'r' ) as f:
+        for line in f:
+            try:
+                records += [ json.loads( line ) ]
+            except ValueError:
+                continue
+    return records
+
+
+def summarise( trace_path ):
+    """
+    Prints the total wall and CPU time spent in each stage and, for the
+    run_pandexo and task stages, in each instrument mode, sorted so that
+    the modes dominating the wall time come first. Returns a dictionary
+    with keys 'stages' and 'modes', each mapping a label to a dictionary
+    with keys 'n', 'wall', 'cpu' and 'maxrss_mb' (the largest peak seen).
+    """
+    records = read( trace_path )
+    stages = {}
+    modes = {}
+    for rec in records:
+        groups = [ [ stages, rec['stage'] ] ]
+        if ( rec['stage'] in [ 'run_pandexo', 'task' ] )*( 'mode' in rec ):
+            label = rec['mode']
+            if rec.get( 'filter', None ) is not None:
+                label = '{0} ({1})'.format( label, rec['filter'] )
+            groups += [ [ modes, '{0}: {1}'.format( rec['stage'], label ) ] ]
+        for group, label in groups:
+            if label not in group:
+                group[label] = { 'n':0, 'wall':0., 'cpu':0., 'maxrss_mb':0. }
+            group[label]['n'] += 1
+            group[label]['wall'] += rec['wall']
+            group[label]['cpu'] += rec['cpu']
+            if rec['maxrss_mb'] is not None:
+                group[label]['maxrss_mb'] = max( [ group[label]['maxrss_mb'], rec['maxrss_mb'] ] )
+
+    print( '\n{0}\nTrace summary: {1} ({2} records)\n{0}'.format( 50*'#', trace_path, len( records ) ) )
+    for title, group in [ [ 'Stage', stages ], [ 'Mode', modes ] ]:
+        if len( group )==0:
+            continue
+        total = sum( [ v['wall'] for v in group.values() ] )
+        print( '\n{0:40s} {1:>6s} {2:>10s} {3:>10s} {4:>7s} {5:>10s}'\
+               .format( title, 'N', 'Wall (s)', 'CPU (s)', 'Wall %', 'Peak (MB)' ) )
+        for label in sorted( group.keys(), key=lambda k: -group[k]['wall'] ):
+            v = group[label]
+            print( '{0:40s} {1:6d} {2:10.2f} {3:10.2f} {4:7.1f} {5:10.1f}'\
+                   .format( label[:40], v['n'], v['wall'], v['cpu'], \
+                            100.*v['wall']/max( [ total, 1e-12 ] ), v['maxrss_mb'] ) )
+    print( '{0}\n'.format( 50*'#' ) )
+    return { 'stages':stages, 'modes':modes }
+
+
+if __name__=='__main__':
+    if len( sys.argv )<2:
+        print( 'Usage: python profiling.py <trace.jsonl>' )
+    else:
+        summarise( sys.argv[1] )
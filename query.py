@@ -0,0 +1,335 @@
+from __future__ import print_function
+import os, pdb, sys, glob, json, tempfile
+import numpy as np
+try:
+    from . import store as store_module
+except ImportError:
+    import store as store_module
+
+"""
+Query layer for picking targets from the results of a sweep. A summary
+index with one row per simulated spectrum is built once from a result
+store (see store.py) or from the <planet>/<label>.txt files written by
+jwstsim, and saved next to the results:
+
+  summary.npy  --> structured array, memory-mapped when loaded
+  summary.json --> wavelength band edges and source details
+
+Each row gives the planet, label, instrument mode and filter, saturation
+flag, wavelength range, median noise (ppm) over the whole spectrum and in
+each wavelength band, and the main timing values from PandExo. Filtering,
+sorting and top-k selection then work on whole columns without reopening
+any spectra, e.g. the 20 unsaturated planets with the lowest G395H noise
+at 4 micron, provided it is below 50 ppm:
+
+  ix = query.load( 'store' )
+  ix = ix.where( mode='NIRSpec G395H', saturated=False, max_error=50, at_um=4.0 )
+  best = ix.top( 20, ix.error_at( 4.0 ) )
+
+The instrument mode is taken from the spectrum label, as PandExo's own
+'Mode' setting is the observing mode (e.g. 'bots' for NIRSpec).
+"""
+
+SUMMARY_NAME = 'summary'
+SUMMARY_VERSION = 2 # increment if the index contents change
+BAND_EDGES = np.arange( 0.5, 12.01, 0.5 ) # wavelength band edges in micron
+
+# Timing columns as [ column name, key in the PandExo timing dictionary ]:
+TIMING_KEYS = [ [ 'tdur_hrs', 'Transit Duration' ], \
+                [ 'obs_hrs', 'Transit+Baseline, no overhead (hrs)' ], \
+                [ 'efficiency', 'Observing Efficiency (%)' ], \
+                [ 'ngroups', 'APT: Num Groups per Integration' ], \
+                [ 'nints_transit', 'Num Integrations In Transit' ] ]
+
+
+def load( source, band_edges=BAND_EDGES, rebuild=False ):
+    """
+    Returns the ResultIndex for a result store directory or jwstsim output
+    directory, building and saving the summary index first if it does not
+    exist, is older than the results, is from an older version of this
+    module or used different band edges.
+    """
+    fpath = os.path.join( source, '{0}.npy'.format( SUMMARY_NAME ) )
+    mpath = os.path.join( source, '{0}.json'.format( SUMMARY_NAME ) )
+    if ( rebuild==False )*os.path.isfile( fpath )*os.path.isfile( mpath ):
+        with open( mpath, 'r' ) as f:
+            meta = json.load( f )
+        current = ( os.path.getmtime( mpath )>=get_mtime( source ) )
+        current *= ( meta.get( 'version', 1 )==SUMMARY_VERSION )
+        if current*np.array_equal( meta['band_edges'], np.asarray( band_edges, dtype=float ) ):
+            return ResultIndex( np.load( fpath, mmap_mode='r' ), meta['band_edges'] )
+    data = build( source, band_edges=band_edges )
+    save( source, data, band_edges )
+    return ResultIndex( np.load( fpath, mmap_mode='r' ), band_edges )
+
+
+def get_mtime( source ):
+    """
+    Returns the latest modification time of the results in a source
+    directory: the store index, or the newest text output.
+    """
+    ipath = os.path.join( source, 'index.jsonl' )
+    if os.path.isfile( ipath ):
+        return os.path.getmtime( ipath )
+    fpaths = glob.glob( os.path.join( source, '*', '*.txt' ) )
+    if len( fpaths )==0:
+        return 0
+    return max( [ os.path.getmtime( f ) for f in fpaths ] )
+
+
+def get_dtype( nbands ):
+    """
+    Returns the dtype of the summary index.
+    """
+    fields = [ ( 'planet', 'U32' ), ( 'label', 'U64' ), ( 'mode', 'U32' ), ( 'filter', 'U16' ), \
+               ( 'saturated', bool ), ( 'wmin', 'f8' ), ( 'wmax', 'f8' ), ( 'npts', 'i8' ), \
+               ( 'median_error', 'f8' ), ( 'band_error', 'f8', ( nbands, ) ) ]
+    fields += [ ( k[0], 'f8' ) for k in TIMING_KEYS ]
+    return np.dtype( fields )
+
+
+def build( source, band_edges=BAND_EDGES ):
+    """
+    Returns the summary index of a result store directory or jwstsim
+    output directory as a structured array with one row per spectrum.
+    """
+    band_edges = np.asarray( band_edges, dtype=float )
+    spectra = list( iter_spectra( source ) )
+    data = np.zeros( len( spectra ), dtype=get_dtype( len( band_edges )-1 ) )
+    for i, spectrum in enumerate( spectra ):
+        planet, label, wav, err, obspar = spectrum
+        row = data[i:i+1]
+        row['planet'] = planet
+        row['label'] = label
+        row['mode'] = get_mode( label )
+        row['filter'] = obspar.get( 'setup', {} ).get( 'Filter', '' )
+        row['saturated'] = obspar.get( 'saturated', False )
+        row['npts'] = len( wav )
+        row['wmin'] = np.min( wav ) if len( wav )>0 else np.nan
+        row['wmax'] = np.max( wav ) if len( wav )>0 else np.nan
+        row['median_error'] = np.median( err ) if len( wav )>0 else np.nan
+        row['band_error'] = band_medians( wav, err, band_edges )
+        timing = obspar.get( 'timing', {} )
+        for k in TIMING_KEYS:
+            try:
+                row[k[0]] = float( timing[k[1]] )
+            except ( KeyError, TypeError, ValueError ):
+                row[k[0]] = np.nan
+    print( 'Built summary index of {0} spectra from {1}'.format( len( data ), source ) )
+    return data
+
+
+def get_mode( label ):
+    """
+    Returns the instrument mode of a spectrum from its label, which starts
+    with the mode name with the space replaced by '-' (see
+    jwstsim.get_onames()), e.g. 'NIRSpec G395H' for 'NIRSpec-G395H-R100'.
+    """
+    return ' '.join( label.split( '-' )[:2] )
+
+
+def iter_spectra( source ):
+    """
+    Yields [ planet, label, wave, error, obspar ] for every spectrum in a
+    result store directory or jwstsim output directory. Binned text outputs
+    (e.g. NIRSpec-G395H-R100.txt) share the observation parameters of the
+    native spectrum.
+    """
+    if os.path.isfile( os.path.join( source, 'index.jsonl' ) ):
+        store = store_module.ResultStore( source )
+        for planet, label in store.keys():
+            wav, err, obspar = store.get( planet, label )
+            yield [ planet, label, wav, err, obspar ]
+        return
+    for planet_dir in sorted( glob.glob( os.path.join( source, '*', '' ) ) ):
+        planet = os.path.basename( os.path.normpath( planet_dir ) )
+        obspars = {}
+        for opath in glob.glob( os.path.join( planet_dir, '*.obspar.txt' ) ):
+            obspars[os.path.basename( opath )[:-len( '.obspar.txt' )]] = store_module.parse_obspar( opath )
+        for ipath in sorted( glob.glob( os.path.join( planet_dir, '*.txt' ) ) ):
+            if ipath.endswith( '.obspar.txt' ):
+                continue
+            label = os.path.basename( ipath )[:-len( '.txt' )]
+            stems = [ s for s in obspars.keys() if label.startswith( s ) ]
+            obspar = {}
+            if len( stems )>0:
+                obspar = obspars[max( stems, key=len )]
+            outp = np.loadtxt( ipath, ndmin=2 )
+            yield [ planet, label, outp[:,0], outp[:,1], obspar ]
+
+
+def band_medians( wave, err, band_edges ):
+    """
+    Returns the median of the errors in each wavelength band, NaN where a
+    band contains no points, with all bands evaluated together.
+    """
+    nbands = len( band_edges )-1
+    outp = np.full( nbands, np.nan )
+    band = np.searchsorted( band_edges, wave, side='right' )-1
+    keep = ( band>=0 )*( band<nbands )
+    band = band[keep]
+    err = np.asarray( err, dtype=float )[keep]
+    if len( err )==0:
+        return outp
+    order = np.lexsort( ( err, band ) )
+    err = err[order]
+    counts = np.bincount( band, minlength=nbands )
+    starts = np.concatenate( [ [ 0 ], np.cumsum( counts )[:-1] ] )
+    ok = ( counts>0 )
+    lo = starts[ok]+( counts[ok]-1 )//2
+    hi = starts[ok]+counts[ok]//2
+    outp[ok] = 0.5*( err[lo]+err[hi] )
+    return outp
+
+
+def save( source, data, band_edges=BAND_EDGES ):
+    """
+    Saves a summary index to the source directory, writing each file to a
+    temporary file first and renaming it into place.
+    """
+    fpath = os.path.join( source, '{0}.npy'.format( SUMMARY_NAME ) )
+    mpath = os.path.join( source, '{0}.json'.format( SUMMARY_NAME ) )
+    fd, tmppath = tempfile.mkstemp( dir=source, prefix='.tmp-', suffix='.npy' )
+    with os.fdopen( fd, 'wb' ) as f:
+        np.save( f, data )
+    os.replace( tmppath, fpath )
+    meta = { 'band_edges':np.asarray( band_edges, dtype=float ).tolist(), 'nrows':len( data ), \
+             'timing_keys':TIMING_KEYS, 'version':SUMMARY_VERSION }
+    fd, tmppath = tempfile.mkstemp( dir=source, prefix='.tmp-', suffix='.json' )
+    with os.fdopen( fd, 'w' ) as f:
+        json.dump( meta, f )
+    os.replace( tmppath, mpath )
+    return fpath
+
+
+class ResultIndex( object ):
+    """
+    Summary index of a sweep, stored as one structured array. As for
+    catalogue.Catalogue, indexing with a field name returns that column,
+    indexing with an integer returns the row as a dictionary, and indexing
+    with a boolean mask, slice or integer array returns a new ResultIndex
+    with the selected rows.
+    """
+
+    def __init__( self, data, band_edges=BAND_EDGES ):
+        self.data = data
+        self.band_edges = np.asarray( band_edges, dtype=float )
+
+    def __len__( self ):
+        return len( self.data )
+
+    def __getitem__( self, key ):
+        if isinstance( key, str ):
+            return self.data[key]
+        if isinstance( key, ( int, np.integer ) ):
+            return self.row( key )
+        return ResultIndex( self.data[key], self.band_edges )
+
+    def keys( self ):
+        """
+        Returns the list of column names.
+        """
+        return list( self.data.dtype.names )
+
+    def row( self, i ):
+        """
+        Returns row i as a dictionary of Python values.
+        """
+        return dict( zip( self.keys(), self.data[i].tolist() ) )
+
+    def rows( self ):
+        """
+        Returns all rows as a list of dictionaries.
+        """
+        return [ self.row( i ) for i in range( len( self.data ) ) ]
+
+    def band( self, wave_um ):
+        """
+        Returns the index of the wavelength band containing wave_um, raising
+        a ValueError if it is outside all bands.
+        """
+        i = np.searchsorted( self.band_edges, wave_um, side='right' )-1
+        if ( i<0 )+( i>=len( self.band_edges )-1 ):
+            raise ValueError( '{0} micron is outside the index bands'.format( wave_um ) )
+        return i
+
+    def error_at( self, wave_um ):
+        """
+        Returns the median noise (ppm) of each row in the band containing
+        wave_um, which is NaN for spectra that do not cover that band.
+        """
+        return self.data['band_error'][:,self.band( wave_um )]
+
+    def filter( self, mask ):
+        """
+        Returns a new ResultIndex containing the rows where mask is True.
+        """
+        return ResultIndex( self.data[np.asarray( mask, dtype=bool )], self.band_edges )
+
+    def where( self, planet=None, mode=None, label=None, saturated=None, max_error=None, at_um=None ):
+        """
+        Returns the rows matching all of the specified criteria. planet,
+        mode and label can each be a string or list of strings. If max_error
+        is given, only rows with median noise below it are kept, either over
+        the whole spectrum or, if at_um is given, in the band containing that
+        wavelength.
+        """
+        mask = np.ones( len( self.data ), dtype=bool )
+        for k, v in [ [ 'planet', planet ], [ 'mode', mode ], [ 'label', label ] ]:
+            if v is not None:
+                if isinstance( v, str ):
+                    v = [ v ]
+                mask *= np.isin( self.data[k], v )
+        if saturated is not None:
+            mask *= ( self.data['saturated']==saturated )
+        if max_error is not None:
+            if at_um is None:
+                err = self.data['median_error']
+            else:
+                err = self.error_at( at_um )
+            mask *= ( err<max_error ) # NaN never passes
+        return self.filter( mask )
+
+    def sort( self, key, descending=False ):
+        """
+        Returns a new ResultIndex sorted by the specified column, or by an
+        array of values with one per row, with NaNs last.
+        """
+        values = self.data[key] if isinstance( key, str ) else np.asarray( key )
+        if descending==True:
+            values = -values
+        ixs = np.argsort( values, kind='stable' )
+        return ResultIndex( self.data[ixs], self.band_edges )
+
+    def top( self, k, key, descending=False, unique='planet' ):
+        """
+        Returns the k rows with the lowest values of the specified column or
+        array (highest if descending is True), in order, ignoring NaNs. By
+        default only the best row of each planet is kept, so that the
+        native and binned spectra or several modes of one planet do not
+        fill the list; unique can be another column name, or None to rank
+        all rows.
+        """
+        values = self.data[key] if isinstance( key, str ) else np.asarray( key )
+        values = np.where( np.isnan( values ), np.inf, -values if descending==True else values )
+        ok = np.flatnonzero( np.isfinite( values ) )
+        k = min( [ k, len( ok ) ] )
+        if k<=0:
+            return ResultIndex( self.data[:0], self.band_edges )
+        if unique is None:
+            ixs = np.argpartition( values, k-1 )[:k]
+            ixs = ixs[np.argsort( values[ixs], kind='stable' )]
+        else:
+            ixs = ok[np.argsort( values[ok], kind='stable' )]
+            first = np.unique( self.data[unique][ixs], return_index=True )[1]
+            ixs = ixs[np.sort( first )][:k]
+        return ResultIndex( self.data[ixs], self.band_edges )
+
+    def show( self, columns=[ 'planet', 'label', 'saturated', 'median_error' ] ):
+        """
+        Prints the specified columns of each row.
+        """
+        print( '  '.join( columns ) )
+        for i in range( len( self.data ) ):
+            print( '  '.join( [ str( self.data[c][i] ) for c in columns ] ) )
+        return None
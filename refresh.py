@@ -0,0 +1,212 @@
+from __future__ import print_function
+import os, pdb, sys, time, tempfile
+import numpy as np
+try:
+    from . import config, jwstsim, batch
+except ImportError:
+    import config, jwstsim, batch
+
+"""
+Routines for refreshing a sweep after the TEPCat tables are updated. The
+new merged catalogue is compared row by row with a snapshot saved after
+the previous refresh, reporting the planets that were added, removed or
+changed (and which fields changed), and PandExo is only run for the
+( planet, mode ) pairs whose inputs are affected, i.e. new planets and
+planets where one of config.EXO_FIELDS changed. For example:
+
+  z = tepcat.load( download_latest=True )
+  report, records = refresh.refresh( z, inst_modes='all', manifest_path='sweep_manifest.jsonl' )
+"""
+
+SNAPSHOT_PATH = 'tepcat_snapshot.npz'
+RTOL = 1e-9 # relative difference below which values are treated as unchanged
+
+
+def refresh( tepcat, inst_modes='all', snapshot_path=SNAPSHOT_PATH, fields=config.EXO_FIELDS, \
+             quiet=False, **kwargs ):
+    """
+    Compares the catalogue with the snapshot at snapshot_path, runs
+    batch.run() for the planets affected by the changes in the specified
+    fields, with any other keyword arguments passed to batch.run(), and
+    saves the catalogue as the new snapshot once the run has finished. If
+    there is no snapshot yet, every planet counts as added. Planets with any
+    task that did not succeed, or that was not run at all because it belongs
+    to another shard (shard=[ k, nshards ], see shard.py), keep their old
+    snapshot rows (see advance_snapshot()), so they are rerun by the next
+    refresh; with a manifest_path the tasks already done are then skipped.
+
+    Returns the diff() report and the batch records.
+    """
+    old = load_snapshot( snapshot_path )
+    report = diff( old, tepcat )
+    if quiet==False:
+        print_report( report, fields=fields )
+    planets = affected_planets( report, fields=fields )
+    records = []
+    if len( planets )>0:
+        records = batch.run( planets, tepcat, inst_modes=inst_modes, **kwargs )
+    else:
+        print( 'No PandExo inputs changed - nothing to run' )
+    pending = pending_planets( affected_tasks( report, inst_modes=inst_modes, fields=fields ), records )
+    if len( pending )>0:
+        print( '{0} planets with unfinished tasks stay pending for the next refresh: {1}'\
+               .format( len( pending ), ', '.join( pending ) ) )
+    save_snapshot( advance_snapshot( old, tepcat, pending ), snapshot_path )
+    return report, records
+
+
+def diff( old, new, fields=None, rtol=RTOL ):
+    """
+    Compares two catalogue dictionaries row by row, matching planets by
+    name. Returns a dictionary with keys:
+
+      'added'   --> names of planets only in the new catalogue
+      'removed' --> names of planets only in the old catalogue
+      'changed' --> dictionary keyed by planet name of the changed fields,
+                    each as { field:[ old value, new value ] }
+
+    Fields are compared for all keys present in both catalogues unless
+    fields is provided. Numbers within a relative difference rtol of each
+    other are treated as equal, as are two NaNs. old can be None, in which
+    case every planet is added.
+    """
+    newnames = np.asarray( new['names'] ).astype( str )
+    if old is None:
+        return { 'added':newnames.tolist(), 'removed':[], 'changed':{} }
+    oldnames = np.asarray( old['names'] ).astype( str )
+    common, iold, inew = np.intersect1d( oldnames, newnames, assume_unique=False, return_indices=True )
+    report = { 'added':np.setdiff1d( newnames, oldnames ).tolist(), \
+               'removed':np.setdiff1d( oldnames, newnames ).tolist(), \
+               'changed':{} }
+    if fields is None:
+        fields = [ k for k in new.keys() if ( k in old )*( k!='names' ) ]
+    for k in fields:
+        a = np.asarray( old[k] )[iold]
+        b = np.asarray( new[k] )[inew]
+        if ( a.dtype.kind in 'fiu' )*( b.dtype.kind in 'fiu' ):
+            same = np.isclose( a.astype( float ), b.astype( float ), rtol=rtol, atol=0, equal_nan=True )
+        else:
+            same = ( a==b )
+        for i in np.flatnonzero( same==False ):
+            values = [ a[i].tolist(), b[i].tolist() ]
+            report['changed'].setdefault( str( common[i] ), {} )[k] = values
+    return report
+
+
+def affected_planets( report, fields=config.EXO_FIELDS ):
+    """
+    Returns the planets in a diff() report whose PandExo results need to be
+    recomputed: those added and those with a change in any of the fields.
+    """
+    planets = list( report['added'] )
+    for planet in sorted( report['changed'].keys() ):
+        if len( set( report['changed'][planet].keys() ).intersection( fields ) )>0:
+            planets += [ planet ]
+    return planets
+
+
+def affected_tasks( report, inst_modes='all', fields=config.EXO_FIELDS ):
+    """
+    Returns the [ planet, inst_mode, filter ] tasks to rerun for a diff()
+    report (see affected_planets()).
+    """
+    planets = affected_planets( report, fields=fields )
+    return batch.list_tasks( planets, jwstsim.get_inst_modes( inst_modes ) )
+
+
+def failed_planets( records ):
+    """
+    Returns the sorted names of the planets in a list of batch records with
+    any task that was not 'done' or 'cached'.
+    """
+    failed = set( [ r['planet'] for r in records if r['status'] not in [ 'done', 'cached' ] ] )
+    return sorted( failed )
+
+
+def pending_planets( tasks, records ):
+    """
+    Returns the sorted names of the planets with any of the specified
+    [ planet, inst_mode, filter ] tasks that is not 'done' or 'cached' in a
+    list of batch records, including tasks with no record at all, e.g.
+    because they were left to another shard.
+    """
+    finished = set( [ ( r['planet'], r['mode'], r['filter'] ) for r in records \
+                      if r['status'] in [ 'done', 'cached' ] ] )
+    pending = set( [ t[0] for t in tasks if ( t[0], t[1], t[2] ) not in finished ] )
+    return sorted( pending )
+
+
+def advance_snapshot( old, new, pending ):
+    """
+    Returns the catalogue to save as the next snapshot: the new catalogue,
+    except that planets in pending keep their rows from the old snapshot,
+    or are left out if they were added, so that diff() reports them again.
+    """
+    if len( pending )==0:
+        return new
+    newnames = np.asarray( new['names'] ).astype( str )
+    keep = ( np.isin( newnames, list( pending ) )==False )
+    iold = []
+    inew = []
+    if old is not None:
+        oldnames = np.asarray( old['names'] ).astype( str )
+        index = dict( zip( oldnames.tolist(), range( len( oldnames ) ) ) )
+        for i in np.flatnonzero( keep==False ):
+            if newnames[i] in index:
+                iold += [ index[newnames[i]] ]
+                inew += [ i ]
+    snapshot = {}
+    for k in new.keys():
+        values = np.asarray( new[k] )
+        if ( old is not None ) and ( k in old ):
+            restored = np.asarray( old[k] )[np.array( iold, dtype=int )]
+        else:
+            restored = values[np.array( inew, dtype=int )] # field not in the old snapshot
+        snapshot[k] = np.concatenate( [ values[keep], restored ] )
+    return snapshot
+
+
+def print_report( report, fields=config.EXO_FIELDS ):
+    """
+    Prints a summary of a diff() report, listing the changes of each
+    planet. Changes to the specified fields are marked with '*'.
+    """
+    print( '\n{0}\nCatalogue changes: {1} added, {2} removed, {3} changed\n{0}'\
+           .format( 50*'#', len( report['added'] ), len( report['removed'] ), \
+                    len( report['changed'] ) ) )
+    for planet in report['added']:
+        print( '+ {0}'.format( planet ) )
+    for planet in report['removed']:
+        print( '- {0}'.format( planet ) )
+    for planet in sorted( report['changed'].keys() ):
+        changes = []
+        for k, v in sorted( report['changed'][planet].items() ):
+            mark = '*' if k in fields else ''
+            changes += [ '{0}{1} {2} --> {3}'.format( mark, k, v[0], v[1] ) ]
+        print( '~ {0}: {1}'.format( planet, ', '.join( changes ) ) )
+    print( '{0}\n'.format( 50*'#' ) )
+    return None
+
+
+def save_snapshot( tepcat, fpath=SNAPSHOT_PATH ):
+    """
+    Saves a catalogue dictionary as the snapshot for the next refresh. The
+    file is written to a temporary file and renamed into place.
+    """
+    odir = os.path.dirname( os.path.abspath( fpath ) )
+    fd, tmppath = tempfile.mkstemp( dir=odir, prefix='.tmp-', suffix='.npz' )
+    with os.fdopen( fd, 'wb' ) as f:
+        np.savez( f, **dict( [ ( k, np.asarray( tepcat[k] ) ) for k in tepcat.keys() ] ) )
+    os.replace( tmppath, fpath )
+    return fpath
+
+
+def load_snapshot( fpath=SNAPSHOT_PATH ):
+    """
+    Returns the catalogue dictionary saved by save_snapshot(), or None if
+    there is no snapshot.
+    """
+    if os.path.isfile( fpath )==False:
+        return None
+    with np.load( fpath ) as f:
+        return dict( [ ( k, f[k] ) for k in f.files ] )
@@ -1,5 +1,5 @@
 import pdb
-from obsplanning.pandexo_prep_dev import tepcat, hstsim
+from obsplanning.pandexo_prep_dev import tepcat, hstsim, hstgrid
 #import tepcat, jwstsim
 
 """
@@ -24,7 +24,10 @@ z = tepcat.load( download_latest=False ) # load the TEPCat catalogues
 #    or set to 'all' to run calculations for all instrument modes.
 inst_modes = 'all'
 
-# 2. Define a dictionary containing the properties of the star and planet:
+# 2. Define a dictionary containing the properties of the star and planet,
+#    or set 'planets' to a list of TEPCat names (e.g. [ 'WASP-121' ]) to build
+#    the planet dictionaries from the catalogue instead:
+planets = None
 
 planetdict = { 'name':'HD209458b', 'star':{}, 'planet':{} }
 
@@ -54,9 +57,26 @@ scan = 'Round Trip' # 'Round Trip' or 'Forward'
 nchan = 14
 useFirstOrbit = False
 
+# Optionally explore a grid of setups instead, running each distinct
+# configuration once in parallel and saving a table of the per-channel
+# uncertainty, number of orbits and duty cycle (set to False to do a
+# single run with the settings above):
+grid = False
+
 ##########################
-# Can only do one planet at a time currently because for HST calculations
-# PandExo requires various planet properties not provided by TEPCat; one
-# possibly solution is to switch from TEPCat to NASA Exoplanet Archive:
-hstsim.main( planetdict, scan=scan, nchan=nchan, inst_modes=inst_modes, useFirstOrbit=useFirstOrbit )
+# Below here is automatic. Planets built from TEPCat use an inclination
+# derived from the transit duration and depth; planets that cannot be
+# completed from the catalogue are listed and skipped:
+if planets is None:
+    planetdicts = [ planetdict ]
+else:
+    planetdicts, flagged = hstsim.build_planetdicts( z, planets=planets )
+    planetdicts = list( planetdicts.values() )
+if grid==True:
+    table = hstgrid.run_grid( planetdicts, scans=hstgrid.SCANS, subarrays=hstgrid.SUBARRAYS, \
+                              nchans=[ 7, 14, 28 ], useFirstOrbit=[ False, True ], outdir='.', \
+                              table_path='hst_grid.txt' )
+else:
+    for p in planetdicts:
+        hstsim.main( p, scan=scan, nchan=nchan, inst_modes=inst_modes, useFirstOrbit=useFirstOrbit )
 
@@ -1,6 +1,7 @@
-import pdb
-#from pandexo_prep_dev.jwst import tepcat, jwstsim
-import tepcat, jwstsim
+import os, pdb
+#from pandexo_prep_dev.jwst import tepcat, jwstsim, batch, screen, schedule, shard as shard_module
+import tepcat, jwstsim, batch, screen, schedule
+import shard as shard_module
 
 """
 Copy this script to your working directory. Edit the import
@@ -11,12 +12,16 @@ catalogues and put them in the working directory:
   'For planning observations' --> save as 'tepcat1.txt'
   'Well-studied transiting planets' --> save as 'tepcat2.txt'
 
-Then there are two steps to edit below:
+Then there are five steps to edit below:
   1. Specify instrument modes by setting 'inst_modes' variable.
   2. Specify planets by setting 'planets' variable.
+  3. Specify the number of parallel workers by setting 'nworkers' variable.
+  4. Specify the sweep manifest by setting 'manifest_path' variable.
+  5. Optionally run one shard of a sweep split across several machines
+     by setting 'shard' variable.
 """
 
-z = tepcat.load( download_latest=True ) # load the TEPCat catalogues
+z = tepcat.load( download_latest=True, cache=True ) # load the TEPCat catalogues, cached in .tepcat_cache
 
 # 1. Specify a list of strings containing the JWST instrument
 #    modes that are recognised by PandExo, 
@@ -29,10 +34,56 @@ inst_modes = 'all'
 #    e.g. [ 'WASP-121', 'WASP-109' ]
 planets = z['names'] # this will do all TEPCat planets
 
+#    Optionally pre-screen the planets with the analytic S/N proxies,
+#    keeping only the top screen_top_n before running PandExo (set to
+#    None to skip screening):
+screen_top_n = None
+if screen_top_n is not None:
+    planets = screen.select_planets( z, inst_modes=inst_modes, top_n=screen_top_n )
+
+# 3. Number of worker processes to run in parallel (None to use all
+#    CPUs) and the maximum time allowed per PandExo run in seconds:
+nworkers = None
+timeout = None
+memo = False # set True to reuse PandExo results for identical inputs
+store_dir = None # set to a directory to save all outputs in one result store
+trace_path = None # set to a file to record the time spent in each stage (see profiling.py)
+resolutions = None # e.g. [ None, 100 ] to save native and R=100 spectra (see binning.py)
+order = None # 'cost' to run the longest tasks first, 'priority' to also finish high sn_tr planets first (see schedule.py)
+
+# 4. Sweep manifest recording finished tasks; rerunning the script with
+#    the same manifest only runs tasks that failed or whose inputs changed
+#    (set to None to always rerun everything):
+manifest_path = 'sweep_manifest.jsonl'
+
+# 5. To split the sweep across N machines, set shard = [ k, N ] on the
+#    k-th machine (k = 0, ..., N-1); each machine needs the same planets,
+#    modes and cost_manifests. Each shard writes its outputs, manifest and
+#    result store under its own shard-<k>-of-<N> directory, which can be
+#    combined afterwards with:
+#      python shard.py merge <outdir> shard-*
+#    Optionally balance the shards using the runtimes recorded in earlier
+#    manifests, e.g. cost_manifests = [ 'sweep_manifest.jsonl' ], which
+#    are also used to order the tasks if 'order' is set:
+shard = None
+cost_manifests = None
+
 ##########################
 # Below here is automatic:
-nplanets = len( planets )
-for i in range( nplanets ):
-    print( '\nPlanet {0} of {1}'.format( i+1, nplanets ) )
-    jwstsim.main( planets[i], z, inst_modes=inst_modes )
+outdir = '.'
+costs = None
+if shard is not None:
+    outdir = shard_module.get_shard_dir( shard[0], shard[1] )
+    if os.path.isdir( outdir )==False:
+        os.makedirs( outdir )
+    if manifest_path is not None:
+        manifest_path = os.path.join( outdir, shard_module.MANIFEST_NAME )
+    if store_dir is not None:
+        store_dir = os.path.join( outdir, shard_module.STORE_NAME )
+if cost_manifests is not None:
+    costs = schedule.estimate_costs( cost_manifests )
+records = batch.run( planets, z, inst_modes=inst_modes, nworkers=nworkers, timeout=timeout, \
+                     outdir=outdir, manifest_path=manifest_path, memo=memo, store_dir=store_dir, \
+                     trace_path=trace_path, shard=shard, costs=costs, resolutions=resolutions, \
+                     order=order )
 
@@ -0,0 +1,178 @@
+from __future__ import print_function
+import os, pdb, sys, heapq
+import numpy as np
+try:
+    from . import manifest, profiling
+except ImportError:
+    import manifest, profiling
+
+"""
+Routines for ordering the tasks of a sweep before they are dispatched to
+the worker pool. The cost of each instrument mode is learned from the
+runtimes recorded in earlier sweep manifests and timing traces, and the
+tasks are ordered by one of:
+
+  cost     --> longest tasks first, so the pool is not left waiting on a
+               few slow tasks at the end of the sweep
+  priority --> planets are taken in tiers of TIER_SIZE in order of
+               decreasing signal metric (e.g. sn_tr), longest first within
+               each tier, so the most promising planets finish early
+
+The predicted makespan of the ordered tasks on the worker pool is printed
+before the sweep starts (see report()).
+"""
+
+ORDERS = [ 'cost', 'priority' ]
+TIER_SIZE = 20 # planets per priority tier
+DEFAULT_COST = 1. # cost assumed for every mode when there are no estimates
+
+
+def cost_key( inst_mode, filt ):
+    """
+    Returns the string identifying an instrument mode and filter in the
+    cost estimates.
+    """
+    return '{0}|{1}'.format( inst_mode, filt )
+
+
+def estimate_costs( manifest_paths=None, trace_paths=None ):
+    """
+    Returns a dictionary of the median runtime in seconds of each
+    instrument mode and filter, keyed by cost_key(), from the tasks that
+    completed in the specified sweep manifests and the task stages of the
+    specified timing traces (see profiling.py). Files that do not exist
+    are ignored.
+    """
+    if isinstance( manifest_paths, str ):
+        manifest_paths = [ manifest_paths ]
+    if isinstance( trace_paths, str ):
+        trace_paths = [ trace_paths ]
+    runtimes = {}
+    for fpath in manifest_paths or []:
+        for record in manifest.load( fpath ).values():
+            if ( record['status']=='done' )*( record.get( 'runtime', 0 )>0 ):
+                key = cost_key( record['mode'], record['filter'] )
+                runtimes.setdefault( key, [] ).append( record['runtime'] )
+    for fpath in trace_paths or []:
+        if os.path.isfile( fpath )==False:
+            continue
+        for rec in profiling.read( fpath ):
+            if ( rec.get( 'stage' )=='task' )*( rec.get( 'ok' )==True ):
+                key = cost_key( rec['mode'], rec['filter'] )
+                runtimes.setdefault( key, [] ).append( rec['wall'] )
+    costs = {}
+    for key in runtimes:
+        costs[key] = float( np.median( runtimes[key] ) )
+    return costs
+
+
+def get_cost( costs, inst_mode, filt ):
+    """
+    Returns the estimated cost of a mode, using the median cost of all
+    modes for modes without an estimate.
+    """
+    key = cost_key( inst_mode, filt )
+    if key in costs:
+        return costs[key]
+    if len( costs )>0:
+        return float( np.median( list( costs.values() ) ) )
+    return DEFAULT_COST
+
+
+def get_priorities( tepcat, keys=[ 'sn_tr' ] ):
+    """
+    Returns a dictionary giving the priority rank of each planet in the
+    catalogue, where 0 is the highest. If several metric keys are given,
+    e.g. [ 'sn_tr', 'sn_em' ], each planet takes its best rank in any of
+    them, so strong transmission and strong emission targets both come
+    early.
+    """
+    if isinstance( keys, str ):
+        keys = [ keys ]
+    names = np.asarray( tepcat['names'] ).astype( str )
+    best = np.full( len( names ), len( names ) )
+    for k in keys:
+        values = np.asarray( tepcat[k], dtype=float )
+        values = np.where( np.isfinite( values ), values, -np.inf )
+        rank = np.empty( len( names ), dtype=int )
+        rank[np.argsort( -values, kind='stable' )] = np.arange( len( names ) )
+        best = np.minimum( best, rank )
+    return dict( zip( names.tolist(), best.tolist() ) )
+
+
+def order_tasks( tasks, costs=None, priorities=None, tier_size=TIER_SIZE ):
+    """
+    Returns the [ planet, inst_mode, filter, ... ] tasks reordered for
+    dispatch. Without priorities the tasks are sorted longest first. With
+    priorities from get_priorities(), the planets are split into tiers of
+    tier_size by rank, and the tiers are run in order with the tasks of
+    each tier sorted longest first.
+    """
+    if len( tasks )==0:
+        return []
+    cost = np.array( [ get_cost( costs or {}, t[1], t[2] ) for t in tasks ] )
+    if priorities is None:
+        rank = np.zeros( len( tasks ), dtype=int )
+        tier = rank
+    else:
+        rank = np.array( [ priorities.get( t[0], len( priorities ) ) for t in tasks ] )
+        tier = get_tiers( rank, tier_size )
+    ixs = np.lexsort( ( np.arange( len( tasks ) ), rank, -cost, tier ) )
+    return [ tasks[i] for i in ixs ]
+
+
+def get_tiers( rank, tier_size=TIER_SIZE ):
+    """
+    Returns the tier of each task from the priority ranks of its planet,
+    counting tiers over the distinct planets present so that gaps in the
+    ranks do not leave tiers empty.
+    """
+    ranks = np.unique( rank )
+    return np.searchsorted( ranks, rank )//tier_size
+
+
+def simulate( tasks, costs, nworkers ):
+    """
+    Returns the predicted finish time of each task when the tasks are
+    dispatched in order to nworkers workers, each task going to the first
+    worker to become free.
+    """
+    free = [ 0. ]*nworkers
+    finish = np.zeros( len( tasks ) )
+    for i, t in enumerate( tasks ):
+        start = heapq.heappop( free )
+        finish[i] = start+get_cost( costs or {}, t[1], t[2] )
+        heapq.heappush( free, finish[i] )
+    return finish
+
+
+def report( tasks, costs, nworkers, priorities=None, tier_size=TIER_SIZE ):
+    """
+    Prints the predicted makespan of the ordered tasks, with the lower bound
+    max( total cost/nworkers, longest task ) and, if priorities are given,
+    the predicted time for the first tier of planets to finish. Returns a
+    dictionary with keys 'makespan', 'lower_bound', 'total' and
+    'first_tier' (None without priorities), in the units of the costs.
+    """
+    outp = { 'makespan':0., 'lower_bound':0., 'total':0., 'first_tier':None }
+    if len( tasks )==0:
+        return outp
+    cost = np.array( [ get_cost( costs or {}, t[1], t[2] ) for t in tasks ] )
+    finish = simulate( tasks, costs, nworkers )
+    outp['makespan'] = float( finish.max() )
+    outp['total'] = float( cost.sum() )
+    outp['lower_bound'] = float( max( [ cost.sum()/nworkers, cost.max() ] ) )
+    print( '\n{0}\nSchedule: {1} tasks, total estimated cost {2:.1f} s on {3} workers'\
+           .format( 50*'#', len( tasks ), outp['total'], nworkers ) )
+    print( '... predicted makespan {0:.1f} s (lower bound {1:.1f} s)'\
+           .format( outp['makespan'], outp['lower_bound'] ) )
+    if priorities is not None:
+        rank = np.array( [ priorities.get( t[0], len( priorities ) ) for t in tasks ] )
+        first = ( get_tiers( rank, tier_size )==0 )
+        outp['first_tier'] = float( finish[first].max() )
+        print( '... top {0} planets predicted to finish after {1:.1f} s'\
+               .format( len( np.unique( rank[first] ) ), outp['first_tier'] ) )
+    if len( costs or {} )==0:
+        print( '... no earlier timings: assuming equal cost for every mode' )
+    print( '{0}\n'.format( 50*'#' ) )
+    return outp
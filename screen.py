@@ -0,0 +1,147 @@
+from __future__ import print_function
+import os, pdb, sys
+import numpy as np
+try:
+    from . import tepcat as tepcat_module
+except ImportError:
+    import tepcat as tepcat_module
+
+"""
+Routines for ranking targets with analytic signal-to-noise proxies before
+running PandExo, so that only the most promising planets are sent to full
+simulation. The transmission proxy is the hydrogen atmosphere transit depth
+( hdepth ) and the emission proxy is the blackbody eclipse depth, each
+scaled by the square root of the stellar flux and a relative instrument
+throughput at the centre of each mode's wavelength range. Modes in which
+the star is brighter than an approximate saturation limit are flagged.
+"""
+
+# Approximate instrument mode properties as [ wavelength min (micron),
+# wavelength max (micron), relative throughput, K magnitude saturation
+# limit at 80% full well ]. These are rough figures intended for ranking
+# only; PandExo should be used for the actual noise and saturation:
+MODE_PROPERTIES = { 'MIRI LRS':[ 5.0, 12.0, 0.3, 4.5 ], \
+                    'NIRISS SOSS':[ 0.6, 2.8, 0.8, 8.5 ], \
+                    'NIRSpec G140M':[ 0.97, 1.84, 0.5, 7.5 ], \
+                    'NIRSpec G140H':[ 0.97, 1.84, 0.4, 7.0 ], \
+                    'NIRSpec G235M':[ 1.66, 3.07, 0.5, 7.0 ], \
+                    'NIRSpec G235H':[ 1.66, 3.07, 0.4, 6.5 ], \
+                    'NIRSpec G395M':[ 2.87, 5.1, 0.5, 6.0 ], \
+                    'NIRSpec G395H':[ 2.87, 5.1, 0.4, 5.5 ], \
+                    'NIRSpec Prism':[ 0.6, 5.3, 1.0, 10.5 ], \
+                    'NIRCam F322W2':[ 2.4, 4.0, 0.6, 5.0 ], \
+                    'NIRCam F444W':[ 3.9, 5.0, 0.5, 4.5 ] }
+
+
+def screen( tepcat, inst_modes='all', metric='sn_tr', sat_level=80, sat_unit='%', top_n=None, \
+            threshold=None, keep_saturated=False ):
+    """
+    Ranks every ( planet, instrument mode ) pair by an analytic S/N proxy.
+
+    metric is 'sn_tr' for transmission or 'sn_em' for emission. Scores are
+    normalised to the tepcat.REF_PLANET value in the same mode, or to the
+    highest score if the reference planet is not in the catalogue. Pairs
+    with a score below threshold are dropped, as are pairs where the star
+    is expected to saturate at sat_level unless keep_saturated is True. The
+    saturation limits are in % of full well, so sat_unit must be '%'. If
+    top_n is provided, only the top_n pairs are kept. Raises ValueError for
+    modes that are not in MODE_PROPERTIES.
+
+    Returns a dictionary of arrays with keys 'names', 'modes', 'score' and
+    'saturated', sorted in order of decreasing score.
+    """
+    inst_modes = get_inst_modes( inst_modes )
+    if sat_unit!='%':
+        raise ValueError( 'Screening needs sat_level in % of full well, not {0}'.format( sat_unit ) )
+    if sat_level<=0:
+        raise ValueError( 'sat_level must be positive' )
+    names = np.asarray( tepcat['names'] )
+    kmags = np.asarray( tepcat['kmags'], dtype=float )
+    tstar = np.asarray( tepcat['tstar'], dtype=float )
+    ixref = np.flatnonzero( names==tepcat_module.REF_PLANET )
+    if len( ixref )>0:
+        ixref = ixref[0]
+    else:
+        ixref = None
+    if metric=='sn_tr':
+        signal = np.asarray( tepcat['hdepth'], dtype=float )
+    elif metric!='sn_em':
+        raise ValueError( 'metric must be sn_tr or sn_em' )
+    # Brighter stars can be observed without saturating at higher sat_level:
+    dksat = -2.5*np.log10( sat_level/80. )
+
+    n = len( names )
+    nmodes = len( inst_modes )
+    score = np.zeros( [ nmodes, n ] )
+    saturated = np.zeros( [ nmodes, n ], dtype=bool )
+    for i in range( nmodes ):
+        wmin, wmax, throughput, ksat = MODE_PROPERTIES[inst_modes[i]]
+        wav_um = 0.5*( wmin+wmax )
+        if ixref is None:
+            fratio = tepcat_module.calc_fratio( wav_um, tstar, kmags, tstar[0], kmags[0] )
+        else:
+            fratio = tepcat_module.calc_fratio( wav_um, tstar, kmags, tstar[ixref], kmags[ixref] )
+        if metric=='sn_em':
+            signal = tepcat_module.calc_ecdepth( np.asarray( tepcat['tplanet'], dtype=float ), \
+                                                 tstar, np.asarray( tepcat['RpRs'], dtype=float ), \
+                                                 wav_um )
+        score[i,:] = signal*np.sqrt( throughput*( wmax-wmin )*fratio )
+        if ixref is None:
+            score[i,:] /= score[i,:].max()
+        else:
+            score[i,:] /= score[i,ixref]
+        saturated[i,:] = ( kmags<ksat+dksat )
+
+    # Flatten to ( planet, mode ) pairs and rank:
+    ranked = {}
+    ranked['names'] = np.tile( names, nmodes )
+    ranked['modes'] = np.repeat( np.array( inst_modes ), n )
+    ranked['score'] = score.flatten()
+    ranked['saturated'] = saturated.flatten()
+    ixs = np.isfinite( ranked['score'] )
+    if keep_saturated==False:
+        ixs *= ( ranked['saturated']==False )
+    if threshold is not None:
+        ixs *= ( ranked['score']>=threshold )
+    ixs = np.flatnonzero( ixs )
+    ixs = ixs[np.argsort( -ranked['score'][ixs], kind='mergesort' )]
+    if top_n is not None:
+        ixs = ixs[:top_n]
+    for k in list( ranked.keys() ):
+        ranked[k] = ranked[k][ixs]
+    return ranked
+
+
+def get_inst_modes( inst_modes='all' ):
+    """
+    Returns the list of instrument modes to screen, expanding 'all'. A
+    single mode can be given as a string. Raises ValueError for modes that
+    have no entry in MODE_PROPERTIES.
+    """
+    if isinstance( inst_modes, str ):
+        inst_modes = [ inst_modes ]
+    inst_modes = list( inst_modes )
+    if inst_modes==[ 'all' ]:
+        return list( MODE_PROPERTIES.keys() )
+    unknown = [ m for m in inst_modes if m not in MODE_PROPERTIES ]
+    if len( unknown )>0:
+        raise ValueError( 'No screening properties for instrument modes {0}; available modes are {1}'\
+                          .format( unknown, list( MODE_PROPERTIES.keys() ) ) )
+    return inst_modes
+
+
+def select_planets( tepcat, inst_modes='all', metric='sn_tr', sat_level=80, sat_unit='%', \
+                    top_n=None, threshold=None ):
+    """
+    Returns the names of the planets with at least one unsaturated mode
+    passing the screen, in order of their best score. If top_n is provided,
+    at most top_n planets are returned.
+    """
+    ranked = screen( tepcat, inst_modes=inst_modes, metric=metric, sat_level=sat_level, \
+                     sat_unit=sat_unit, threshold=threshold )
+    names, ixs = np.unique( ranked['names'], return_index=True )
+    planets = names[np.argsort( ixs )]
+    if top_n is not None:
+        planets = planets[:top_n]
+    print( 'Screening selected {0} of {1} planets'.format( len( planets ), len( tepcat['names'] ) ) )
+    return planets
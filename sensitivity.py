@@ -0,0 +1,121 @@
+from __future__ import print_function
+import os, pdb, sys, time
+import numpy as np
+try:
+    from . import batch
+    from .store import ResultStore
+except ImportError:
+    import batch
+    from store import ResultStore
+
+"""
+Routines for exploring the noise floor and saturation level trade-offs
+without rerunning PandExo for every noise floor. PandExo applies the noise
+floor after the simulation by raising each error to at least the floor, so
+each ( planet, mode, filter, saturation level ) is simulated once with no
+floor and every floor is then applied to the raw errors in one step. The
+result for each task is an error cube with one row per noise floor:
+
+  <outdir>/sat-<level>/           --> result store of the raw noise spectra
+                                      and its sweep manifest
+  <outdir>/sat-<level>/cubes/<planet>/<label>.npz
+                                  --> 'wave' (micron), 'floors_ppm',
+                                      'error_ppm' (floors x wavelength)
+                                      and 'saturated'
+"""
+
+FLOORS_PPM = [ 0, 10, 20, 30, 50, 100 ]
+
+
+def run_grid( planets, tepcat, inst_modes='all', sat_levels=[ 80 ], sat_unit='%', \
+              floors_ppm=FLOORS_PPM, outdir='.', nworkers=None, timeout=None, backend=None, \
+              memo=False ):
+    """
+    Runs PandExo once per planet, instrument mode and saturation level with
+    no noise floor, then writes the error cube over floors_ppm for each
+    task with save_cubes(). The raw spectra are kept in a result store per
+    saturation level (see get_sat_dir()) with a sweep manifest, so a rerun
+    only simulates tasks that are missing, and adding floors costs no
+    further PandExo runs. The nworkers, timeout, backend and memo arguments
+    are as for batch.run().
+
+    Returns a dictionary keyed by saturation level of the batch records.
+    """
+    if outdir=='.':
+        outdir = os.getcwd()
+    t0 = time.time()
+    records = {}
+    for sat_level in sat_levels:
+        sdir = get_sat_dir( outdir, sat_level )
+        if os.path.isdir( sdir )==False:
+            os.makedirs( sdir )
+        print( '\n{0}\nSaturation level {1}{2}: {3} noise floors from one PandExo run per task\n{0}'\
+               .format( 50*'#', sat_level, sat_unit, len( floors_ppm ) ) )
+        records[sat_level] = batch.run( planets, tepcat, inst_modes=inst_modes, nworkers=nworkers, \
+                                        timeout=timeout, backend=backend, sat_level=sat_level, \
+                                        sat_unit=sat_unit, noise_floor_ppm=0, \
+                                        manifest_path=os.path.join( sdir, 'manifest.jsonl' ), \
+                                        memo=memo, store_dir=sdir )
+        save_cubes( sdir, floors_ppm )
+    print( 'Sensitivity grid finished in {0:.2f} minutes'.format( ( time.time()-t0 )/60. ) )
+    return records
+
+
+def get_sat_dir( outdir, sat_level ):
+    """
+    Returns the result store directory for a saturation level.
+    """
+    return os.path.join( outdir, 'sat-{0}'.format( sat_level ) )
+
+
+def apply_floors( err_ppm, floors_ppm ):
+    """
+    Returns the errors with each noise floor applied as a floors x
+    wavelength array, where row i is max( err_ppm, floors_ppm[i] ) as in
+    PandExo. The raw errors must have been simulated with no noise floor.
+    """
+    err_ppm = np.asarray( err_ppm, dtype=float )
+    floors_ppm = np.asarray( floors_ppm, dtype=float )
+    return np.maximum( err_ppm[None,:], floors_ppm[:,None] )
+
+
+def get_cube( store, planet, label, floors_ppm=FLOORS_PPM ):
+    """
+    Returns the wavelengths (micron), error cube (ppm, floors x wavelength)
+    and observation parameters for one task in a raw result store, which
+    can be a ResultStore or its directory.
+    """
+    if isinstance( store, ResultStore )==False:
+        store = ResultStore( store )
+    wav, err, obspar = store.get( planet, label )
+    return wav, apply_floors( err, floors_ppm ), obspar
+
+
+def save_cubes( sdir, floors_ppm=FLOORS_PPM ):
+    """
+    Writes the error cube of every task in the raw result store sdir to
+    sdir/cubes/<planet>/<label>.npz. Returns the number of cubes written.
+    """
+    store = ResultStore( sdir )
+    floors_ppm = np.asarray( floors_ppm, dtype=float )
+    n = 0
+    for planet, label in store.keys():
+        wav, cube, obspar = get_cube( store, planet, label, floors_ppm )
+        odir = os.path.join( sdir, 'cubes', planet )
+        if os.path.isdir( odir )==False:
+            os.makedirs( odir )
+        np.savez( os.path.join( odir, '{0}.npz'.format( label ) ), wave=wav, floors_ppm=floors_ppm, \
+                  error_ppm=cube, saturated=obspar.get( 'saturated', False ) )
+        n += 1
+    print( 'Saved {0} error cubes ({1} noise floors) to {2}'\
+           .format( n, len( floors_ppm ), os.path.join( sdir, 'cubes' ) ) )
+    return n
+
+
+def load_cube( fpath ):
+    """
+    Reads a cube written by save_cubes(), returning the wavelengths
+    (micron), noise floors (ppm), error cube (ppm) and saturation flag.
+    """
+    with np.load( fpath ) as f:
+        return f['wave'], f['floors_ppm'], f['error_ppm'], bool( f['saturated'] )
@@ -0,0 +1,414 @@
+from __future__ import print_function
+import os, pdb, sys, time, json, socket, signal, asyncio, argparse
+import http.client
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+try:
+    from . import jwstsim, batch, manifest, catalogue
+except ImportError:
+    import jwstsim, batch, manifest, catalogue
+
+"""
+Long-running job server for on-demand JWST noise simulations. The TEPCat
+catalogue is loaded and PandExo is imported once at startup, and requests
+are farmed out to a pool of warm worker processes. Identical ( planet,
+mode, filter ) simulations that are already running for another request
+are not repeated; the second request waits for the same result. Results
+are streamed back one instrument mode at a time as they finish.
+
+The server speaks a minimal HTTP/1.1 over TCP or a Unix socket:
+
+  POST /simulate  --> JSON body with 'planet' and optionally 'inst_modes',
+                      'sat_level', 'sat_unit' and 'noise_floor_ppm'; the
+                      response is newline-delimited JSON with one line per
+                      mode as it finishes and a final line with 'done'
+  GET /status     --> JSON with the server statistics
+
+Start it with, e.g.:
+
+  python server.py --port 8765
+  python server.py --socket /tmp/pandexo_prep.sock --backend fakejdi
+
+and query it from Python with simulate(), or with curl:
+
+  curl -N -d '{"planet":"WASP-121","inst_modes":["NIRSpec G395H"]}' localhost:8765/simulate
+"""
+
+PORT = 8765
+
+
+class JobServer( object ):
+    """
+    Holds the warm catalogue and worker pool and serves simulation requests.
+    tepcat can be a catalogue dictionary or Catalogue; by default the
+    catalogue is loaded from the saved TEPCat tables. The nworkers, timeout,
+    backend and memo arguments are as for batch.run().
+    """
+
+    def __init__( self, tepcat=None, nworkers=None, timeout=None, backend=None, memo=False ):
+        if backend is not None:
+            jwstsim.set_backend( backend )
+        jwstsim.get_jdi() # import PandExo before the workers are started
+        if tepcat is None:
+            tepcat = catalogue.load( download_latest=False, quiet=True )
+        elif isinstance( tepcat, catalogue.Catalogue )==False:
+            tepcat = catalogue.Catalogue.from_dict( tepcat )
+        self.tepcat = tepcat
+        if nworkers is None:
+            nworkers = os.cpu_count()
+        self.nworkers = nworkers
+        self.backend = backend
+        self.simkw = { 'outdir':None, 'timeout':timeout, 'memo':memo, 'store':True, 'resolutions':None }
+        self.pool = self.new_pool()
+        self.inflight = {}
+        self.stats = { 'requests':0, 'tasks':0, 'coalesced':0, 'done':0, 'failed':0, \
+                       'restarts':0, 'started':time.time() }
+
+    def new_pool( self ):
+        """
+        Returns a new pool of warm worker processes.
+        """
+        return ProcessPoolExecutor( max_workers=self.nworkers, initializer=batch.init_worker, \
+                                    initargs=( self.backend, self.simkw ) )
+
+    def restart_pool( self, broken ):
+        """
+        Replaces the worker pool after a worker process died, unless another
+        task has already replaced it.
+        """
+        if self.pool is broken:
+            print( 'Worker pool broken - starting new workers' )
+            self.pool = self.new_pool()
+            self.stats['restarts'] += 1
+            broken.shutdown( wait=False )
+        return None
+
+    def close( self ):
+        """
+        Shuts down the worker pool, cancelling queued tasks and waiting for
+        the worker processes to exit.
+        """
+        self.pool.shutdown( wait=True, cancel_futures=True )
+        return None
+
+    def prepare_tasks( self, params ):
+        """
+        Returns the list of [ planet, inst_mode, filter, exo_dict, hash ]
+        tasks for a request, raising a KeyError if the planet is not in the
+        catalogue and a ValueError if the request is malformed, including
+        inst_modes that are not 'all' or a list of known mode names.
+        """
+        if isinstance( params, dict )==False:
+            raise ValueError( 'Request must be a JSON object' )
+        if 'planet' not in params:
+            raise ValueError( 'Request must give a planet' )
+        planet = str( params['planet'] )
+        if planet not in self.tepcat:
+            raise KeyError( 'Could not match {0} to any TEPCat planets'.format( planet ) )
+        inst_modes = params.get( 'inst_modes', 'all' )
+        if inst_modes!='all':
+            if isinstance( inst_modes, list )==False:
+                raise ValueError( 'inst_modes must be "all" or a list of mode names' )
+            if len( inst_modes )==0:
+                raise ValueError( 'inst_modes must not be empty' )
+            for m in inst_modes:
+                if isinstance( m, str )==False:
+                    raise ValueError( 'inst_modes must be "all" or a list of mode names' )
+        inst_modes = jwstsim.get_inst_modes( inst_modes ) # ValueError for unknown modes
+        zs = jwstsim.prepare_exo_dicts( self.tepcat, [ planet ], \
+                                        sat_level=params.get( 'sat_level', 80 ), \
+                                        sat_unit=params.get( 'sat_unit', '%' ), \
+                                        noise_floor_ppm=params.get( 'noise_floor_ppm', 20 ) )
+        tasks = []
+        for task in batch.list_tasks( [ planet ], inst_modes ):
+            z = zs[planet]
+            tasks += [ task+[ z, manifest.hash_inputs( z, task[1], task[2] ) ] ]
+        return tasks
+
+    async def run_task( self, task ):
+        """
+        Returns the batch record for a task, running it in the worker pool
+        unless the same simulation is already in flight, in which case the
+        running result is awaited instead. Returns the record and whether
+        it was coalesced.
+        """
+        key = task[4]
+        self.stats['tasks'] += 1
+        if key in self.inflight:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield( self.inflight[key] ), True
+        future = asyncio.ensure_future( self.execute( task ) )
+        self.inflight[key] = future
+        future.add_done_callback( lambda f: self.inflight.pop( key, None ) )
+        record = await asyncio.shield( future )
+        if record['status']=='done':
+            self.stats['done'] += 1
+        else:
+            self.stats['failed'] += 1
+        return record, False
+
+    async def execute( self, task ):
+        """
+        Runs a task in the worker pool, returning a failed record if the
+        pool raised instead of the task, e.g. because a worker process died,
+        in which case the pool is replaced for later tasks.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self.pool
+        try:
+            return await loop.run_in_executor( pool, batch.run_task, task )
+        except Exception as err:
+            if isinstance( err, BrokenProcessPool ):
+                self.restart_pool( pool )
+            record = batch.new_record( task )
+            record['error'] = repr( err )
+            return record
+
+    async def simulate( self, tasks ):
+        """
+        Runs the tasks for one request, yielding a result dictionary for
+        each mode as it finishes (see format_result()).
+        """
+        async def run( task ):
+            record, coalesced = await self.run_task( task )
+            return format_result( record, coalesced )
+        for f in asyncio.as_completed( [ run( task ) for task in tasks ] ):
+            yield await f
+
+    async def handle( self, reader, writer ):
+        """
+        Handles one HTTP connection.
+        """
+        streaming = False
+        try:
+            method, path, headers, body = await read_request( reader )
+            if ( method=='GET' )*( path=='/status' ):
+                status = dict( self.stats )
+                status.update( { 'inflight':len( self.inflight ), 'nworkers':self.nworkers, \
+                                 'planets':len( self.tepcat ) } )
+                await send_json( writer, 200, status )
+            elif ( method=='POST' )*( path=='/simulate' ):
+                try:
+                    params = json.loads( body.decode( 'utf-8' ) or '{}' )
+                    tasks = self.prepare_tasks( params )
+                except KeyError as err:
+                    await send_json( writer, 404, { 'error':str( err.args[0] ) } )
+                    return
+                except ValueError as err:
+                    await send_json( writer, 400, { 'error':str( err ) } )
+                    return
+                self.stats['requests'] += 1
+                t1 = time.time()
+                streaming = True
+                writer.write( ( 'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n' \
+                                'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n' ).encode( 'latin-1' ) )
+                async for result in self.simulate( tasks ):
+                    await send_chunk( writer, json.dumps( result )+'\n' )
+                await send_chunk( writer, json.dumps( { 'done':True, 'planet':tasks[0][0], \
+                                                       'ntasks':len( tasks ), \
+                                                       'elapsed':time.time()-t1 } )+'\n' )
+                await send_chunk( writer, '' )
+            else:
+                await send_json( writer, 404, { 'error':'Unknown endpoint {0} {1}'.format( method, path ) } )
+        except ( ConnectionError, asyncio.IncompleteReadError ):
+            pass # client went away
+        except asyncio.CancelledError:
+            pass # server shutting down
+        except Exception as err:
+            # End the response cleanly rather than leaving it truncated:
+            try:
+                if streaming:
+                    await send_chunk( writer, json.dumps( { 'error':repr( err ) } )+'\n' )
+                    await send_chunk( writer, '' )
+                else:
+                    await send_json( writer, 500, { 'error':repr( err ) } )
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def serve( self, host='127.0.0.1', port=PORT, socket_path=None, handle_signals=False ):
+        """
+        Serves requests until cancelled, on a Unix socket if socket_path is
+        provided or on host:port otherwise. If handle_signals is True (only
+        possible in the main thread), SIGINT and SIGTERM stop the server so
+        that the worker pool can be shut down.
+        """
+        if socket_path is not None:
+            server = await asyncio.start_unix_server( self.handle, path=socket_path )
+            address = socket_path
+        else:
+            server = await asyncio.start_server( self.handle, host=host, port=port )
+            address = '{0}:{1}'.format( host, port )
+        print( 'Serving {0} planets on {1} with {2} workers'.format( len( self.tepcat ), address, \
+                                                                  self.nworkers ) )
+        async with server:
+            if handle_signals==False:
+                await server.serve_forever()
+            else:
+                stop = asyncio.Event()
+                loop = asyncio.get_running_loop()
+                for sig in [ signal.SIGINT, signal.SIGTERM ]:
+                    loop.add_signal_handler( sig, stop.set )
+                await stop.wait()
+        return None
+
+
+def format_result( record, coalesced=False ):
+    """
+    Returns the JSON-serialisable result for a finished batch record, with
+    keys 'planet', 'mode', 'filter', 'status', 'runtime', 'error',
+    'coalesced' and, if the task succeeded, 'label', 'wave' (micron),
+    'noise_ppm' and 'obspar'.
+    """
+    result = {}
+    for k in [ 'planet', 'mode', 'filter', 'status', 'runtime', 'error' ]:
+        result[k] = record[k]
+    result['coalesced'] = coalesced
+    if 'result' in record:
+        label, wav, err, obspar = record['result'][0]
+        result['label'] = label
+        result['wave'] = np.asarray( wav ).tolist()
+        result['noise_ppm'] = np.asarray( err ).tolist()
+        result['obspar'] = obspar
+    return result
+
+
+async def read_request( reader ):
+    """
+    Reads an HTTP request, returning the method, path, header dictionary
+    (with lower-case keys) and body bytes.
+    """
+    line = await reader.readline()
+    method, path = line.decode( 'latin-1' ).split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in [ b'\r\n', b'\n', b'' ]:
+            break
+        k, v = line.decode( 'latin-1' ).split( ':', 1 )
+        headers[k.strip().lower()] = v.strip()
+    body = b''
+    n = int( headers.get( 'content-length', 0 ) )
+    if n>0:
+        body = await reader.readexactly( n )
+    return method, path, headers, body
+
+
+async def send_json( writer, code, obj ):
+    """
+    Sends a complete JSON response.
+    """
+    reasons = { 200:'OK', 400:'Bad Request', 404:'Not Found', 500:'Internal Server Error' }
+    body = json.dumps( obj ).encode( 'utf-8' )
+    writer.write( ( 'HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n' \
+                    'Connection: close\r\n\r\n'.format( code, reasons[code], len( body ) ) ).encode( 'latin-1' ) )
+    writer.write( body )
+    await writer.drain()
+    return None
+
+
+async def send_chunk( writer, s ):
+    """
+    Sends one chunk of a chunked response; an empty string ends the response.
+    """
+    data = s.encode( 'utf-8' )
+    writer.write( '{0:x}\r\n'.format( len( data ) ).encode( 'latin-1' )+data+b'\r\n' )
+    await writer.drain()
+    return None
+
+
+class UnixHTTPConnection( http.client.HTTPConnection ):
+    """
+    HTTP connection over a Unix socket.
+    """
+
+    def __init__( self, socket_path, timeout=None ):
+        http.client.HTTPConnection.__init__( self, 'localhost', timeout=timeout )
+        self.socket_path = socket_path
+
+    def connect( self ):
+        self.sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        if self.timeout is not None:
+            self.sock.settimeout( self.timeout )
+        self.sock.connect( self.socket_path )
+
+
+def get_connection( host='127.0.0.1', port=PORT, socket_path=None, timeout=None ):
+    """
+    Returns an HTTP connection to a running server.
+    """
+    if socket_path is not None:
+        return UnixHTTPConnection( socket_path, timeout=timeout )
+    return http.client.HTTPConnection( host, port, timeout=timeout )
+
+
+def simulate( planet, inst_modes='all', sat_level=80, sat_unit='%', noise_floor_ppm=20, \
+              host='127.0.0.1', port=PORT, socket_path=None, timeout=None ):
+    """
+    Sends a simulation request to a running server and yields the result
+    dictionary for each instrument mode as soon as it arrives (see
+    format_result()), followed by a final dictionary with key 'done'.
+    Raises a ValueError if the server rejects the request.
+    """
+    params = { 'planet':planet, 'inst_modes':inst_modes, 'sat_level':sat_level, \
+               'sat_unit':sat_unit, 'noise_floor_ppm':noise_floor_ppm }
+    conn = get_connection( host=host, port=port, socket_path=socket_path, timeout=timeout )
+    try:
+        conn.request( 'POST', '/simulate', body=json.dumps( params ), \
+                      headers={ 'Content-Type':'application/json' } )
+        resp = conn.getresponse()
+        if resp.status!=200:
+            raise ValueError( json.loads( resp.read().decode( 'utf-8' ) )['error'] )
+        while True:
+            line = resp.readline()
+            if len( line )==0:
+                break
+            yield json.loads( line.decode( 'utf-8' ) )
+    finally:
+        conn.close()
+
+
+def status( host='127.0.0.1', port=PORT, socket_path=None, timeout=None ):
+    """
+    Returns the statistics of a running server.
+    """
+    conn = get_connection( host=host, port=port, socket_path=socket_path, timeout=timeout )
+    try:
+        conn.request( 'GET', '/status' )
+        return json.loads( conn.getresponse().read().decode( 'utf-8' ) )
+    finally:
+        conn.close()
+
+
+def main( host='127.0.0.1', port=PORT, socket_path=None, nworkers=None, timeout=None, \
+          backend=None, memo=False ):
+    """
+    Starts a job server and serves until interrupted or terminated.
+    """
+    server = JobServer( nworkers=nworkers, timeout=timeout, backend=backend, memo=memo )
+    try:
+        asyncio.run( server.serve( host=host, port=port, socket_path=socket_path, \
+                                   handle_signals=True ) )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if ( socket_path is not None ) and os.path.exists( socket_path ):
+            os.remove( socket_path )
+    return None
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser( description='pandexo_prep job server' )
+    parser.add_argument( '--host', default='127.0.0.1' )
+    parser.add_argument( '--port', type=int, default=PORT )
+    parser.add_argument( '--socket', default=None, help='serve on this Unix socket instead of TCP' )
+    parser.add_argument( '--nworkers', type=int, default=None )
+    parser.add_argument( '--timeout', type=float, default=None, help='maximum seconds per PandExo run' )
+    parser.add_argument( '--backend', default=None, help='e.g. fakejdi to test without PandExo' )
+    parser.add_argument( '--memo', action='store_true', help='reuse cached PandExo results' )
+    args = parser.parse_args()
+    main( host=args.host, port=args.port, socket_path=args.socket, nworkers=args.nworkers, \
+          timeout=args.timeout, backend=args.backend, memo=args.memo )
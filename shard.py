@@ -0,0 +1,203 @@
+from __future__ import print_function
+import os, pdb, sys, glob, shutil, hashlib, argparse
+import numpy as np
+try:
+    from . import manifest, schedule
+    from .store import ResultStore
+except ImportError:
+    import manifest, schedule
+    from store import ResultStore
+
+"""
+Routines for splitting a sweep across several machines. The ( planet,
+instrument mode, filter ) tasks are partitioned deterministically into N
+shards, so that each node can work out its own share of the sweep from the
+same planet list and settings without any coordination, and the outputs of
+the shards are merged back into one result set afterwards.
+
+Two partitioning methods are available:
+
+  hash     --> each task goes to shard hash( planet, mode, filter ) mod N,
+               using a stable hash, so a task always lands on the same
+               shard however the planet list changes
+  balanced --> tasks are assigned longest first to the shard with the least
+               total estimated cost so far, using per-mode runtimes from the
+               manifests of earlier sweeps (see schedule.estimate_costs());
+               every node must use the same planets, modes and cost estimates
+
+Each shard is run with batch.run( ..., shard=[ k, N ] ), normally writing to
+its own directory returned by get_shard_dir() (see run_jwst.py). Once the
+shard directories have been copied to one place, merge() combines them:
+
+  python shard.py merge <outdir> <shard_dir> [<shard_dir> ...]
+  python shard.py plan --nshards 4 --manifests sweep_manifest.jsonl
+"""
+
+MANIFEST_NAME = 'sweep_manifest.jsonl' # manifest file name within a shard directory
+STORE_NAME = 'store' # result store directory name within a shard directory
+
+
+def get_shard_dir( k, nshards, outdir='.' ):
+    """
+    Returns the output directory for shard k of nshards.
+    """
+    if outdir=='.':
+        outdir = os.getcwd()
+    return os.path.join( outdir, 'shard-{0:03d}-of-{1:03d}'.format( k, nshards ) )
+
+
+def task_hash( planet, inst_mode, filt ):
+    """
+    Returns a stable integer hash of a task, which unlike the built-in
+    hash() is the same in every process and on every machine.
+    """
+    key = manifest.task_key( planet, inst_mode, filt )
+    return int( hashlib.sha1( key.encode( 'utf-8' ) ).hexdigest()[:15], 16 )
+
+
+def assign( tasks, nshards, costs=None ):
+    """
+    Returns an array giving the shard of each [ planet, inst_mode, filter ]
+    task. If costs is None the hash method is used, otherwise the balanced
+    method with costs as returned by schedule.estimate_costs(). The result
+    depends only on the set of tasks, not on their order.
+    """
+    nshards = int( nshards )
+    if nshards<1:
+        raise ValueError( 'nshards must be at least 1' )
+    hashes = np.array( [ task_hash( *t[:3] ) for t in tasks ], dtype=np.int64 )
+    if costs is None:
+        return hashes%nshards
+    cost = np.array( [ schedule.get_cost( costs, t[1], t[2] ) for t in tasks ] )
+    shards = np.zeros( len( tasks ), dtype=int )
+    loads = np.zeros( nshards )
+    # Longest first, ties broken by hash so that every node agrees:
+    for i in np.lexsort( ( hashes, -cost ) ):
+        k = np.argmin( loads )
+        shards[i] = k
+        loads[k] += cost[i]
+    return shards
+
+
+def select( tasks, k, nshards, costs=None ):
+    """
+    Returns the tasks assigned to shard k of nshards (see assign()).
+    """
+    if ( k<0 )+( k>=nshards ):
+        raise ValueError( 'shard k must be from 0 to {0}'.format( nshards-1 ) )
+    shards = assign( tasks, nshards, costs=costs )
+    return [ tasks[i] for i in np.flatnonzero( shards==k ) ]
+
+
+def plan( tasks, nshards, costs=None, quiet=False ):
+    """
+    Returns the number of tasks and estimated total cost of each shard,
+    printing them unless quiet is True. Costs are those used for balancing,
+    or DEFAULT_COST per task for the hash method.
+    """
+    shards = assign( tasks, nshards, costs=costs )
+    cost = np.array( [ schedule.get_cost( costs or {}, t[1], t[2] ) for t in tasks ] )
+    ntasks = np.bincount( shards, minlength=nshards )
+    loads = np.bincount( shards, weights=cost, minlength=nshards )
+    if quiet==False:
+        print( '\n{0}\n{1} tasks in {2} shards ({3})'.format( 50*'#', len( tasks ), nshards, \
+                                                             'hash' if costs is None else 'balanced' ) )
+        for k in range( nshards ):
+            print( '... shard {0}: {1} tasks, estimated cost {2:.1f}'.format( k, ntasks[k], loads[k] ) )
+        if loads.min()>0:
+            print( 'Imbalance (max/mean): {0:.3f}'.format( loads.max()/loads.mean() ) )
+        print( '{0}\n'.format( 50*'#' ) )
+    return ntasks, loads
+
+
+def merge( shard_dirs, outdir ):
+    """
+    Merges shard directories into outdir. Planet output directories are
+    copied across, result stores (STORE_NAME subdirectories) are combined
+    into one, and the shard manifests are combined into one manifest
+    outdir/MANIFEST_NAME with the output paths pointing to the merged
+    copies, so that rerunning a sweep with it only runs missing or failed
+    tasks. Where a task appears in more than one shard, the most recent
+    record is kept. Returns the merged manifest dictionary.
+    """
+    outdir = os.path.abspath( outdir )
+    if os.path.isdir( outdir )==False:
+        os.makedirs( outdir )
+    ledger = {}
+    sdir = os.path.join( outdir, STORE_NAME )
+    store = None
+    for shard_dir in shard_dirs:
+        name = os.path.basename( os.path.normpath( shard_dir ) )
+        # Planet output directories:
+        for planet_dir in sorted( glob.glob( os.path.join( shard_dir, '*', '' ) ) ):
+            planet = os.path.basename( os.path.normpath( planet_dir ) )
+            if planet==STORE_NAME:
+                continue
+            odir = os.path.join( outdir, planet )
+            if os.path.isdir( odir )==False:
+                os.makedirs( odir )
+            for ipath in glob.glob( os.path.join( planet_dir, '*' ) ):
+                shutil.copy2( ipath, odir )
+        # Result store:
+        ishard = os.path.join( shard_dir, STORE_NAME )
+        if os.path.isdir( ishard ):
+            if store is None:
+                store = ResultStore( sdir )
+            istore = ResultStore( ishard )
+            for planet, label in istore.keys():
+                wav, err, obspar = istore.get( planet, label )
+                store.append( planet, label, wav, err, obspar )
+        # Manifest, keeping the latest record of each task:
+        records = manifest.load( os.path.join( shard_dir, MANIFEST_NAME ) ).values()
+        for record in records:
+            record['outputs'] = [ remap_path( p, name, outdir ) for p in record['outputs'] ]
+            if ( record['key'] not in ledger ) or ( record['time']>=ledger[record['key']]['time'] ):
+                ledger[record['key']] = record
+        print( 'Merged {0}: {1} tasks'.format( shard_dir, len( records ) ) )
+    if store is not None:
+        store.flush()
+    opath = os.path.join( outdir, MANIFEST_NAME )
+    if os.path.isfile( opath ):
+        os.remove( opath )
+    for key in sorted( ledger.keys() ):
+        manifest.append( opath, ledger[key] )
+    manifest.summarise( opath )
+    return ledger
+
+
+def remap_path( fpath, shard_name, outdir ):
+    """
+    Returns the path in outdir corresponding to an output path written
+    under the shard directory shard_name, which may have been on another
+    machine. Paths outside the shard directory are returned unchanged.
+    """
+    parts = os.path.normpath( fpath ).split( os.sep )
+    if shard_name not in parts:
+        return fpath
+    i = len( parts )-1-parts[::-1].index( shard_name )
+    return os.path.join( outdir, *parts[i+1:] )
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser( description='Plan or merge a sharded sweep' )
+    sub = parser.add_subparsers( dest='command' )
+    p = sub.add_parser( 'merge', help='merge shard directories into one output directory' )
+    p.add_argument( 'outdir' )
+    p.add_argument( 'shard_dirs', nargs='+' )
+    p = sub.add_parser( 'plan', help='print the shard sizes for the TEPCat planets' )
+    p.add_argument( '--nshards', type=int, required=True )
+    p.add_argument( '--inst-modes', nargs='+', default='all' )
+    p.add_argument( '--manifests', nargs='+', default=None, help='earlier manifests for balancing' )
+    args = parser.parse_args()
+    if args.command=='merge':
+        merge( args.shard_dirs, args.outdir )
+    elif args.command=='plan':
+        import tepcat, jwstsim, batch
+        z = tepcat.load( download_latest=False, quiet=True )
+        costs = None
+        if args.manifests is not None:
+            costs = schedule.estimate_costs( args.manifests )
+        tasks = batch.list_tasks( z['names'], jwstsim.get_inst_modes( args.inst_modes ) )
+        plan( tasks, args.nshards, costs=costs )
+    else:
+        parser.print_help()
@@ -0,0 +1,224 @@
+from __future__ import print_function
+import os, pdb, sys, glob, json, tempfile
+import numpy as np
+
+"""
+Compact result store for simulated noise spectra, used in place of writing
+two small text files per simulation. All spectra are appended to a single
+store directory containing:
+
+  chunk_NNNNNN.npy --> 2xN arrays of [ wavelength (micron), noise (ppm) ]
+                       with many spectra concatenated along the second axis
+  index.jsonl      --> one line per spectrum giving its planet, label, chunk,
+                       start/stop columns and observation parameters
+
+Spectra are keyed by planet and label, where the label is the output file
+name stem used by jwstsim (e.g. 'NIRSpec-G395H' or 'NIRSpec-G140M-F100LP').
+If the same key is appended more than once, the latest entry is used. The
+store should only be written by one process at a time.
+"""
+
+CHUNK_POINTS = 500000 # number of wavelength points buffered per chunk
+
+
+class ResultStore( object ):
+    """
+    Buffered writer and random-access reader for a result store directory.
+    """
+
+    def __init__( self, sdir, chunk_points=CHUNK_POINTS ):
+        self.sdir = sdir
+        self.chunk_points = chunk_points
+        if os.path.isdir( sdir )==False:
+            os.makedirs( sdir )
+        self.index_path = os.path.join( sdir, 'index.jsonl' )
+        self.index = read_index( self.index_path )
+        chunks = glob.glob( os.path.join( sdir, 'chunk_*.npy' ) )
+        if len( chunks )>0:
+            self.nchunks = max( [ int( os.path.basename( c )[6:12] ) for c in chunks ] )+1
+        else:
+            self.nchunks = 0
+        self.buffer = []
+        self.nbuffered = 0
+        self.loaded = {}
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.flush()
+
+    def __len__( self ):
+        return len( self.index )
+
+    def __contains__( self, key ):
+        return key in self.index
+
+    def keys( self ):
+        """
+        Returns the list of [ planet, label ] keys in the store.
+        """
+        return [ [ e['planet'], e['label'] ] for e in self.index.values() ]
+
+    def append( self, planet, label, wave, error, obspar={} ):
+        """
+        Buffers a spectrum for writing. Returns True if the buffer was
+        flushed to disk by this call.
+        """
+        outp = np.vstack( [ np.asarray( wave, dtype=float ), np.asarray( error, dtype=float ) ] )
+        self.buffer += [ [ planet, label, outp, obspar ] ]
+        self.nbuffered += outp.shape[1]
+        if self.nbuffered>=self.chunk_points:
+            self.flush()
+            return True
+        return False
+
+    def extend( self, items ):
+        """
+        Buffers a list of [ planet, label, wave, error, obspar ] spectra.
+        """
+        for item in items:
+            self.append( *item )
+        return None
+
+    def flush( self ):
+        """
+        Writes the buffered spectra to a new chunk file and appends their
+        entries to the index. The chunk is written before the index, so
+        the index never refers to data that is not on disk.
+        """
+        if len( self.buffer )==0:
+            return None
+        chunk = self.nchunks
+        data = np.hstack( [ b[2] for b in self.buffer ] )
+        cpath = get_chunkpath( self.sdir, chunk )
+        fd, tmppath = tempfile.mkstemp( dir=self.sdir, prefix='.tmp-', suffix='.npy' )
+        with os.fdopen( fd, 'wb' ) as f:
+            np.save( f, data )
+        os.replace( tmppath, cpath )
+        start = 0
+        lines = []
+        for planet, label, outp, obspar in self.buffer:
+            stop = start+outp.shape[1]
+            entry = { 'key':get_key( planet, label ), 'planet':planet, 'label':label, \
+                      'chunk':chunk, 'start':start, 'stop':stop, 'obspar':obspar }
+            self.index[entry['key']] = entry
+            lines += [ json.dumps( entry ) ]
+            start = stop
+        with open( self.index_path, 'a' ) as f:
+            f.write( '\n'.join( lines )+'\n' )
+            f.flush()
+            os.fsync( f.fileno() )
+        self.nchunks += 1
+        self.buffer = []
+        self.nbuffered = 0
+        return None
+
+    def get( self, planet, label ):
+        """
+        Returns the wavelength array, noise array and observation parameters
+        dictionary for the specified spectrum. Chunks are memory-mapped and
+        only the requested columns are read.
+        """
+        entry = self.index[get_key( planet, label )]
+        chunk = entry['chunk']
+        if chunk not in self.loaded:
+            self.loaded[chunk] = np.load( get_chunkpath( self.sdir, chunk ), mmap_mode='r' )
+        outp = np.array( self.loaded[chunk][:,entry['start']:entry['stop']] )
+        return outp[0], outp[1], entry['obspar']
+
+
+def get_key( planet, label ):
+    """
+    Returns the string identifying a spectrum in the store.
+    """
+    return '{0}/{1}'.format( planet, label )
+
+
+def get_chunkpath( sdir, chunk ):
+    """
+    Returns the path of a chunk file.
+    """
+    return os.path.join( sdir, 'chunk_{0:06d}.npy'.format( chunk ) )
+
+
+def read_index( fpath ):
+    """
+    Reads a store index, returning a dictionary of the latest entry for
+    each key. Incomplete final lines are ignored.
+    """
+    index = {}
+    if os.path.isfile( fpath )==False:
+        return index
+    with open( fpath, 'r' ) as f:
+        for line in f:
+            try:
+                entry = json.loads( line )
+            except ValueError:
+                continue
+            index[entry['key']] = entry
+    return index
+
+
+def convert_txt( outdir, sdir, chunk_points=CHUNK_POINTS ):
+    """
+    Copies the <planet>/<label>.txt and <planet>/<label>.obspar.txt files
+    written by jwstsim under outdir into the result store sdir. Returns
+    the number of spectra converted.
+    """
+    n = 0
+    with ResultStore( sdir, chunk_points=chunk_points ) as store:
+        for ipath in sorted( glob.glob( os.path.join( outdir, '*', '*.txt' ) ) ):
+            if ipath.endswith( '.obspar.txt' ):
+                continue
+            planet = os.path.basename( os.path.dirname( ipath ) )
+            label = os.path.basename( ipath )[:-len( '.txt' )]
+            outp = np.loadtxt( ipath, ndmin=2 )
+            opath = ipath.replace( '.txt', '.obspar.txt' )
+            if os.path.isfile( opath ):
+                obspar = parse_obspar( opath )
+            else:
+                obspar = {}
+            store.append( planet, label, outp[:,0], outp[:,1], obspar )
+            n += 1
+    print( 'Converted {0} spectra from {1} to {2}'.format( n, outdir, sdir ) )
+    return n
+
+
+def parse_obspar( fpath ):
+    """
+    Parses an .obspar.txt file written by jwstsim.save_obspar() into the
+    dictionary format returned by jwstsim.get_obspar().
+    """
+    with open( fpath, 'r' ) as f:
+        lines = f.read().split( '\n' )
+    obspar = { 'saturated':( lines[0].strip()=='SATURATED' ), \
+               'warnings':{}, 'setup':{}, 'timing':{} }
+    section = None
+    key = None
+    for line in lines[1:]:
+        if line.startswith( 50*'-' ):
+            line = line[50:] # section underline, not always followed by a newline
+        if line=='WARNINGS':
+            section = 'warnings'
+        elif line=='SETUP':
+            section = 'setup'
+        elif line=='EXPOSURES':
+            section = 'timing'
+        elif section=='warnings':
+            if line.startswith( '*** ' ):
+                key = line[4:]
+                obspar['warnings'][key] = ''
+            elif line.startswith( '--> ' ):
+                obspar['warnings'][key] = line[4:]
+            elif ( key is not None )*( len( line )>0 ):
+                obspar['warnings'][key] += '\n'+line # multi-line warning
+        elif ( section is not None )*( ':  ' in line ):
+            k, v = line.split( ':  ', 1 )
+            if section=='timing':
+                try:
+                    v = float( v )
+                except ValueError:
+                    pass
+            obspar[section][k] = v
+    return obspar
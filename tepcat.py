@@ -1,13 +1,11 @@
 from __future__ import print_function
-import pdb, sys, os
+import pdb, sys, os, time, hashlib, shutil, tempfile, json, socket, itertools
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 try:
-    # For Python 3.0 and later:
-    from urllib.request import urlopen
-    from urllib.error import URLError
+    from . import profiling
 except ImportError:
-    # For earlier Python:
-    from urllib2 import urlopen, URLError
+    import profiling
 
 HPLANCK_SI = 6.62607e-34 # planck's constant in J*s
 C_SI = 2.99792e8 # speed of light in vacuum in m s^-1
@@ -22,120 +20,157 @@ AU_SI = 1.49598e11 # au to metres conversion factor
 RGAS_SI = 8.314 # gas constant in J mol^-1 K^-1
 MUJUP_SI = 2.22e-3 # jupiter atmosphere mean molecular weight in kg mole^-1
 
-def load( download_latest=True, quiet=False ):
+REF_PLANET = 'WASP-121' # planet used to normalise the signal metrics
+KBAND_UM = 2.2 # reference wavelength of the K magnitudes in micron
+
+# Constant factors of the Planck function, B = PLANCK_C1/( wav**5 )/( exp( PLANCK_C2/wav/T )-1 ):
+PLANCK_C1 = 2*HPLANCK_SI*( C_SI**2. )
+PLANCK_C2 = HPLANCK_SI*C_SI/KB_SI
+GRID_CHUNK = 10000 # number of planets evaluated at a time by the grid routines
+
+# TEPCat tables as [ remote file name, local file name ]:
+TEPCAT_URL = 'http://www.astro.keele.ac.uk/jkt/tepcat/'
+TEPCAT_TABLES = [ [ 'observables.txt', 'tepcat1.txt' ], \
+                  [ 'allplanets-ascii.txt', 'tepcat2.txt' ] ]
+DOWNLOAD_TIMEOUT = 10 # seconds per attempt
+DOWNLOAD_RETRIES = 2 # additional attempts after a failed download
+
+# Derived catalogue cache; the key depends on the following constants:
+CACHE_DIR = '.tepcat_cache'
+CACHE_VERSION = 3 # increment if the derived quantities change
+CACHE_CONSTANTS = [ 'HPLANCK_SI', 'C_SI', 'KB_SI', 'G_SI', 'DAY_SI', 'RSUN_SI', \
+                    'MSUN_SI', 'RJUP_SI', 'MJUP_SI', 'AU_SI', 'RGAS_SI', \
+                    'MUJUP_SI', 'REF_PLANET' ]
+
+# Whitespace-delimited column indices of the quantities read from each
+# TEPCat table (note that RA and Dec each span three columns in tepcat1.txt):
+TEPCAT1_COLUMNS = [ [ 'names', 0, 'U32' ], \
+                    [ 'vmags', 8, 'f8' ], \
+                    [ 'kmags', 9, 'f8' ], \
+                    [ 'tdurs', 10, 'f8' ], \
+                    [ 'tdepths', 11, 'f8' ], \
+                    [ 'periods', 14, 'f8' ] ]
+TEPCAT2_COLUMNS = [ [ 'names', 0, 'U32' ], \
+                    [ 'tstar', 1, 'f8' ], \
+                    [ 'metalstar', 2, 'f8' ], \
+                    [ 'mstar', 7, 'f8' ], \
+                    [ 'rstar', 10, 'f8' ], \
+                    [ 'loggstar', 11, 'f8' ], \
+                    [ 'ecc', 20, 'f8' ], \
+                    [ 'a', 23, 'f8' ], \
+                    [ 'mplanet', 26, 'f8' ], \
+                    [ 'rplanet', 29, 'f8' ], \
+                    [ 'littleg', 32, 'f8' ], \
+                    [ 'rhoplanet', 35, 'f8' ], \
+                    [ 'tplanet_tepcat', 38, 'f8' ] ]
+
+# Fields of the catalogue dictionary returned by load():
+TEPCAT_KEYS = [ 'names', 'a', 'aRs', 'periods', 'mplanet', 'RpRs', 'mstar', 'rstar', \
+                'loggstar', 'rplanet', 'tstar', 'metalstar', 'tplanet', 'kmags', 'vmags', \
+                'littleg', 'rhoplanet', 'tdurs', 'tdepths', 'hdepth', 'hatm', 'sn_tr', 'sn_em', \
+                'ecc' ]
+
+def load( download_latest=True, quiet=False, on_missing='drop', cache=False, \
+          cache_dir=None ):
     """
     Routine called by the run_jwst.py script to load the TEPCat catalogues into
     a format that can be used by the routines in the jwstsim.py module.
+
+    The on_missing argument sets what happens to planets in tepcat2.txt that
+    have no entry in tepcat1.txt (see the merge() routine).
+
+    If cache is True, the final catalogue is saved to a binary cache in
+    cache_dir (default is CACHE_DIR in the working directory) and memory-mapped
+    on subsequent calls, provided the TEPCat tables, physical constants,
+    reference planet and on_missing setting are all unchanged. The cached
+    arrays are copy-on-write: they can be modified like the uncached ones,
+    but the changes are not saved back to the cache.
     """
 
-    if internet_on() and download_latest==True:
-        print("TEPCat connection successful: Downloading latest tables")
-        download_tables()
-    elif not internet_on():
-        print("No internet connection to TEPCat: Using saved tables")
+    if download_latest==True:
+        with profiling.stage( 'download' ):
+            # Quick probe first, so that an offline load does not wait for
+            # the download timeouts and retries:
+            status = { 'probe':'failed' }
+            if internet_on():
+                status = download_tables()
+        if 'failed' in status.values():
+            print("No connection to TEPCat: Using saved tables")
+        else:
+            print("TEPCat connection successful: Tables are up to date")
     else:
         print("Download not requested: Using saved tables")
 
+    fpaths = [ 'tepcat1.txt', 'tepcat2.txt' ]
+    if cache==True:
+        with profiling.stage( 'cache_read' ):
+            key = cache_key( fpaths, on_missing=on_missing )
+            tepcat = read_cache( key, cache_dir=cache_dir )
+        if tepcat is not None:
+            if quiet==False: print( '\nFinished reading TEPCat (cached).\n' )
+            return tepcat
+
+    # Read contents of both tepcat files into structured arrays:
+    with profiling.stage( 'parse' ):
+        cat1 = read_tepcat1( fpaths[0] )
+        cat2 = read_tepcat2( fpaths[1] )
+    if quiet==False:
+        for i in range( len( cat1 ) ):
+            print( cat1['names'][i], cat1['periods'][i] )
 
-    # Read contents of the first tepcat file into numpy arrays:
-    ifile1 = open( 'tepcat1.txt', 'r' )
-    header1 = ifile1.readline() # skip first header line
-    names1 = []
-    vmags1 = []
-    kmags1 = []
-    tdurs1 = []
-    tdepths1 = []
-    periods1 = []
-    for line in ifile1:
-        z = line.split()
-        names1 += [ str( z[0] ) ]
-        vmags1 += [ float( z[8] ) ]
-        kmags1 += [ float( z[9] ) ]
-        tdurs1 += [ float( z[10] ) ]
-        tdepths1 += [ float( z[11] ) ]
-        periods1 += [ float( z[14] ) ]
-        if quiet==False: print( names1[-1], periods1[-1] )
-    ifile1.close()
-    names1 = np.array( names1 )
-    vmags1 = np.array( vmags1 )
-    kmags1 = np.array( kmags1 )
-    tdurs1 = np.array( tdurs1 )
-    tdepths1 = np.array( tdepths1 )
-    periods1 = np.array( periods1 )
-    # Read contents of the second tepcat file into numpy arrays:
-    ifile2 = open( 'tepcat2.txt', 'r' )
-    ifile2.seek( 0 )
-    header2 = ifile2.readline() # skip first header line
-    names2 = []
-    tstar = []
-    metalstar = []
-    mstar = []
-    rstar = []
-    loggstar = []
-    a = []
-    mplanet = []
-    rplanet = []
-    littleg = []    
-    rhoplanet = []
-    tplanet_tepcat = []
-    for line in ifile2:
-        z = line.split()
-        mstar_i = float( z[7] )
-        rstar_i = float( z[10] )
-        loggstar_i = float( z[11] )
-        mplanet_i = float( z[26] )
-        rplanet_i = float( z[29] )
-        littleg_i = float( z[32] )
-        rhoplanet_i = float( z[35] )
-        if ( mstar_i>0 )*( rstar_i>0 )*( mplanet_i>0 )*( rplanet_i>0 ):
-            names2 += [ str( z[0] ) ]
-            tstar += [ float( z[1] ) ]
-            metalstar += [ float( z[2] ) ]
-            mstar += [ mstar_i ]
-            rstar += [ rstar_i ]
-            loggstar += [ loggstar_i ]
-            a += [ float( z[23] ) ]
-            mplanet += [ mplanet_i ]
-            rplanet += [ rplanet_i ]
-            littleg += [ littleg_i ]
-            rhoplanet += [ rhoplanet_i ]
-            tplanet_tepcat += [ float( z[38] ) ]
-    ifile2.close()
-    names2 = np.array( names2 )
-    tstar = np.array( tstar )
-    metalstar = np.array( metalstar )
-    mstar = np.array( mstar )
-    rstar = np.array( rstar )
-    loggstar = np.array( loggstar )
-    a = np.array( a )
-    mplanet = np.array( mplanet )
-    rplanet = np.array( rplanet )
-    littleg = np.array( littleg )
-    rhoplanet = np.array( rhoplanet )
-    tplanet_tepcat = np.array( tplanet_tepcat )
     # Merge the two catalogues:
     if quiet==False: print( 'Merging both catalogues:' )
-    n = len( names2 )
-    m = len( names1 )
-    names = names2
-    vmags = np.zeros( n )
-    kmags = np.zeros( n )
-    tdurs = np.zeros( n )
-    tdepths = np.zeros( n )
-    periods = np.zeros( n )
-    for i in range( n ):
-        for j in range( m ):
-            if names[i]==names1[j]:
-                vmags[i] = vmags1[j]
-                kmags[i] = kmags1[j]
-                tdurs[i] = tdurs1[j]
-                tdepths[i] = tdepths1[j]
-                periods[i] = periods1[j]
-                if quiet==False: print( '... matched {0} --> {1}'.format( names[i], names1[j] ) )
-                break
-        if j==m-1:
-            print( 'Could not match {0}!'.format( names[i] ) )
-            pdb.set_trace()
+    with profiling.stage( 'merge' ):
+        cat, unmatched = merge( cat2, cat1, on_missing=on_missing, quiet=quiet )
+    with profiling.stage( 'derive' ):
+        tepcat = derive( cat )
+    if cache==True:
+        with profiling.stage( 'cache_write' ):
+            write_cache( key, tepcat, cache_dir=cache_dir )
+
+    print( '\nFinished reading TEPCat.\n' )
+    return tepcat
+
+
+def derive( cat ):
+    """
+    Computes the derived quantities for a merged TEPCat structured array,
+    restricts to planets with reliable brightnesses and returns a dictionary
+    of arrays sorted in order of decreasing transmission signal.
+    """
+    derived = derive_chunk( cat, reference_values( cat ) )
+    # Restrict to those with reliable brightnesses and sort in order of
+    # decreasing transmission signal, copying each column only once:
+    ixs = np.flatnonzero( ( derived['vmags']>0 )*( derived['kmags']>0 ) )
+    ixs = ixs[np.argsort( derived['sn_tr'][ixs] )[::-1]]
+    tepcat = {}
+    for k in TEPCAT_KEYS:
+        tepcat[k] = derived[k][ixs]
+    return tepcat
+
+
+def derive_chunk( cat, ref ):
+    """
+    Computes the derived quantities for the rows of a merged TEPCat structured
+    array, returning a dictionary of arrays in the same row order without any
+    filtering. The signal metrics are normalised using the reference planet
+    values ref returned by reference_values(), so that the catalogue can be
+    processed in chunks.
+    """
+    names = cat['names']
+    tstar = cat['tstar']
+    metalstar = cat['metalstar']
+    mstar = cat['mstar']
+    rstar = cat['rstar']
+    loggstar = cat['loggstar']
+    mplanet = cat['mplanet']
+    rplanet = cat['rplanet']
+    vmags = cat['vmags']
+    kmags = cat['kmags']
+    tdurs = cat['tdurs']
+    tdepths = cat['tdepths']
+    periods = cat['periods']
+    ecc = cat['ecc'] # -1 where not given
 
     littleg = G_SI*mplanet*MJUP_SI/( ( rplanet*RJUP_SI )**2. )
     volplanet = ( (4*np.pi/3.)*( ( rplanet*RJUP_SI )**3. ) )
@@ -150,66 +185,340 @@ def load( download_latest=True, quiet=False ):
     ##############################################
     # Calculate and normalise the thermal signal assuming
     # planet radiates as blackbody at equilibrium temperature:
-    nearir_um = 2.2
+    nearir_um = KBAND_UM
     ecdepth_nearir = calc_ecdepth( tplanet, tstar, RpRs, nearir_um )
-    ix = ( names=='WASP-121' )
-    tref = tstar[ix]
-    kref = kmags[ix]
+    if ref is None:
+        return { 'tstar':tstar, 'kmags':kmags, 'ecdepth_nearir':ecdepth_nearir }
+    tref = ref['tstar']
+    kref = ref['kmags']
     fratios_nearir = calc_fratio( nearir_um, tstar, kmags, tref, kref )
     sn_em = ecdepth_nearir*np.sqrt( fratios_nearir )
-    sn_em /= sn_em[ix]
+    sn_em /= ref['ecdepth_nearir']
 
     # Calculate and normalise the transmission signal
     # assuming a hydrogen-dominated atmosphere:
     hatm = RGAS_SI*tplanet/MUJUP_SI/littleg
     hdepth = 2*hatm*(rplanet*RJUP_SI)/( ( rstar*RSUN_SI )**2. )
-    ix = ( names=='WASP-121' )
-    dkmag = kmags-kmags[ix]
+    dkmag = kmags-kref
     fratio = 10**( -dkmag/2.5 )
     sn_tr = hdepth*np.sqrt( fratio )
     ##############################################
 
-    ixs = ( vmags>0 )*( kmags>0 ) # restrict to those with reliable brightnesses
-    tepcat = {}
-    tepcat['names'] = names[ixs]
-    tepcat['a'] = a[ixs]
-    tepcat['aRs'] = aRs[ixs]
-    tepcat['periods'] = periods[ixs]
-    tepcat['mplanet'] = mplanet[ixs]
-    tepcat['RpRs'] = RpRs[ixs]
-    tepcat['mstar'] = mstar[ixs]
-    tepcat['rstar'] = rstar[ixs]
-    tepcat['loggstar'] = loggstar[ixs]
-    tepcat['rplanet'] = rplanet[ixs]
-    tepcat['tstar'] = tstar[ixs]
-    tepcat['metalstar'] = metalstar[ixs]
-    tepcat['tplanet'] = tplanet[ixs]
-    tepcat['rplanet'] = rplanet[ixs]
-    tepcat['kmags'] = kmags[ixs]
-    tepcat['vmags'] = vmags[ixs]
-    tepcat['littleg'] = littleg[ixs]
-    tepcat['rhoplanet'] = rhoplanet[ixs]
-    tepcat['tdurs'] = tdurs[ixs]
-    tepcat['tdepths'] = tdepths[ixs]
-    tepcat['hdepth'] = hdepth[ixs]
-    tepcat['hatm'] = hatm[ixs]
-    tepcat['sn_tr'] = sn_tr[ixs]
-    tepcat['sn_em'] = sn_em[ixs]
-
-    # Sort in order of decreasing transmission signal:
-    ixs = np.argsort( tepcat['sn_tr'] )
+    derived = { 'names':names, 'a':a, 'aRs':aRs, 'periods':periods, 'mplanet':mplanet, \
+                'RpRs':RpRs, 'mstar':mstar, 'rstar':rstar, 'loggstar':loggstar, \
+                'rplanet':rplanet, 'tstar':tstar, 'metalstar':metalstar, 'tplanet':tplanet, \
+                'kmags':kmags, 'vmags':vmags, 'littleg':littleg, 'rhoplanet':rhoplanet, \
+                'tdurs':tdurs, 'tdepths':tdepths, 'hdepth':hdepth, 'hatm':hatm, \
+                'sn_tr':sn_tr, 'sn_em':sn_em, 'ecc':ecc }
+    return derived
+
+
+def reference_values( cat ):
+    """
+    Returns the REF_PLANET stellar temperature, K magnitude and near-IR
+    eclipse depth used to normalise the signal metrics.
+    """
+    ix = np.flatnonzero( cat['names']==REF_PLANET )
+    if len( ix )==0:
+        raise ValueError( 'Reference planet {0} not in catalogue'.format( REF_PLANET ) )
+    ref = derive_chunk( cat[ix[:1]], None )
+    for k in list( ref.keys() ):
+        ref[k] = ref[k][0]
+    return ref
+
+
+def iterate( fpaths=[ 'tepcat1.txt', 'tepcat2.txt' ], chunk_size=100000, on_missing='drop' ):
+    """
+    Generator yielding the catalogue in chunks of up to chunk_size rows of
+    the second table, each as a dictionary of arrays in the same format as
+    load() returns, restricted to planets with reliable brightnesses but not
+    sorted. Only the join columns of the first table and one chunk of the
+    second table are held in memory at a time, so arbitrarily large merged
+    catalogues can be processed with bounded memory.
+    """
+    cat1 = read_tepcat1( fpaths[0] )
+    ref = None
+    with open( fpaths[1], 'r' ) as f:
+        f.readline() # skip first header line
+        for line in f:
+            if line.strip()=='':
+                continue # skip blank lines
+            if line.split( None, 1 )[0]==REF_PLANET:
+                row = filter_tepcat2( read_table( [ line ], TEPCAT2_COLUMNS, skiprows=0 ) )
+                ref = reference_values( merge( row, cat1, on_missing='raise', quiet=True )[0] )
+                break
+    if ref is None:
+        raise ValueError( 'Reference planet {0} not in catalogue'.format( REF_PLANET ) )
+    with open( fpaths[1], 'r' ) as f:
+        f.readline() # skip first header line
+        while True:
+            lines = list( itertools.islice( f, chunk_size ) )
+            if len( lines )==0:
+                break
+            lines = [ l for l in lines if l.strip()!='' ]
+            if len( lines )==0:
+                continue
+            cat2 = filter_tepcat2( read_table( lines, TEPCAT2_COLUMNS, skiprows=0 ) )
+            cat, unmatched = merge( cat2, cat1, on_missing=on_missing, quiet=True )
+            derived = derive_chunk( cat, ref )
+            ixs = ( derived['vmags']>0 )*( derived['kmags']>0 )
+            chunk = {}
+            for k in TEPCAT_KEYS:
+                chunk[k] = derived[k][ixs]
+            yield chunk
+
+
+def top_k( k, metric='sn_tr', fpaths=[ 'tepcat1.txt', 'tepcat2.txt' ], chunk_size=100000, \
+           on_missing='drop' ):
+    """
+    Returns the k planets with the highest value of metric ( 'sn_tr' or
+    'sn_em' ) as a dictionary of arrays sorted in decreasing order, streaming
+    the catalogue with iterate(). At most k+chunk_size rows are held in memory
+    and np.argpartition is used to keep the running top k without a full sort.
+    Returns None if k<=0 or there are no planets.
+    """
+    if k<=0:
+        return None
+    best = None
+    for chunk in iterate( fpaths=fpaths, chunk_size=chunk_size, on_missing=on_missing ):
+        if best is not None:
+            for key in TEPCAT_KEYS:
+                chunk[key] = np.concatenate( [ best[key], chunk[key] ] )
+        n = len( chunk[metric] )
+        kk = min( k, n )
+        if kk<n:
+            ixs = np.argpartition( -chunk[metric], kk-1 )[:kk]
+        else:
+            ixs = np.arange( n )
+        best = {}
+        for key in TEPCAT_KEYS:
+            best[key] = chunk[key][ixs]
+    if best is None:
+        return None
+    ixs = np.argsort( best[metric] )[::-1]
+    for key in TEPCAT_KEYS:
+        best[key] = best[key][ixs]
+    return best
+
+
+def cache_key( fpaths, on_missing='drop' ):
+    """
+    Returns a hash identifying the derived catalogue that would be built from
+    the specified TEPCat tables, given the current physical constants and
+    reference planet.
+    """
+    h = hashlib.sha1()
+    h.update( 'version={0}\n'.format( CACHE_VERSION ).encode( 'utf-8' ) )
+    for fpath in fpaths:
+        with open( fpath, 'rb' ) as f:
+            h.update( hashlib.sha1( f.read() ).hexdigest().encode( 'utf-8' ) )
+    for k in CACHE_CONSTANTS:
+        h.update( '{0}={1!r}\n'.format( k, globals()[k] ).encode( 'utf-8' ) )
+    h.update( 'on_missing={0}\n'.format( on_missing ).encode( 'utf-8' ) )
+    return h.hexdigest()
+
+def get_cache_dir( cache_dir=None ):
+    """
+    Returns the path of the TEPCat cache directory.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join( os.getcwd(), CACHE_DIR )
+    return cache_dir
+
+def read_cache( key, cache_dir=None ):
+    """
+    Returns the cached catalogue for the specified key as a dictionary of
+    copy-on-write memory-mapped arrays, or None if there is no such entry.
+    """
+    edir = os.path.join( get_cache_dir( cache_dir ), key )
+    if os.path.isdir( edir )==False:
+        return None
+    try:
+        with open( os.path.join( edir, 'keys.txt' ), 'r' ) as f:
+            keys = f.read().split()
+        tepcat = {}
+        for k in keys:
+            tepcat[k] = np.load( os.path.join( edir, '{0}.npy'.format( k ) ), mmap_mode='c' )
+    except ( IOError, OSError, ValueError ):
+        print( 'Could not read TEPCat cache entry {0} - rebuilding'.format( key ) )
+        return None
+    return tepcat
+
+def write_cache( key, tepcat, cache_dir=None ):
+    """
+    Saves a catalogue to the cache as a directory of .npy files, one per
+    field. The entry is written to a temporary directory first and renamed
+    into place, so readers never see a partially written entry.
+    """
+    cdir = get_cache_dir( cache_dir )
+    if os.path.isdir( cdir )==False:
+        os.makedirs( cdir )
+    edir = os.path.join( cdir, key )
+    tmpdir = tempfile.mkdtemp( dir=cdir, prefix='.tmp-' )
     keys = list( tepcat.keys() )
     for k in keys:
-        tepcat[k] = tepcat[k][ixs][::-1]
+        np.save( os.path.join( tmpdir, '{0}.npy'.format( k ) ), np.asarray( tepcat[k] ) )
+    with open( os.path.join( tmpdir, 'keys.txt' ), 'w' ) as f:
+        f.write( '\n'.join( keys ) )
+    try:
+        os.rename( tmpdir, edir )
+    except OSError:
+        # Another process got there first:
+        shutil.rmtree( tmpdir )
+    return edir
 
-    print( '\nFinished reading TEPCat.\n' )
-    return tepcat
+def cache_info( cache_dir=None ):
+    """
+    Prints and returns a list of [ key, size_bytes, mtime ] entries for the
+    TEPCat cache.
+    """
+    cdir = get_cache_dir( cache_dir )
+    entries = []
+    if os.path.isdir( cdir ):
+        for key in sorted( os.listdir( cdir ) ):
+            edir = os.path.join( cdir, key )
+            if ( key.startswith( '.' ) )+( os.path.isdir( edir )==False ):
+                continue
+            fnames = os.listdir( edir )
+            size = sum( [ os.path.getsize( os.path.join( edir, f ) ) for f in fnames ] )
+            entries += [ [ key, size, os.path.getmtime( edir ) ] ]
+    print( 'TEPCat cache {0}: {1} entries'.format( cdir, len( entries ) ) )
+    for e in entries:
+        print( '... {0}  {1:.1f} kB  {2}'.format( e[0], e[1]/1024., time.ctime( e[2] ) ) )
+    return entries
+
+def clear_cache( cache_dir=None ):
+    """
+    Deletes the TEPCat cache directory.
+    """
+    cdir = get_cache_dir( cache_dir )
+    if os.path.isdir( cdir ):
+        shutil.rmtree( cdir )
+        print( 'Cleared TEPCat cache {0}'.format( cdir ) )
+    return None
+
+
+def read_table( fpath, columns, skiprows=1 ):
+    """
+    Reads the specified columns of a whitespace-delimited TEPCat table into
+    a numpy structured array in a single pass. The columns argument is a
+    list of [ field_name, column_index, dtype ] entries and by default the
+    first line of the file is assumed to be a header. fpath can also be a
+    list of lines.
+    """
+    dtype = np.dtype( [ ( c[0], c[2] ) for c in columns ] )
+    usecols = [ c[1] for c in columns ]
+    table = np.loadtxt( fpath, dtype=dtype, usecols=usecols, skiprows=skiprows, \
+                        comments=None, ndmin=1 )
+    return table
+
+def read_tepcat1( fpath='tepcat1.txt' ):
+    """
+    Reads the 'For planning observations' TEPCat table.
+    """
+    return read_table( fpath, TEPCAT1_COLUMNS )
+
+def read_tepcat2( fpath='tepcat2.txt' ):
+    """
+    Reads the 'Well-studied transiting planets' TEPCat table, retaining
+    only those systems with positive stellar and planetary masses and radii.
+    """
+    return filter_tepcat2( read_table( fpath, TEPCAT2_COLUMNS ) )
+
+def filter_tepcat2( table ):
+    """
+    Restricts a tepcat2 structured array to systems with positive stellar
+    and planetary masses and radii.
+    """
+    ixs = ( table['mstar']>0 )*( table['rstar']>0 )\
+          *( table['mplanet']>0 )*( table['rplanet']>0 )
+    return table[ixs]
+
+def merge( cat2, cat1, fields=[ 'vmags', 'kmags', 'tdurs', 'tdepths', 'periods' ], \
+           on_missing='drop', quiet=False ):
+    """
+    Joins the specified fields of the cat1 structured array onto the rows of
+    the cat2 structured array by matching the 'names' field. Names are matched
+    by sorting cat1 and doing a binary search for each cat2 name, so the cost
+    scales as O( (n+m)log(m) ) rather than O( n*m ). If a name occurs more than
+    once in cat1, the first occurrence is used.
+
+    Rows of cat2 without a match in cat1 are handled according to on_missing:
+      'drop' --> remove the row from the output
+      'nan' --> keep the row with the cat1 fields set to NaN
+      'raise' --> raise a ValueError listing the unmatched names
+
+    Returns the merged structured array and an array of unmatched names.
+    """
+    if on_missing not in [ 'drop', 'nan', 'raise' ]:
+        raise ValueError( 'on_missing must be one of drop, nan or raise' )
+    names1 = cat1['names']
+    names2 = cat2['names']
+    n = len( names2 )
+    m = len( names1 )
+    # Locate each cat2 name in the sorted cat1 names:
+    isort = np.argsort( names1, kind='mergesort' )
+    ixs = np.searchsorted( names1[isort], names2, side='left' )
+    ixs = np.clip( ixs, 0, max( [ m-1, 0 ] ) )
+    if m>0:
+        jmatch = isort[ixs]
+        matched = ( names1[jmatch]==names2 )
+    else:
+        jmatch = np.zeros( n, dtype=int )
+        matched = np.zeros( n, dtype=bool )
+    unmatched = names2[~matched]
+    nmatched = matched.sum()
+    if ( quiet==False )+( nmatched<n ):
+        print( 'Matched {0} of {1} planets ({2} unmatched)'.format( nmatched, n, n-nmatched ) )
+    if quiet==False:
+        for name in unmatched:
+            print( '... could not match {0}'.format( name ) )
+    if ( on_missing=='raise' )*( n>nmatched ):
+        raise ValueError( 'Could not match {0}'.format( ', '.join( unmatched ) ) )
+
+    # Build the merged array:
+    dtype = cat2.dtype.descr + [ ( k, cat1.dtype[k] ) for k in fields ]
+    merged = np.empty( n, dtype=dtype )
+    for k in cat2.dtype.names:
+        merged[k] = cat2[k]
+    for k in fields:
+        merged[k] = cat1[k][jmatch]
+        if on_missing=='nan':
+            merged[k][~matched] = np.nan
+    if on_missing=='drop':
+        merged = merged[matched]
+    return merged, unmatched
 
 
 def calc_teq( tstar, aRs, Ab=0, fprime=0.25 ):
     redist = fprime*( 1-Ab )
     return tstar*( np.sqrt( 1./aRs ) )*( redist**0.25 )
 
+def calc_inclination( tdurs, periods, aRs, RpRs, ecc=0, w_deg=90, return_clamped=False ):
+    """
+    Returns the orbital inclination in degrees implied by the total transit
+    duration tdurs and period (both in days), the scaled semimajor axis aRs
+    and the radius ratio RpRs, for an orbit with eccentricity ecc and argument
+    of periastron w_deg (degrees). Uses the Seager & Mallen-Ornelas (2003)
+    duration relation, with the duration scaled to the equivalent circular
+    orbit. Where the duration is longer than a central transit allows, the
+    inclination is set to 90 degrees; where no inclination can produce the
+    duration (e.g. aRs<1+RpRs), NaN is returned. If return_clamped is True,
+    a boolean array marking the values set to 90 degrees is also returned.
+    """
+    ecc = np.clip( ecc, 0, None ) # treat missing eccentricities (-1) as circular
+    esinw = ecc*np.sin( np.deg2rad( w_deg ) )
+    tcirc = tdurs*( 1+esinw )/np.sqrt( 1-ecc**2. )
+    phi = np.pi*tcirc/periods
+    cos2i = ( ( 1+RpRs )**2.-( aRs*np.sin( phi ) )**2. )/( ( aRs*np.cos( phi ) )**2. )
+    invalid = ( cos2i>1 )+( phi>=0.5*np.pi )
+    clamped = ( cos2i<0 )*( invalid==False )
+    cos2i = np.where( invalid, np.nan, np.clip( cos2i, 0, None ) )
+    incl = np.rad2deg( np.arccos( np.sqrt( cos2i ) ) )
+    if return_clamped==True:
+        return incl, clamped
+    return incl
+
 def calc_ecdepth( tplanet, tstar, RpRs, wav_um ):
     wav_m = wav_um*(1e-6)
     bratio = planck( wav_m, tplanet )/planck( wav_m, tstar )
@@ -222,8 +531,8 @@ def planck( wav_m, temp ):
     and temperature. Wavelength should be provided in metres and
     temperature should be provided in Kelvins.
     """
-    term1 = 2 * HPLANCK_SI * ( C_SI**2. ) / ( wav_m**5. )
-    term2 = np.exp( HPLANCK_SI * C_SI / KB_SI / wav_m / temp ) - 1
+    term1 = PLANCK_C1 / ( wav_m**5. )
+    term2 = np.expm1( PLANCK_C2 / wav_m / temp )
     bbflux = term1 / term2
     return bbflux
 
@@ -237,19 +546,203 @@ def calc_fratio( wav_um, t, kmag, tref, kmagref ):
     termB = 10**( -delk/2.5 )
     return termA*termB
 
-def internet_on():
+def planck_ratio( wav_m, temp1, temp2 ):
+    """
+    Evaluates the ratio of Planck functions B( wav, temp1 )/B( wav, temp2 ),
+    which does not depend on the constant factors. The inputs must be
+    broadcastable against each other.
+    """
+    return expm1_ratio( PLANCK_C2/wav_m/temp2, PLANCK_C2/wav_m/temp1 )
+
+def expm1_ratio( a, b ):
+    """
+    Evaluates expm1( a )/expm1( b ) for positive a and b, rearranged as
+    exp( a-b )*expm1( -a )/expm1( -b ) to avoid overflowing to inf/inf for
+    the large arguments reached at short wavelengths and low temperatures.
+    """
+    with np.errstate( over='ignore' ):
+        return np.exp( a-b )*np.expm1( -a )/np.expm1( -b )
+
+def calc_ecdepth_grid( tplanet, tstar, RpRs, wav_um, dtype=np.float64, chunk_size=GRID_CHUNK ):
+    """
+    Evaluates the blackbody eclipse depths of many planets over a grid of
+    wavelengths, returning an array with shape ( nplanets, nwavelengths ).
+    Planets are processed chunk_size at a time to bound the memory used by
+    temporary arrays, and the output can be returned as float32 by setting
+    dtype=np.float32.
+    """
+    tplanet, tstar, RpRs = [ np.atleast_1d( np.asarray( v, dtype=float ) ) \
+                             for v in [ tplanet, tstar, RpRs ] ]
+    wav_m = np.atleast_1d( np.asarray( wav_um, dtype=float ) )*( 1e-6 )
+    n = len( tplanet )
+    ecdepth = np.empty( [ n, len( wav_m ) ], dtype=dtype )
+    for i in range( 0, n, chunk_size ):
+        s = slice( i, i+chunk_size )
+        bratio = planck_ratio( wav_m[None,:], tplanet[s,None], tstar[s,None] )
+        ecdepth[s,:] = bratio*( RpRs[s,None]**2. )
+    return ecdepth
+
+def calc_fratio_grid( wav_um, t, kmag, tref, kmagref, dtype=np.float64, chunk_size=GRID_CHUNK ):
+    """
+    Grid version of calc_fratio(), returning the stellar flux ratios relative
+    to the reference star for many stars over a grid of wavelengths as an
+    array with shape ( nstars, nwavelengths ). See calc_ecdepth_grid().
+    """
+    t, kmag = [ np.atleast_1d( np.asarray( v, dtype=float ) ) for v in [ t, kmag ] ]
+    wav_m = np.atleast_1d( np.asarray( wav_um, dtype=float ) )*( 1e-6 )
+    k_m = KBAND_UM*( 1e-6 )
+    # Reference star term, B( wav, tref )/B( k, tref ), and K magnitude term:
+    bratioref = planck( wav_m, tref )/planck( k_m, tref )
+    termB = 10**( -( kmag-kmagref )/2.5 )
+    n = len( t )
+    fratio = np.empty( [ n, len( wav_m ) ], dtype=dtype )
+    for i in range( 0, n, chunk_size ):
+        s = slice( i, i+chunk_size )
+        # B( wav, t )/B( k, t ) for each star:
+        x = PLANCK_C2/t[s,None]
+        bratio = ( ( k_m/wav_m[None,:] )**5. )*expm1_ratio( x/k_m, x/wav_m[None,:] )
+        fratio[s,:] = ( bratio/bratioref[None,:] )*termB[s,None]
+    return fratio
+
+def calc_sn_em_grid( tepcat, wav_um, dtype=np.float64, chunk_size=GRID_CHUNK ):
+    """
+    Evaluates the emission signal metric sn_em for every planet in a loaded
+    catalogue over a grid of wavelengths, normalised to REF_PLANET at each
+    wavelength. Returns an array with shape ( nplanets, nwavelengths ).
+    """
+    names = np.asarray( tepcat['names'] )
+    ix = np.flatnonzero( names==REF_PLANET )[0]
+    tplanet, tstar, RpRs, kmags = [ np.asarray( tepcat[k], dtype=float ) \
+                                    for k in [ 'tplanet', 'tstar', 'RpRs', 'kmags' ] ]
+    tref = tstar[ix]
+    kref = kmags[ix]
+    snref = calc_ecdepth_grid( tplanet[ix], tref, RpRs[ix], wav_um )[0]
+    n = len( names )
+    sn_em = np.empty( [ n, np.size( wav_um ) ], dtype=dtype )
+    for i in range( 0, n, chunk_size ):
+        s = slice( i, i+chunk_size )
+        ecdepth = calc_ecdepth_grid( tplanet[s], tstar[s], RpRs[s], wav_um, chunk_size=chunk_size )
+        fratio = calc_fratio_grid( wav_um, tstar[s], kmags[s], tref, kref, chunk_size=chunk_size )
+        sn_em[s,:] = ecdepth*np.sqrt( fratio )/snref[None,:]
+    return sn_em
+
+def internet_on( base_url=TEPCAT_URL, timeout=1 ):
+    """
+    Checks whether the TEPCat server can be reached using a HEAD request,
+    so that no table contents are transferred.
+    """
+    urlopen, Request, URLError, HTTPError = import_urllib()
+    req = Request( base_url+TEPCAT_TABLES[1][0] )
+    req.get_method = lambda: 'HEAD'
     try:
-        urlopen('http://www.astro.keele.ac.uk/jkt/tepcat/allplanets-ascii.txt', timeout=1)
+        urlopen( req, timeout=timeout ).close()
+        return True
+    except HTTPError as err:
+        # The server responded, even if it refused the HEAD request:
         return True
-    except URLError as err:
+    except ( URLError, socket.timeout, IOError ) as err:
         return False
 
-def download_tables():
-    table = urlopen('http://www.astro.keele.ac.uk/jkt/tepcat/observables.txt').read()
-    with open('tepcat1.txt', 'wb') as f:
-        f.write(table)
+def download_tables( base_url=TEPCAT_URL, outdir='.', timeout=DOWNLOAD_TIMEOUT, \
+                     retries=DOWNLOAD_RETRIES ):
+    """
+    Downloads the TEPCat tables concurrently, returning a dictionary with
+    the status of each local file: 'downloaded', 'not modified' or 'failed'.
+
+    Requests are conditional on the ETag/Last-Modified values saved from the
+    previous download, so unchanged tables are not transferred again. Each
+    table is written to a temporary file and renamed into place, so a failed
+    or interrupted download leaves the existing local table untouched.
+    """
+    tables = [ [ base_url+t[0], os.path.join( outdir, t[1] ) ] for t in TEPCAT_TABLES ]
+    with ThreadPoolExecutor( max_workers=len( tables ) ) as pool:
+        futures = [ pool.submit( fetch_table, t[0], t[1], timeout=timeout, \
+                                 retries=retries ) for t in tables ]
+        status = {}
+        for t, f in zip( tables, futures ):
+            status[os.path.basename( t[1] )] = f.result()
+    return status
+
+def fetch_table( url, opath, timeout=DOWNLOAD_TIMEOUT, retries=DOWNLOAD_RETRIES ):
+    """
+    Fetches a single table with a conditional GET, retrying with a linear
+    backoff on connection errors. See download_tables().
+    """
+    urlopen, Request, URLError, HTTPError = import_urllib()
+    hpath = get_headerpath( opath )
+    headers = {}
+    if os.path.isfile( opath ) and os.path.isfile( hpath ):
+        with open( hpath, 'r' ) as f:
+            cached = json.load( f )
+        if cached.get( 'etag' ):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get( 'last_modified' ):
+            headers['If-Modified-Since'] = cached['last_modified']
+    for attempt in range( retries+1 ):
+        if attempt>0:
+            time.sleep( attempt )
+        try:
+            resp = urlopen( Request( url, headers=headers ), timeout=timeout )
+            table = resp.read()
+            info = { 'etag':resp.headers.get( 'ETag' ), \
+                     'last_modified':resp.headers.get( 'Last-Modified' ) }
+            resp.close()
+        except HTTPError as err:
+            if err.code==304:
+                return 'not modified'
+            print( 'Failed to download {0} (HTTP {1})'.format( url, err.code ) )
+            if err.code<500:
+                return 'failed'
+            continue
+        except ( URLError, socket.timeout, IOError ) as err:
+            print( 'Failed to download {0} ({1})'.format( url, err ) )
+            continue
+        atomic_write( opath, table )
+        atomic_write( hpath, json.dumps( info ).encode( 'utf-8' ) )
+        print( 'Downloaded {0} --> {1}'.format( url, opath ) )
+        return 'downloaded'
+    return 'failed'
+
+def import_urllib():
+    """
+    Returns urlopen, Request, URLError and HTTPError, imported on first use
+    so that the catalogue can be read without the cost of importing the
+    HTTP client.
+    """
+    try:
+        # For Python 3.0 and later:
+        from urllib.request import urlopen, Request
+        from urllib.error import URLError, HTTPError
+    except ImportError:
+        # For earlier Python:
+        from urllib2 import urlopen, Request, URLError, HTTPError
+    return urlopen, Request, URLError, HTTPError
 
-    table2 = urlopen('http://www.astro.keele.ac.uk/jkt/tepcat/allplanets-ascii.txt').read()
-    with open('tepcat2.txt', 'wb') as g:
-        g.write(table2)
-    return 
+def atomic_write( opath, data ):
+    """
+    Writes bytes to a temporary file alongside opath and renames it into place.
+    """
+    odir = os.path.dirname( os.path.abspath( opath ) )
+    fd, tmppath = tempfile.mkstemp( dir=odir, prefix='.tmp-' )
+    try:
+        with os.fdopen( fd, 'wb' ) as f:
+            f.write( data )
+        os.replace( tmppath, opath )
+    except:
+        os.remove( tmppath )
+        raise
+    return None
+
+def get_headerpath( opath ):
+    """
+    Returns the path of the file storing the HTTP caching headers for a table.
+    """
+    odir, fname = os.path.split( opath )
+    return os.path.join( odir, '.{0}.http.json'.format( fname ) )
+
+if __name__=='__main__':
+    # Cache inspection entry point, e.g. python tepcat.py cache-info
+    if ( len( sys.argv )>1 )*( sys.argv[-1]=='cache-clear' ):
+        clear_cache()
+    else:
+        cache_info()
@@ -0,0 +1,43 @@
+from __future__ import print_function
+import os, sys, shutil, tempfile
+import pytest
+
+"""
+Shared fixtures for the tests, which run against the fakejdi stand-in for
+PandExo so that they do not need PandExo installed. The repository root is
+put on the path so that the modules are imported as in run_jwst.py, and the
+shared spectra and memo directories are redirected to a temporary directory.
+"""
+
+ROOT = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, ROOT )
+SCRATCH = tempfile.mkdtemp( prefix='pandexo_prep_tests-' )
+os.environ['PANDEXO_PREP_SPECTRA_DIR'] = os.path.join( SCRATCH, 'spectra' )
+os.environ['PANDEXO_PREP_MEMO_DIR'] = os.path.join( SCRATCH, 'memo' )
+os.environ['FAKEJDI_LATENCY'] = '0'
+
+import jwstsim
+jwstsim.set_backend( 'fakejdi' )
+import hstsim
+hstsim.set_backend( 'fakejdi' )
+
+
+@pytest.fixture
+def workdir( tmp_path, monkeypatch ):
+    """
+    Runs a test in a temporary directory containing copies of the TEPCat
+    tables.
+    """
+    for fname in [ 'tepcat1.txt', 'tepcat2.txt' ]:
+        shutil.copy( os.path.join( ROOT, fname ), str( tmp_path ) )
+    monkeypatch.chdir( tmp_path )
+    return tmp_path
+
+
+@pytest.fixture
+def tepcat( workdir ):
+    """
+    Returns the catalogue loaded from the saved TEPCat tables.
+    """
+    import tepcat as tepcat_module
+    return tepcat_module.load( download_latest=False, quiet=True, cache=False )
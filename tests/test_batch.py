@@ -0,0 +1,83 @@
+from __future__ import print_function
+import os
+import numpy as np
+import pytest
+import batch, jwstsim, fakejdi, profiling
+
+MODES = [ 'NIRSpec G395H', 'NIRSpec G140H' ] # G140H runs two filters
+
+
+def test_get_inst_modes():
+    assert jwstsim.get_inst_modes( 'NIRSpec G395H' )==[ 'NIRSpec G395H' ]
+    assert jwstsim.get_inst_modes( MODES )==MODES
+    modes = jwstsim.get_inst_modes( 'all' )
+    assert ( 'WFC3 G141' in modes )==False
+    assert jwstsim.get_inst_modes( [ 'all' ] )==modes
+    with pytest.raises( ValueError ):
+        jwstsim.get_inst_modes( [ 'NIRSpec G395H', 'NIRSpec G999X' ] )
+
+
+def test_list_tasks():
+    tasks = batch.list_tasks( [ 'A', 'B' ], MODES )
+    assert tasks==[ [ 'A', 'NIRSpec G395H', None ], [ 'A', 'NIRSpec G140H', 'f100lp' ], \
+                    [ 'A', 'NIRSpec G140H', None ], [ 'B', 'NIRSpec G395H', None ], \
+                    [ 'B', 'NIRSpec G140H', 'f100lp' ], [ 'B', 'NIRSpec G140H', None ] ]
+
+
+def test_parallel_matches_serial( tepcat ):
+    planets = list( tepcat['names'][:3] )+[ 'NOT-A-PLANET' ]
+    serial = batch.run( planets, tepcat, inst_modes=MODES, nworkers=1, backend='fakejdi', \
+                        outdir=os.path.abspath( 'serial' ) )
+    parallel = batch.run( planets, tepcat, inst_modes=MODES, nworkers=2, backend='fakejdi', \
+                          outdir=os.path.abspath( 'parallel' ) )
+    for records in [ serial, parallel ]:
+        statuses = [ r['status'] for r in records ]
+        assert statuses.count( 'done' )==3*3
+        assert statuses.count( 'skipped' )==3
+    for r in serial:
+        if r['status']=='done':
+            for opath in r['outputs']:
+                ppath = opath.replace( os.sep+'serial'+os.sep, os.sep+'parallel'+os.sep )
+                assert os.path.isfile( ppath )
+                if opath.endswith( '.obspar.txt' )==False:
+                    assert np.allclose( np.loadtxt( opath ), np.loadtxt( ppath ) )
+
+
+def test_failures_and_timeouts_are_recorded( tepcat, monkeypatch ):
+    planets = list( tepcat['names'][:2] )
+    simulate_mode = jwstsim.simulate_mode
+    def flaky( z, inst_mode, filt, memo=False ):
+        if filt=='f100lp':
+            raise RuntimeError( 'flaky' )
+        return simulate_mode( z, inst_mode, filt, memo=memo )
+    monkeypatch.setattr( jwstsim, 'simulate_mode', flaky )
+    records = batch.run( planets, tepcat, inst_modes=MODES, nworkers=1, backend='fakejdi' )
+    failed = [ r for r in records if r['status']=='failed' ]
+    assert len( failed )==2
+    assert all( [ 'flaky' in r['error'] for r in failed ] )
+    assert len( [ r for r in records if r['status']=='done' ] )==4
+
+    monkeypatch.setattr( fakejdi, 'LATENCY', 5. )
+    records = batch.run( planets[:1], tepcat, inst_modes=[ 'NIRSpec G395H' ], nworkers=1, \
+                         backend='fakejdi', timeout=0.2 )
+    assert records[0]['status']=='timeout'
+    assert records[0]['runtime']<2
+
+
+def test_profiling_settings_are_restored( tepcat, monkeypatch ):
+    planets = list( tepcat['names'][:1] )
+    kwargs = { 'inst_modes':MODES, 'nworkers':1, 'backend':'fakejdi' }
+    monkeypatch.delenv( profiling.TRACE_ENV, raising=False )
+    monkeypatch.delenv( profiling.PROFILE_ENV, raising=False )
+    batch.run( planets, tepcat, trace_path='trace.jsonl', profiler='cprofile', **kwargs )
+    assert os.path.isfile( 'trace.jsonl' )
+    assert ( profiling.TRACE_ENV in os.environ )==False
+    assert ( profiling.PROFILE_ENV in os.environ )==False
+
+    # Settings made outside the run are kept, also when it fails:
+    monkeypatch.setenv( profiling.TRACE_ENV, os.path.abspath( 'outer.jsonl' ) )
+    with pytest.raises( ValueError ):
+        batch.run( planets, tepcat, trace_path='trace.jsonl', inst_modes=[ 'NIRSpec G999X' ] )
+    assert os.environ[profiling.TRACE_ENV]==os.path.abspath( 'outer.jsonl' )
+    batch.run( planets, tepcat, **kwargs )
+    assert os.path.isfile( 'outer.jsonl' )
@@ -0,0 +1,52 @@
+from __future__ import print_function
+import numpy as np
+import pytest
+import binning, jwstsim
+
+
+def test_rebin_matches_loop():
+    wave = np.linspace( 1, 5, 997 )
+    err = np.random.RandomState( 0 ).uniform( 50, 150, len( wave ) )
+    edges = binning.get_edges( wave.min(), wave.max()*( 1+1e-12 ), 100 )
+    wbin, ebin, npts = binning.rebin( wave, err, edges )
+    i = 0
+    for k in range( len( edges )-1 ):
+        ixs = ( wave>=edges[k] )*( wave<edges[k+1] )
+        if ixs.sum()==0:
+            continue
+        assert np.isclose( wbin[i], wave[ixs].mean() )
+        assert np.isclose( ebin[i], np.sqrt( np.sum( err[ixs]**2. ) )/ixs.sum() )
+        i += 1
+    assert i==len( wbin )
+    assert npts.sum()==len( wave )
+
+
+def test_binned_errors_respect_noise_floor( tepcat ):
+    floor = 150. # below the native noise but above the binned noise
+    z = jwstsim.prepare_exo_dict( 'WASP-121', tepcat, noise_floor_ppm=floor )
+    y = jwstsim.simulate_mode( z, 'NIRSpec G395H', None )
+    band = [ 'band', np.array( [ 3., 4., 5. ] ) ]
+    spectra = jwstsim.get_spectra( y, resolutions=[ None, 100, band ], noise_floor_ppm=floor )
+    assert [ s[0] for s in spectra ]==[ '', '-R100', '-band' ]
+    wav, raw = jwstsim.get_noise( y, floor=False )
+    binned = binning.bin_resolutions( wav, raw, [ 100 ] )[0][2]
+    assert np.any( binned<floor ) # otherwise the floor is not being tested
+    for label, wbin, ebin in spectra:
+        assert np.all( ebin>=floor )
+    # Native resolution is unchanged, and binned errors are binned before flooring:
+    assert np.allclose( spectra[0][2], jwstsim.get_noise( y )[1] )
+    assert np.allclose( spectra[1][2], np.maximum( binned, floor ) )
+
+
+def test_missing_raw_noise_is_an_error( tepcat ):
+    z = jwstsim.prepare_exo_dict( 'WASP-121', tepcat, noise_floor_ppm=150. )
+    y = jwstsim.simulate_mode( z, 'NIRSpec G395H', None )
+    wav, raw = jwstsim.get_noise( y, floor=False )
+    assert np.all( raw<=jwstsim.get_noise( y )[1] )
+    y['RawData']['error_no_floor'] = y['RawData']['error_no_floor'][::2]
+    with pytest.raises( ValueError ):
+        jwstsim.get_noise( y, floor=False )
+    del y['RawData']
+    with pytest.raises( ValueError ):
+        jwstsim.get_spectra( y, resolutions=[ 100 ], noise_floor_ppm=150. )
+    assert np.array_equal( jwstsim.get_spectra( y )[0][2], jwstsim.get_noise( y )[1] )
@@ -0,0 +1,55 @@
+from __future__ import print_function
+import numpy as np
+import pytest
+from catalogue import Catalogue, Planet
+
+
+def test_catalogue_matches_dict( tepcat ):
+    cat = Catalogue.from_dict( tepcat )
+    assert len( cat )==len( tepcat['names'] )
+    assert sorted( cat.keys() )==sorted( tepcat.keys() )
+    for k in tepcat:
+        np.testing.assert_array_equal( cat[k], tepcat[k] )
+    d = cat.as_dict()
+    for k in tepcat:
+        np.testing.assert_array_equal( d[k], tepcat[k] )
+
+
+def test_planet_lookup( tepcat ):
+    cat = Catalogue.from_dict( tepcat )
+    names = tepcat['names'].tolist()
+    for i in [ 0, 10, len( names )-1 ]:
+        p = cat.planet( names[i] )
+        assert isinstance( p, Planet )
+        assert cat.row( names[i] )==names.index( names[i] )
+        assert p.kmags==tepcat['kmags'][names.index( names[i] )]
+        assert p['sn_tr']==p.sn_tr
+    assert 'NOT-A-PLANET' not in cat
+    with pytest.raises( KeyError ):
+        cat.planet( 'NOT-A-PLANET' )
+    with pytest.raises( AttributeError ):
+        cat[0].not_a_field
+    assert cat[-1].as_dict()['names']==names[-1]
+    assert [ p['names'] for p in cat ][:3]==names[:3]
+
+
+def test_rows_are_views( tepcat ):
+    cat = Catalogue.from_dict( tepcat )
+    p = cat[0]
+    kmag = p.kmags
+    cat['kmags'][0] += 1
+    assert p.kmags==kmag+1
+
+
+def test_filter_and_sort( tepcat ):
+    cat = Catalogue.from_dict( tepcat )
+    mask = ( tepcat['kmags']<9 )
+    bright = cat.filter( mask )
+    assert len( bright )==mask.sum()
+    assert bright['names'].tolist()==tepcat['names'][mask].tolist()
+    assert len( cat[mask] )==mask.sum()
+    assert cat[:5]['names'].tolist()==tepcat['names'][:5].tolist()
+    name = bright['names'][-1]
+    assert bright.planet( name ).kmags==cat.planet( name ).kmags
+    by_kmag = cat.sort( 'kmags', descending=False )
+    assert np.all( np.diff( by_kmag['kmags'] )>=0 )
@@ -0,0 +1,119 @@
+from __future__ import print_function
+import os, time, socket, hashlib, threading
+import pytest
+import tepcat
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class TableHandler( BaseHTTPRequestHandler ):
+    """
+    Serves the tables in server.tables with an ETag, answering conditional
+    requests with 304 and recording the request headers.
+    """
+
+    def do_HEAD( self ):
+        self.respond( body=False )
+
+    def do_GET( self ):
+        self.respond( body=True )
+
+    def respond( self, body=True ):
+        name = self.path.lstrip( '/' )
+        self.server.requests += [ [ self.command, name, dict( self.headers ) ] ]
+        if name not in self.server.tables:
+            self.send_response( 404 )
+            self.end_headers()
+            return
+        data = self.server.tables[name]
+        etag = '"{0}"'.format( hashlib.sha1( data ).hexdigest() )
+        if self.headers.get( 'If-None-Match' )==etag:
+            self.send_response( 304 )
+            self.end_headers()
+            return
+        self.send_response( 200 )
+        self.send_header( 'ETag', etag )
+        self.send_header( 'Content-Length', str( len( data ) ) )
+        self.end_headers()
+        if body:
+            self.wfile.write( data )
+
+    def log_message( self, *args ):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer( ( '127.0.0.1', 0 ), TableHandler )
+    httpd.tables = dict( [ ( t[0], 'table {0}\n'.format( t[0] ).encode( 'utf-8' ) ) \
+                           for t in tepcat.TEPCAT_TABLES ] )
+    httpd.requests = []
+    thread = threading.Thread( target=httpd.serve_forever )
+    thread.daemon = True
+    thread.start()
+    httpd.base_url = 'http://127.0.0.1:{0}/'.format( httpd.server_address[1] )
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read( fpath ):
+    with open( fpath, 'rb' ) as f:
+        return f.read()
+
+
+def test_conditional_download( server, tmp_path ):
+    outdir = str( tmp_path )
+    status = tepcat.download_tables( base_url=server.base_url, outdir=outdir )
+    assert status=={ 'tepcat1.txt':'downloaded', 'tepcat2.txt':'downloaded' }
+    for remote, local in tepcat.TEPCAT_TABLES:
+        assert read( os.path.join( outdir, local ) )==server.tables[remote]
+        assert os.path.isfile( tepcat.get_headerpath( os.path.join( outdir, local ) ) )
+
+    # Unchanged tables are not transferred again:
+    del server.requests[:]
+    status = tepcat.download_tables( base_url=server.base_url, outdir=outdir )
+    assert status=={ 'tepcat1.txt':'not modified', 'tepcat2.txt':'not modified' }
+    assert all( [ 'If-None-Match' in r[2] for r in server.requests ] )
+
+    # A changed table is downloaded again:
+    remote, local = tepcat.TEPCAT_TABLES[1]
+    server.tables[remote] = b'new table\n'
+    status = tepcat.download_tables( base_url=server.base_url, outdir=outdir )
+    assert status=={ 'tepcat1.txt':'not modified', 'tepcat2.txt':'downloaded' }
+    assert read( os.path.join( outdir, local ) )==b'new table\n'
+
+
+def test_failed_download_keeps_table( server, tmp_path ):
+    remote, local = tepcat.TEPCAT_TABLES[0]
+    opath = os.path.join( str( tmp_path ), local )
+    with open( opath, 'wb' ) as f:
+        f.write( b'old table\n' )
+    del server.tables[remote]
+    assert tepcat.fetch_table( server.base_url+remote, opath, retries=0 )=='failed'
+    assert read( opath )==b'old table\n'
+    assert [ f for f in os.listdir( str( tmp_path ) ) if f.startswith( '.tmp' ) ]==[]
+
+
+def test_probe( server ):
+    assert tepcat.internet_on( base_url=server.base_url )==True
+    assert server.requests[-1][0]=='HEAD'
+    sock = socket.socket()
+    sock.bind( ( '127.0.0.1', 0 ) )
+    port = sock.getsockname()[1]
+    sock.close() # nothing listening on this port now
+    t1 = time.time()
+    assert tepcat.internet_on( base_url='http://127.0.0.1:{0}/'.format( port ) )==False
+    assert time.time()-t1<2
+
+
+def test_offline_load_skips_downloads( workdir, monkeypatch ):
+    def no_downloads( *args, **kwargs ):
+        raise AssertionError( 'download_tables() called while offline' )
+    monkeypatch.setattr( tepcat, 'internet_on', lambda *args, **kwargs: False )
+    monkeypatch.setattr( tepcat, 'download_tables', no_downloads )
+    z = tepcat.load( download_latest=True, quiet=True, cache=False )
+    assert len( z['names'] )>0
@@ -0,0 +1,74 @@
+from __future__ import print_function
+import os, copy
+import numpy as np
+import pytest
+import hstgrid
+
+# The example planet from run_hst.py:
+PLANETDICT = { 'name':'HD209458b', \
+               'star':{ 'type':'phoenix', 'mag':6.31, 'ref_wave':2.22, 'temp':6080, 'metal':0, \
+                        'logg':4.4, 'radius':1.19, 'r_unit':'R_sun' }, \
+               'planet':{ 'transit_duration':0.127, 'depth':0.121**2., 'period':3.5247, \
+                          'i':86.7, 'ars':8.8, 'ecc':0., 'w':90., 'radius':1.4, \
+                          'r_unit':'R_jup', 'w_unit':'um', 'f_unit':'rp^2/r*^2', \
+                          'td_unit':'d' } }
+
+
+def make_planetdict( name, kmag=6.31 ):
+    planetdict = copy.deepcopy( PLANETDICT )
+    planetdict['name'] = name
+    planetdict['star']['mag'] = kmag
+    return planetdict
+
+
+def get_planetdicts():
+    # P1 and P2 have identical PandExo inputs:
+    return [ make_planetdict( 'P1' ), make_planetdict( 'P2' ), make_planetdict( 'P3', kmag=8. ) ]
+
+
+def test_expand_and_dedupe( workdir ):
+    planetdicts = get_planetdicts()
+    grid = hstgrid.expand_grid( planetdicts+planetdicts[:1], scans=[ 'Round Trip', 'rt', 'forward' ], \
+                                subarrays=[ 'grism256', 'GRISM512' ], nchans=[ 14, 14., 7 ], \
+                                useFirstOrbit=[ False, 0, True ] )
+    assert len( grid )==3*2*2*2*2 # repeated planets and values are dropped
+    assert set( [ p['scan'] for p in grid ] )==set( hstgrid.SCANS )
+    assert set( [ p['subarray'] for p in grid ] )==set( [ 'GRISM256', 'GRISM512' ] )
+    tasks = hstgrid.dedupe( grid )
+    assert len( tasks )==2*len( grid )//3
+    assert set( [ t['planet'] for t in tasks ] )==set( [ 'P1', 'P3' ] )
+    with pytest.raises( ValueError ):
+        hstgrid.expand_grid( planetdicts, subarrays=[ 'GRISM64' ] )
+    with pytest.raises( ValueError ):
+        hstgrid.expand_grid( planetdicts, scans=[ 'Backward' ] )
+
+
+def test_run_grid( workdir ):
+    planetdicts = get_planetdicts()
+    kwargs = { 'scans':hstgrid.SCANS, 'subarrays':hstgrid.SUBARRAYS, 'nchans':[ 7, 14 ], \
+               'useFirstOrbit':[ False, True ], 'backend':'fakejdi' }
+    table = hstgrid.run_grid( planetdicts, nworkers=2, outdir=os.path.abspath( 'out' ), \
+                              table_path='grid.txt', **kwargs )
+    n = 3*2*3*2*2
+    assert sorted( table.keys() )==sorted( hstgrid.TABLE_KEYS )
+    assert len( table['planet'] )==n
+    assert np.all( table['status']=='done' )
+
+    # Equivalent configurations share one run, saved under the first planet:
+    p1, p2, p3 = [ table['planet']==p for p in [ 'P1', 'P2', 'P3' ] ]
+    for k in [ 'ppm', 'norbits', 'duty_cycle', 'runtime' ]:
+        assert np.array_equal( table[k][p1], table[k][p2] )
+    assert np.all( table['ppm'][p3]>table['ppm'][p1] ) # fainter star
+    assert sorted( os.listdir( 'out' ) )==[ 'P1', 'P3' ]
+    assert len( os.listdir( os.path.join( 'out', 'P1' ) ) )==2*n//3
+
+    # Running serially gives the same table:
+    serial = hstgrid.run_grid( planetdicts, nworkers=1, **kwargs )
+    for k in hstgrid.TABLE_KEYS:
+        if k!='runtime':
+            assert serial[k].tolist()==table[k].tolist()
+
+    with open( 'grid.txt', 'r' ) as f:
+        lines = f.readlines()
+    assert lines[0].split()[1:]==hstgrid.TABLE_KEYS
+    assert len( lines )==n+1
@@ -0,0 +1,92 @@
+from __future__ import print_function
+import numpy as np
+import pytest
+import hstsim, tepcat as tepcat_module
+
+
+def calc_duration( incl, periods, aRs, RpRs, ecc=0 ):
+    """
+    Total transit duration in days from Seager & Mallen-Ornelas (2003), for
+    an orbit transiting at periastron if ecc>0.
+    """
+    b = aRs*np.cos( np.deg2rad( incl ) )
+    x = np.sqrt( ( 1+RpRs )**2.-b**2. )/( aRs*np.sin( np.deg2rad( incl ) ) )
+    return ( periods/np.pi )*np.arcsin( x )*np.sqrt( 1-ecc**2. )/( 1+ecc )
+
+
+def test_calc_inclination_inverts_duration():
+    incl = np.array( [ 80., 84., 86.7, 89. ] )
+    periods = np.array( [ 1.2, 3.5, 3.5, 10. ] )
+    aRs = np.array( [ 4., 8.8, 8.8, 20. ] )
+    RpRs = np.array( [ 0.15, 0.12, 0.12, 0.1 ] )
+    tdurs = calc_duration( incl, periods, aRs, RpRs )
+    assert np.allclose( tepcat_module.calc_inclination( tdurs, periods, aRs, RpRs ), incl )
+    # An eccentric orbit transiting at periastron has a shorter transit:
+    tdurs_ecc = calc_duration( incl, periods, aRs, RpRs, ecc=0.3 )
+    assert np.all( tdurs_ecc<tdurs )
+    assert np.allclose( tepcat_module.calc_inclination( tdurs_ecc, periods, aRs, RpRs, ecc=0.3, \
+                                                        w_deg=90 ), incl )
+    # Too long for a central transit, and impossible:
+    tcentral = calc_duration( 90., periods[0], aRs[0], RpRs[0] )
+    assert tepcat_module.calc_inclination( 1.02*tcentral, periods[0], aRs[0], RpRs[0] )==90
+    assert np.isnan( tepcat_module.calc_inclination( 0.1, 3.5, 1.05, 0.1 ) )
+
+
+def test_build_planetdicts( tepcat ):
+    names = tepcat['names'][:20].tolist()
+    planetdicts, flagged = hstsim.build_planetdicts( tepcat, planets=names+[ 'NOT-A-PLANET' ] )
+    assert flagged['NOT-A-PLANET']=='not in catalogue'
+    assert len( planetdicts )+len( flagged )==len( names )+1
+    assert len( planetdicts )>0
+    for p, planetdict in planetdicts.items():
+        ix = names.index( p )
+        assert planetdict['name']==p
+        assert planetdict['star']['mag']==tepcat['kmags'][ix]
+        assert planetdict['planet']['period']==tepcat['periods'][ix]
+        assert planetdict['planet']['ars']==tepcat['aRs'][ix]
+        assert 0<planetdict['planet']['i']<=90
+        # The inclination reproduces the catalogue transit duration:
+        if planetdict['planet']['i']<90:
+            tdur = calc_duration( planetdict['planet']['i'], planetdict['planet']['period'], \
+                                  planetdict['planet']['ars'], np.sqrt( planetdict['planet']['depth'] ), \
+                                  ecc=planetdict['planet']['ecc'] )
+            assert np.isclose( tdur, tepcat['tdurs'][ix] )
+        # Ready to simulate:
+        z, norb = hstsim.prepare_exo_dict( planetdict )
+        assert norb>0
+
+
+def test_incomplete_planets_are_flagged( tepcat ):
+    cat = dict( [ ( k, np.array( tepcat[k][:5] ) ) for k in tepcat.keys() ] )
+    names = cat['names'].tolist()
+    cat['tstar'][1] = -1
+    cat['aRs'][2] = 0.5 # inside the star
+    planetdicts, flagged = hstsim.build_planetdicts( cat, quiet=True )
+    assert flagged[names[1]]=='missing tstar'
+    assert 'inconsistent' in flagged[names[2]]
+    assert ( names[1] in planetdicts )==False
+
+
+def test_clamped_inclinations_are_reported( tepcat ):
+    periods = np.array( [ 1.2, 3.5 ] )
+    aRs = np.array( [ 4., 8.8 ] )
+    RpRs = np.array( [ 0.15, 0.12 ] )
+    tdurs = calc_duration( np.array( [ 85., 90. ] ), periods, aRs, RpRs )
+    tdurs[1] *= 1.02
+    incl, clamped = tepcat_module.calc_inclination( tdurs, periods, aRs, RpRs, return_clamped=True )
+    assert np.isclose( incl[0], 85 )*( incl[1]==90 )
+    assert clamped.tolist()==[ False, True ]
+
+    cat = dict( [ ( k, np.array( tepcat[k][:5] ) ) for k in tepcat.keys() ] )
+    names = cat['names'].tolist()
+    assert hstsim.build_planetdicts( cat, quiet=True )[0][names[0]]['warnings']==[]
+    cat['aRs'][0] *= 2 # makes the catalogue duration too long
+    planetdicts, flagged = hstsim.build_planetdicts( cat, quiet=True )
+    assert planetdicts[names[0]]['planet']['i']==90
+    assert len( planetdicts[names[0]]['warnings'] )==1
+    assert all( [ planetdicts[p]['warnings']==[] for p in names[1:] if p in planetdicts ] )
+    planetdicts, flagged = hstsim.build_planetdicts( cat, quiet=True, on_clamped='flag' )
+    assert 'central transit' in flagged[names[0]]
+    assert ( names[0] in planetdicts )==False
+    with pytest.raises( ValueError ):
+        hstsim.build_planetdicts( cat, on_clamped='ignore' )
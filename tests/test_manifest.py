@@ -0,0 +1,74 @@
+from __future__ import print_function
+import os, json
+import batch, manifest, jwstsim, config
+from store import ResultStore
+
+MODES = [ 'NIRSpec G395H', 'NIRISS SOSS' ]
+
+
+def test_load_ignores_incomplete_lines( tmp_path ):
+    fpath = str( tmp_path/'m.jsonl' )
+    manifest.append( fpath, { 'key':'a', 'status':'failed' } )
+    manifest.append( fpath, { 'key':'a', 'status':'done' } )
+    with open( fpath, 'a' ) as f:
+        f.write( '{"key": "b", "stat' ) # killed mid-write
+    ledger = manifest.load( fpath )
+    assert list( ledger.keys() )==[ 'a' ]
+    assert ledger['a']['status']=='done'
+    assert manifest.load( str( tmp_path/'missing.jsonl' ) )=={}
+
+
+def test_hash_inputs_is_canonical():
+    assert manifest.hash_inputs( { 'a':1, 'b':[ 1, 2 ] } )==manifest.hash_inputs( { 'b':[ 1, 2 ], 'a':1 } )
+    assert manifest.hash_inputs( { 'a':1 } )!=manifest.hash_inputs( { 'a':2 } )
+
+
+def test_rerun_skips_finished_tasks( tepcat ):
+    planets = list( tepcat['names'][:2] )
+    kwargs = { 'inst_modes':MODES, 'nworkers':1, 'backend':'fakejdi', \
+               'outdir':os.path.abspath( 'out' ), 'manifest_path':'m.jsonl' }
+    records = batch.run( planets, tepcat, **kwargs )
+    assert [ r['status'] for r in records ]==[ 'done' ]*4
+    records = batch.run( planets, tepcat, **kwargs )
+    assert [ r['status'] for r in records ]==[ 'cached' ]*4
+
+    # Changed inputs and missing outputs are run again:
+    os.remove( records[0]['outputs'][0] )
+    records = batch.run( planets, tepcat, noise_floor_ppm=30, **kwargs )
+    assert [ r['status'] for r in records ]==[ 'done' ]*4
+    records = batch.run( planets, tepcat, noise_floor_ppm=30, **kwargs )
+    os.remove( records[0]['outputs'][0] )
+    records = batch.run( planets, tepcat, noise_floor_ppm=30, **kwargs )
+    assert sorted( [ r['status'] for r in records ] )==[ 'cached' ]*3+[ 'done' ]
+
+
+def test_rerun_depends_on_backend_and_output_mode( tepcat, tmp_path, monkeypatch ):
+    planets = list( tepcat['names'][:2] )
+    kwargs = { 'inst_modes':MODES, 'nworkers':1, 'manifest_path':'m.jsonl' }
+    outdir = os.path.abspath( 'out' )
+    records = batch.run( planets, tepcat, backend='fakejdi', outdir=outdir, **kwargs )
+    assert [ r['status'] for r in records ]==[ 'done' ]*4
+
+    # Another PandExo version:
+    with open( str( tmp_path/'fakejdi_v2.py' ), 'w' ) as f:
+        f.write( 'from fakejdi import *\n' )
+    monkeypatch.syspath_prepend( str( tmp_path ) )
+    try:
+        records = batch.run( planets, tepcat, backend='fakejdi_v2', outdir=outdir, **kwargs )
+    finally:
+        jwstsim.set_backend( 'fakejdi' )
+    assert [ r['status'] for r in records ]==[ 'done' ]*4
+
+    # Results saved to a store rather than as text files:
+    records = batch.run( planets, tepcat, backend='fakejdi', store_dir='store', **kwargs )
+    assert [ r['status'] for r in records ]==[ 'done' ]*4
+    assert len( ResultStore( 'store' ) )==4
+    records = batch.run( planets, tepcat, backend='fakejdi', store_dir='store', **kwargs )
+    assert [ r['status'] for r in records ]==[ 'cached' ]*4
+
+    # The same planet spectrum kept somewhere else, e.g. on another machine:
+    monkeypatch.setattr( config, 'SPECTRA_DIR', str( tmp_path/'spectra' ) )
+    z = jwstsim.prepare_exo_dict( planets[0], tepcat )
+    assert z['planet']['exopath'].startswith( str( tmp_path ) )
+    records = batch.run( planets, tepcat, backend='fakejdi', store_dir='store', **kwargs )
+    assert [ r['status'] for r in records ]==[ 'cached' ]*4
@@ -0,0 +1,83 @@
+from __future__ import print_function
+import os, types
+import numpy as np
+import memo, jwstsim, fakejdi
+
+
+def test_cache_round_trip( tepcat, tmp_path ):
+    memo_dir = str( tmp_path/'memo' )
+    jdi = fakejdi
+    z = jwstsim.prepare_exo_dict( 'WASP-121', tepcat )
+    inst = [ 'NIRSpec G395H' ]
+    nhits = memo.STATS['hits']
+    y1 = memo.run_pandexo( jdi, z, inst, memo_dir=memo_dir )
+    y2 = memo.run_pandexo( jdi, z, inst, memo_dir=memo_dir )
+    assert memo.STATS['hits']==nhits+1
+    assert np.array_equal( y1['FinalSpectrum']['error_w_floor'], y2['FinalSpectrum']['error_w_floor'] )
+    assert len( memo.list_entries( memo_dir ) )==1
+
+    # Different inputs are a different entry:
+    z['observation']['noise_floor'] = 0
+    memo.run_pandexo( jdi, z, inst, memo_dir=memo_dir )
+    assert memo.STATS['hits']==nhits+1
+    assert len( memo.list_entries( memo_dir ) )==2
+
+
+def test_key_depends_on_spectrum_contents( tmp_path ):
+    jdi = fakejdi
+    fpaths = [ str( tmp_path/'a.txt' ), str( tmp_path/'b.txt' ) ]
+    for fpath in fpaths:
+        np.savetxt( fpath, np.column_stack( [ [ 1., 2. ], [ 0., 0. ] ] ) )
+    keys = [ memo.result_key( jdi, { 'planet':{ 'exopath':f } }, [ 'MIRI LRS' ] ) for f in fpaths ]
+    assert keys[0]==keys[1] # same contents, different paths
+    np.savetxt( fpaths[1], np.column_stack( [ [ 1., 2. ], [ 0., 1. ] ] ) )
+    os.utime( fpaths[1], ( 0, 0 ) )
+    assert memo.result_key( jdi, { 'planet':{ 'exopath':fpaths[1] } }, [ 'MIRI LRS' ] )!=keys[0]
+
+
+def test_evict_keeps_size_bounded( tepcat, tmp_path ):
+    memo_dir = str( tmp_path/'memo' )
+    jdi = fakejdi
+    z = jwstsim.prepare_exo_dict( 'WASP-121', tepcat )
+    for floor in [ 0, 10, 20 ]:
+        z['observation']['noise_floor'] = floor
+        memo.run_pandexo( jdi, z, [ 'MIRI LRS' ], memo_dir=memo_dir )
+    sizes = [ e[1] for e in memo.list_entries( memo_dir ) ]
+    memo.evict( memo_dir, max_bytes=max( sizes )+1 )
+    assert len( memo.list_entries( memo_dir ) )==1
+
+
+def test_evict_scans_only_when_full( tepcat, tmp_path, monkeypatch ):
+    memo_dir = str( tmp_path/'memo' )
+    z = jwstsim.prepare_exo_dict( 'WASP-121', tepcat )
+    nscans = [ 0 ]
+    list_entries = memo.list_entries
+    def counted( memo_dir ):
+        nscans[0] += 1
+        return list_entries( memo_dir )
+    monkeypatch.setattr( memo, 'list_entries', counted )
+    for floor in range( 5 ):
+        z['observation']['noise_floor'] = floor
+        memo.run_pandexo( fakejdi, z, [ 'MIRI LRS' ], memo_dir=memo_dir )
+    assert nscans[0]==1
+    size = list_entries( memo_dir )[0][1]
+    for floor in range( 5, 10 ):
+        z['observation']['noise_floor'] = floor
+        memo.run_pandexo( fakejdi, z, [ 'MIRI LRS' ], memo_dir=memo_dir, max_bytes=3.5*size )
+    assert len( list_entries( memo_dir ) )==3
+    assert memo.SIZES[os.path.abspath( memo_dir )]==sum( [ e[1] for e in list_entries( memo_dir ) ] )
+
+
+def test_backend_version( monkeypatch ):
+    from importlib import metadata
+    versions = { 'pandexo.engine':'2.0' }
+    def version( dist ):
+        if dist not in versions:
+            raise metadata.PackageNotFoundError( dist )
+        return versions[dist]
+    monkeypatch.setattr( metadata, 'version', version )
+    assert memo.backend_version( types.ModuleType( 'pandexo.engine.justdoit' ) )=='pandexo.engine.justdoit==2.0'
+    assert memo.backend_version( fakejdi )=='fakejdi==unknown'
+    jdi = types.ModuleType( 'fakejdi_v2' )
+    jdi.__version__ = '0.1'
+    assert memo.backend_version( jdi )=='fakejdi_v2==0.1'
@@ -0,0 +1,94 @@
+from __future__ import print_function
+import os
+import numpy as np
+import batch, query
+
+MODES = [ 'NIRSpec G395H', 'NIRISS SOSS' ]
+
+
+def run_sweep( tepcat, nplanets=4, **kwargs ):
+    planets = list( tepcat['names'][:nplanets] )
+    records = batch.run( planets, tepcat, inst_modes=MODES, nworkers=1, backend='fakejdi', \
+                         resolutions=[ None, 100 ], **kwargs )
+    assert all( [ r['status']=='done' for r in records ] )
+    return planets
+
+
+def test_index_matches_spectra( tepcat ):
+    planets = run_sweep( tepcat, store_dir='store' )
+    ix = query.load( 'store' )
+    assert len( ix )==len( planets )*len( MODES )*2 # native and R=100
+    spectra = list( query.iter_spectra( 'store' ) )
+    assert len( spectra )==len( ix )
+    for planet, label, wave, err, obspar in spectra:
+        row = ix.where( planet=planet, label=label )
+        assert len( row )==1
+        assert np.isclose( row['median_error'][0], np.median( err ) )
+        assert row['npts'][0]==len( wave )
+        i = ix.band( 4.0 )
+        inband = ( wave>=ix.band_edges[i] )*( wave<ix.band_edges[i+1] )
+        if inband.sum()>0:
+            assert np.isclose( row.error_at( 4.0 )[0], np.median( err[inband] ) )
+    err = ix.error_at( 4.0 )
+    cut = np.nanmedian( err )
+    assert np.all( ix.where( max_error=cut, at_um=4.0 ).error_at( 4.0 )<cut )
+
+
+def test_top_matches_sort( tepcat ):
+    run_sweep( tepcat, store_dir='store' )
+    ix = query.load( 'store' )
+    best = ix.top( 5, 'median_error', unique=None )
+    assert best['median_error'].tolist()==ix.sort( 'median_error' )['median_error'][:5].tolist()
+    worst = ix.top( 5, 'median_error', descending=True, unique=None )
+    assert worst['median_error'].tolist()==ix.sort( 'median_error', descending=True )['median_error'][:5].tolist()
+    assert len( ix.top( 1000, ix.error_at( 4.0 ), unique=None ) )==np.isfinite( ix.error_at( 4.0 ) ).sum()
+
+
+def test_summary_is_rebuilt_when_results_change( tepcat ):
+    run_sweep( tepcat, nplanets=2, outdir=os.path.abspath( 'out' ) )
+    ix = query.load( 'out' )
+    assert isinstance( ix.data, np.memmap )
+    assert len( ix )==2*len( MODES )*2
+    assert len( query.load( 'out' ) )==len( ix )
+    # Results added after the summary was saved:
+    mpath = os.path.join( 'out', '{0}.json'.format( query.SUMMARY_NAME ) )
+    os.utime( mpath, ( 0, 0 ) )
+    run_sweep( tepcat, nplanets=3, outdir=os.path.abspath( 'out' ) )
+    assert len( query.load( 'out' ) )==3*len( MODES )*2
+    assert len( query.load( 'out', band_edges=[ 1, 2, 3 ] ).band_edges )==3
+
+
+def test_where_matches_instrument_mode( tepcat ):
+    planets = run_sweep( tepcat, store_dir='store' )
+    ix = query.load( 'store' )
+    assert len( ix )==len( planets )*len( MODES )*2 # native and R=100
+    # PandExo's own 'Mode' is the observing mode, not the instrument mode:
+    assert ix.row( 0 )['mode'] in MODES
+    g395h = ix.where( mode='NIRSpec G395H' )
+    assert len( g395h )==len( planets )*2
+    assert set( g395h['label'].tolist() )==set( [ 'NIRSpec-G395H', 'NIRSpec-G395H-R100' ] )
+    assert len( ix.where( mode='NIRSpec G395H', label='NIRSpec-G395H-R100' ) )==len( planets )
+    err = g395h.error_at( 4.0 )
+    assert np.all( g395h.where( max_error=np.nanmedian( err ), at_um=4.0 ).error_at( 4.0 )<np.nanmedian( err ) )
+
+
+def test_text_outputs_give_same_index( tepcat ):
+    run_sweep( tepcat, nplanets=2, outdir=os.path.abspath( 'out' ) )
+    ix = query.load( 'out' )
+    assert set( ix['mode'].tolist() )==set( MODES )
+    assert set( ix.where( mode='NIRISS SOSS' )['label'].tolist() )==set( [ 'NIRISS-SOSS', 'NIRISS-SOSS-R100' ] )
+
+
+def test_top_is_one_row_per_planet( tepcat ):
+    planets = run_sweep( tepcat, store_dir='store' )
+    ix = query.load( 'store' )
+    best = ix.top( 3, 'median_error' )
+    assert len( best )==3
+    assert len( set( best['planet'].tolist() ) )==3
+    assert np.all( np.diff( best['median_error'] )>=0 )
+    # The best row of each planet is kept:
+    for row in best.rows():
+        assert row['median_error']==ix.where( planet=row['planet'] )['median_error'].min()
+    assert len( ix.top( 100, 'median_error' ) )==len( planets )
+    assert len( ix.top( 100, 'median_error', unique=None ) )==len( ix )
+    assert len( ix.top( 0, 'median_error' ) )==0
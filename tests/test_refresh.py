@@ -0,0 +1,83 @@
+from __future__ import print_function
+import numpy as np
+import refresh, jwstsim, batch, shard
+
+MODES = [ 'NIRSpec G395H' ]
+
+
+def subset( tepcat, n ):
+    return dict( [ ( k, np.array( np.asarray( tepcat[k] )[:n] ) ) for k in tepcat.keys() ] )
+
+
+def test_diff_reports_changes( tepcat ):
+    old = subset( tepcat, 4 )
+    new = subset( tepcat, 5 ) # one added
+    new['kmags'][0] += 0.1 # PandExo input
+    new['vmags'][1] += 0.1 # not a PandExo input
+    new['tstar'][2] = np.nan
+    report = refresh.diff( old, new )
+    names = new['names'].tolist()
+    assert report['added']==[ names[4] ]
+    assert report['removed']==[]
+    assert sorted( report['changed'].keys() )==sorted( names[:3] )
+    assert report['changed'][names[0]]['kmags'][1]==new['kmags'][0]
+    assert sorted( refresh.affected_planets( report ) )==sorted( [ names[0], names[2], names[4] ] )
+    assert refresh.diff( new, new )=={ 'added':[], 'removed':[], 'changed':{} }
+    report = refresh.diff( new, old )
+    assert report['removed']==[ names[4] ]
+    assert refresh.diff( None, old )['added']==old['names'].tolist()
+
+
+def test_refresh_runs_only_affected_planets( tepcat ):
+    old = subset( tepcat, 4 )
+    records = refresh.refresh( old, inst_modes=MODES, nworkers=1, backend='fakejdi', quiet=True )[1]
+    assert len( records )==4
+    new = subset( tepcat, 4 )
+    new['tdurs'][1] *= 1.1
+    report, records = refresh.refresh( new, inst_modes=MODES, nworkers=1, backend='fakejdi', quiet=True )
+    assert [ r['planet'] for r in records ]==[ new['names'][1] ]
+    assert refresh.refresh( new, inst_modes=MODES, nworkers=1, backend='fakejdi', quiet=True )[1]==[]
+
+
+def test_failed_planets_stay_pending( tepcat, monkeypatch ):
+    old = subset( tepcat, 4 )
+    refresh.save_snapshot( old )
+    new = subset( tepcat, 5 )
+    new['kmags'][[ 0, 1 ]] += 0.5
+    failing = [ new['names'][0], new['names'][4] ] # one changed, one added
+    simulate_mode = jwstsim.simulate_mode
+    def flaky( z, inst_mode, filt, memo=False ):
+        if z['star']['mag'] in [ new['kmags'][0], new['kmags'][4] ]:
+            raise RuntimeError( 'flaky' )
+        return simulate_mode( z, inst_mode, filt, memo=memo )
+    monkeypatch.setattr( jwstsim, 'simulate_mode', flaky )
+    records = refresh.refresh( new, inst_modes=MODES, nworkers=1, backend='fakejdi', quiet=True )[1]
+    assert sorted( refresh.failed_planets( records ) )==sorted( failing )
+    report = refresh.diff( refresh.load_snapshot(), new )
+    assert sorted( refresh.affected_planets( report ) )==sorted( failing )
+
+    monkeypatch.setattr( jwstsim, 'simulate_mode', simulate_mode )
+    records = refresh.refresh( new, inst_modes=MODES, nworkers=1, backend='fakejdi', quiet=True )[1]
+    assert sorted( [ r['planet'] for r in records ] )==sorted( failing )
+    assert refresh.affected_planets( refresh.diff( refresh.load_snapshot(), new ) )==[]
+
+
+def test_other_shards_stay_pending( tepcat ):
+    modes = MODES+[ 'NIRISS SOSS' ]
+    kwargs = { 'inst_modes':modes, 'nworkers':1, 'backend':'fakejdi', 'quiet':True, \
+               'manifest_path':'m.jsonl' }
+    new = subset( tepcat, 6 )
+    tasks = batch.list_tasks( new['names'], modes )
+    mine = [ t[:3] for t in shard.select( tasks, 0, 2 ) ]
+    expected = sorted( set( [ t[0] for t in tasks if t[:3] not in mine ] ) )
+    assert 0<len( expected )<6
+    records = refresh.refresh( new, shard=[ 0, 2 ], **kwargs )[1]
+    assert sorted( [ [ r['planet'], r['mode'], r['filter'] ] for r in records ] )==sorted( mine )
+    report = refresh.diff( refresh.load_snapshot(), new )
+    assert refresh.affected_planets( report )==expected
+
+    # An unsharded refresh completes them, reusing the shard's results:
+    records = refresh.refresh( new, **kwargs )[1]
+    assert sorted( set( [ r['planet'] for r in records ] ) )==expected
+    assert len( [ r for r in records if r['status']=='done' ] )==len( tasks )-len( mine )
+    assert refresh.affected_planets( refresh.diff( refresh.load_snapshot(), new ) )==[]
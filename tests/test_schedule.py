@@ -0,0 +1,86 @@
+from __future__ import print_function
+import numpy as np
+import pytest
+import batch, schedule
+
+MODES = [ 'NIRSpec G395H', 'NIRISS SOSS' ]
+COSTS = { schedule.cost_key( 'A', None ):5., schedule.cost_key( 'B', None ):2., \
+          schedule.cost_key( 'C', None ):1. }
+
+
+def get_tasks( nplanets ):
+    return [ [ 'P{0}'.format( i ), m, None ] for i in range( nplanets ) for m in [ 'C', 'A', 'B' ] ]
+
+
+def test_estimate_costs( tepcat ):
+    planets = list( tepcat['names'][:3] )
+    batch.run( planets, tepcat, inst_modes=MODES, nworkers=1, backend='fakejdi', \
+               manifest_path='sweep.jsonl', trace_path='trace.jsonl' )
+    costs = schedule.estimate_costs( manifest_paths='sweep.jsonl' )
+    assert sorted( costs.keys() )==sorted( [ schedule.cost_key( m, None ) for m in MODES ] )
+    assert all( [ c>0 for c in costs.values() ] )
+    assert sorted( schedule.estimate_costs( trace_paths='trace.jsonl' ).keys() )==sorted( costs.keys() )
+    assert schedule.estimate_costs( manifest_paths=[], trace_paths='missing.jsonl' )=={}
+    assert schedule.get_cost( costs, 'MIRI LRS', None )==np.median( list( costs.values() ) )
+    assert schedule.get_cost( {}, 'MIRI LRS', None )==schedule.DEFAULT_COST
+
+
+def test_order_by_cost():
+    tasks = get_tasks( 3 )
+    ordered = schedule.order_tasks( tasks, costs=COSTS )
+    assert sorted( ordered )==sorted( tasks )
+    cost = [ schedule.get_cost( COSTS, t[1], t[2] ) for t in ordered ]
+    assert cost==sorted( cost, reverse=True )
+    # Without costs the order is unchanged:
+    assert schedule.order_tasks( tasks )==tasks
+    assert schedule.order_tasks( [], costs=COSTS )==[]
+
+
+def test_order_by_priority( tepcat ):
+    cat = dict( [ ( k, np.asarray( tepcat[k] )[:6] ) for k in [ 'names', 'sn_tr', 'sn_em' ] ] )
+    priorities = schedule.get_priorities( cat, keys='sn_tr' )
+    names = cat['names'].tolist()
+    assert sorted( priorities.values() )==list( range( 6 ) )
+    assert names[int( np.argmax( cat['sn_tr'] ) )]==[ p for p in priorities if priorities[p]==0 ][0]
+    both = schedule.get_priorities( cat, keys=[ 'sn_tr', 'sn_em' ] )
+    assert names[int( np.argmax( cat['sn_em'] ) )] in [ p for p in both if both[p]==0 ]
+
+    tasks = [ [ p, m, None ] for p in names for m in [ 'C', 'A', 'B' ] ]
+    ordered = schedule.order_tasks( tasks, costs=COSTS, priorities=priorities, tier_size=2 )
+    tiers = [ priorities[t[0]]//2 for t in ordered ]
+    assert tiers==sorted( tiers )
+    for tier in range( 3 ):
+        cost = [ COSTS[schedule.cost_key( t[1], t[2] )] for t in ordered if priorities[t[0]]//2==tier ]
+        assert len( cost )==6
+        assert cost==sorted( cost, reverse=True )
+
+
+def test_makespan_prediction():
+    tasks = get_tasks( 4 )
+    for nworkers in [ 1, 2, 3 ]:
+        outp = schedule.report( schedule.order_tasks( tasks, costs=COSTS ), COSTS, nworkers )
+        assert outp['total']==4*8.
+        assert outp['lower_bound']==max( [ 32./nworkers, 5. ] )
+        assert outp['lower_bound']<=outp['makespan']
+    # Longest first beats the original order here:
+    assert outp['makespan']==11.
+    assert schedule.report( tasks, COSTS, 3 )['makespan']>11.
+    # With one worker the finish times are the running totals:
+    finish = schedule.simulate( tasks[:3], COSTS, 1 )
+    assert finish.tolist()==[ 1., 6., 8. ]
+    priorities = dict( [ ( 'P{0}'.format( i ), i ) for i in range( 4 ) ] )
+    ordered = schedule.order_tasks( tasks, costs=COSTS, priorities=priorities, tier_size=1 )
+    outp = schedule.report( ordered, COSTS, 3, priorities=priorities, tier_size=1 )
+    assert outp['first_tier']==5.
+
+
+def test_run_with_order( tepcat ):
+    planets = list( tepcat['names'][:3] )
+    kwargs = { 'inst_modes':MODES, 'nworkers':1, 'backend':'fakejdi' }
+    serial = batch.run( planets, tepcat, **kwargs )
+    for order in schedule.ORDERS:
+        records = batch.run( planets, tepcat, order=order, **kwargs )
+        assert sorted( [ [ r['planet'], r['mode'], r['status'] ] for r in records ] )==\
+               sorted( [ [ r['planet'], r['mode'], r['status'] ] for r in serial ] )
+    with pytest.raises( ValueError ):
+        batch.run( planets, tepcat, order='random', **kwargs )
@@ -0,0 +1,28 @@
+from __future__ import print_function
+import numpy as np
+import pytest
+import screen
+
+
+def test_screen_ranks_pairs( tepcat ):
+    ranked = screen.screen( tepcat, inst_modes='NIRSpec G395H', keep_saturated=True )
+    assert len( ranked['names'] )==np.isfinite( tepcat['hdepth'] ).sum()
+    assert np.all( np.diff( ranked['score'] )<=0 )
+    assert set( ranked['modes'].tolist() )==set( [ 'NIRSpec G395H' ] )
+    ranked = screen.screen( tepcat, top_n=10 )
+    assert len( ranked['names'] )==10
+    assert np.any( ranked['saturated'] )==False
+    # A higher saturation level saturates fewer stars:
+    n80 = screen.screen( tepcat, keep_saturated=True )['saturated'].sum()
+    assert screen.screen( tepcat, sat_level=95, keep_saturated=True )['saturated'].sum()<=n80
+
+
+def test_bad_arguments_are_rejected( tepcat ):
+    with pytest.raises( ValueError ):
+        screen.screen( tepcat, inst_modes=[ 'NIRSpec G395H', 'NIRSpec G999X' ] )
+    with pytest.raises( ValueError ):
+        screen.screen( tepcat, sat_level=50000, sat_unit='e' )
+    with pytest.raises( ValueError ):
+        screen.select_planets( tepcat, sat_level=0 )
+    with pytest.raises( ValueError ):
+        screen.screen( tepcat, metric='sn_xx' )
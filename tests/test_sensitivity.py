@@ -0,0 +1,43 @@
+from __future__ import print_function
+import os
+import numpy as np
+import batch, sensitivity
+
+MODES = [ 'NIRSpec G395H', 'MIRI LRS' ]
+FLOORS = [ 0, 50, 150 ]
+
+
+def test_apply_floors():
+    cube = sensitivity.apply_floors( [ 10., 60., 200. ], FLOORS )
+    assert np.array_equal( cube, [ [ 10, 60, 200 ], [ 50, 60, 200 ], [ 150, 150, 200 ] ] )
+
+
+def test_cubes_match_full_simulations( tepcat ):
+    planets = list( tepcat['names'][:2] )
+    kwargs = { 'inst_modes':MODES, 'nworkers':1, 'backend':'fakejdi' }
+    records = sensitivity.run_grid( planets, tepcat, sat_levels=[ 80, 50 ], floors_ppm=FLOORS, \
+                                    outdir='grid', **kwargs )
+    assert sorted( records.keys() )==[ 50, 80 ]
+    assert all( [ r['status']=='done' for r in records[80]+records[50] ] )
+
+    # Each noise floor matches a PandExo run with that floor:
+    for floor in FLOORS:
+        odir = os.path.abspath( 'floor{0}'.format( floor ) )
+        batch.run( planets, tepcat, noise_floor_ppm=floor, outdir=odir, **kwargs )
+        for planet in planets:
+            for label in [ 'NIRSpec-G395H', 'MIRI-LRS' ]:
+                fpath = os.path.join( 'grid', 'sat-80', 'cubes', planet, '{0}.npz'.format( label ) )
+                wav, floors, cube, saturated = sensitivity.load_cube( fpath )
+                assert cube.shape==( len( FLOORS ), len( wav ) )
+                txt = np.loadtxt( os.path.join( odir, planet, '{0}.txt'.format( label ) ) )
+                assert np.allclose( wav, txt[:,0] )
+                assert np.allclose( cube[FLOORS.index( floor )], txt[:,1] )
+
+    # More floors do not need any more PandExo runs:
+    records = sensitivity.run_grid( planets, tepcat, sat_levels=[ 80 ], floors_ppm=FLOORS+[ 300 ], \
+                                    outdir='grid', **kwargs )
+    assert all( [ r['status']=='cached' for r in records[80] ] )
+    fpath = os.path.join( 'grid', 'sat-80', 'cubes', planets[0], 'MIRI-LRS.npz' )
+    wav, floors, cube, saturated = sensitivity.load_cube( fpath )
+    assert floors.tolist()==FLOORS+[ 300 ]
+    assert np.all( cube[-1]>=300 )
@@ -0,0 +1,86 @@
+from __future__ import print_function
+import os, time, asyncio, threading
+import pytest
+import server, jwstsim, fakejdi
+
+
+@pytest.fixture
+def job_server( tepcat, monkeypatch ):
+    """
+    Yields a function starting a JobServer on a Unix socket in a background
+    event loop, which returns the socket path.
+    """
+    started = []
+
+    def start( **kwargs ):
+        srv = server.JobServer( tepcat=tepcat, backend='fakejdi', **kwargs )
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread( target=loop.run_forever )
+        thread.daemon = True
+        thread.start()
+        socket_path = os.path.abspath( 'server.sock' )
+        future = asyncio.run_coroutine_threadsafe( srv.serve( socket_path=socket_path ), loop )
+        started.append( [ srv, loop, thread, future ] )
+        t1 = time.time()
+        while ( os.path.exists( socket_path )==False )*( time.time()-t1<10 ):
+            time.sleep( 0.05 )
+        return socket_path
+
+    yield start
+    for srv, loop, thread, future in started:
+        loop.call_soon_threadsafe( future.cancel )
+        time.sleep( 0.1 )
+        loop.call_soon_threadsafe( loop.stop )
+        thread.join( 5 )
+        loop.close()
+        srv.close()
+
+
+def test_identical_requests_are_coalesced( job_server, monkeypatch ):
+    monkeypatch.setattr( fakejdi, 'LATENCY', 0.5 ) # inherited by the workers
+    socket_path = job_server( nworkers=2 )
+    modes = [ 'NIRSpec G395H', 'MIRI LRS' ]
+    results = {}
+
+    def client( i ):
+        results[i] = list( server.simulate( 'WASP-121', inst_modes=modes, socket_path=socket_path ) )
+
+    threads = [ threading.Thread( target=client, args=( i, ) ) for i in range( 3 ) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join( 30 )
+    for i in range( 3 ):
+        assert results[i][-1]['done']==True
+        assert sorted( [ r['mode'] for r in results[i][:-1] ] )==sorted( modes )
+        assert all( [ r['status']=='done' for r in results[i][:-1] ] )
+    stats = server.status( socket_path=socket_path )
+    assert stats['tasks']==6
+    assert stats['coalesced']==4
+    assert stats['done']==2
+
+
+@pytest.mark.parametrize( 'inst_modes', [ 'NIRSpec G395H', [ 'NIRSpec G999X' ], [], [ 1 ] ] )
+def test_bad_modes_are_rejected( job_server, inst_modes ):
+    socket_path = job_server( nworkers=1 )
+    with pytest.raises( ValueError ):
+        list( server.simulate( 'WASP-121', inst_modes=inst_modes, socket_path=socket_path ) )
+    with pytest.raises( ValueError ):
+        list( server.simulate( 'NOT-A-PLANET', inst_modes=[ 'MIRI LRS' ], socket_path=socket_path ) )
+
+
+def test_worker_crash_is_reported_and_pool_restarted( job_server, monkeypatch ):
+    simulate_mode = jwstsim.simulate_mode
+    def crash( z, inst_mode, filt, memo=False ):
+        if inst_mode=='MIRI LRS':
+            os._exit( 1 ) # kill the worker process
+        return simulate_mode( z, inst_mode, filt, memo=memo )
+    monkeypatch.setattr( jwstsim, 'simulate_mode', crash ) # inherited by the workers
+    socket_path = job_server( nworkers=1 )
+    results = list( server.simulate( 'WASP-121', inst_modes=[ 'MIRI LRS' ], socket_path=socket_path ) )
+    assert results[-1]['done']==True
+    assert results[0]['status']=='failed'
+    assert 'BrokenProcessPool' in results[0]['error']
+    results = list( server.simulate( 'WASP-121', inst_modes=[ 'NIRSpec G395H' ], socket_path=socket_path ) )
+    assert results[0]['status']=='done'
+    assert server.status( socket_path=socket_path )['restarts']==1
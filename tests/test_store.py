@@ -0,0 +1,39 @@
+from __future__ import print_function
+import os
+import numpy as np
+import batch
+from store import ResultStore, convert_txt
+
+MODES = [ 'NIRSpec G395H', 'MIRI LRS' ]
+
+
+def test_append_and_get( tmp_path ):
+    sdir = str( tmp_path/'store' )
+    wave = np.linspace( 1, 2, 50 )
+    with ResultStore( sdir, chunk_points=60 ) as store:
+        store.append( 'P1', 'MIRI-LRS', wave, 100+wave, { 'saturated':False } )
+        store.append( 'P2', 'MIRI-LRS', wave, 200+wave, { 'saturated':True } )
+    store = ResultStore( sdir )
+    assert len( store )==2
+    assert sorted( store.keys() )==[ [ 'P1', 'MIRI-LRS' ], [ 'P2', 'MIRI-LRS' ] ]
+    wav, err, obspar = store.get( 'P2', 'MIRI-LRS' )
+    assert np.allclose( wav, wave )
+    assert np.allclose( err, 200+wave )
+    assert obspar['saturated']==True
+
+
+def test_store_matches_text_outputs( tepcat ):
+    planets = list( tepcat['names'][:3] )
+    batch.run( planets, tepcat, inst_modes=MODES, nworkers=1, backend='fakejdi', \
+               outdir=os.path.abspath( 'out' ) )
+    batch.run( planets, tepcat, inst_modes=MODES, nworkers=1, backend='fakejdi', store_dir='store' )
+    convert_txt( 'out', 'converted' )
+    store = ResultStore( 'store' )
+    converted = ResultStore( 'converted' )
+    assert sorted( store.keys() )==sorted( converted.keys() )
+    for planet, label in store.keys():
+        wav, err, obspar = store.get( planet, label )
+        txt = np.loadtxt( os.path.join( 'out', planet, '{0}.txt'.format( label ) ) )
+        assert np.allclose( wav, txt[:,0] )
+        assert np.allclose( err, txt[:,1] )
+        assert obspar['saturated']==converted.get( planet, label )[2]['saturated']
@@ -0,0 +1,179 @@
+from __future__ import print_function
+import os
+import numpy as np
+import pytest
+import tepcat, benchmark
+
+# Fields of read_tepcat2() in the column order of benchmark.loop_read_tepcat2():
+TEPCAT2_FIELDS = [ 'names', 'tstar', 'metalstar', 'mstar', 'rstar', 'loggstar', 'a', \
+                   'mplanet', 'rplanet', 'littleg', 'rhoplanet', 'tplanet_tepcat' ]
+MERGE_FIELDS = [ 'vmags', 'kmags', 'tdurs', 'tdepths', 'periods' ]
+
+
+def test_reader_matches_loop( workdir ):
+    cat1 = tepcat.read_tepcat1( 'tepcat1.txt' )
+    loop1 = benchmark.loop_read_tepcat1( 'tepcat1.txt' )
+    assert len( cat1 )==len( loop1[0] )
+    for k, col in zip( [ 'names', 'vmags', 'kmags', 'tdurs', 'tdepths', 'periods' ], loop1 ):
+        assert cat1[k].tolist()==col.tolist()
+    cat2 = tepcat.read_tepcat2( 'tepcat2.txt' )
+    loop2 = benchmark.loop_read_tepcat2( 'tepcat2.txt' )
+    assert len( cat2 )==len( loop2[0] )
+    for k, col in zip( TEPCAT2_FIELDS, loop2 ):
+        assert cat2[k].tolist()==col.tolist()
+
+
+
+def loop_merge( cat2, cat1 ):
+    """
+    The original nested-loop merge from tepcat.load(), kept as a reference,
+    except that unmatched rows are left as zeros instead of entering pdb.
+    Returns the merged fields and a boolean array marking the matched rows.
+    """
+    names1 = cat1['names'].tolist()
+    names2 = cat2['names'].tolist()
+    merged = dict( [ ( k, np.zeros( len( names2 ) ) ) for k in MERGE_FIELDS ] )
+    matched = np.zeros( len( names2 ), dtype=bool )
+    for i in range( len( names2 ) ):
+        for j in range( len( names1 ) ):
+            if names2[i]==names1[j]:
+                for k in MERGE_FIELDS:
+                    merged[k][i] = cat1[k][j]
+                matched[i] = True
+                break
+    return merged, matched
+
+
+def test_merge_matches_loop( workdir ):
+    cat1 = tepcat.read_tepcat1( 'tepcat1.txt' )
+    cat2 = tepcat.read_tepcat2( 'tepcat2.txt' )
+    # Add a planet that is not in the first table:
+    extra = cat2[:1].copy()
+    extra['names'] = 'NOT-A-PLANET'
+    cat2 = np.concatenate( [ cat2, extra ] )
+    loop, matched = loop_merge( cat2, cat1 )
+    assert matched.sum()==len( cat2 )-1
+
+    merged, unmatched = tepcat.merge( cat2, cat1, on_missing='drop', quiet=True )
+    assert unmatched.tolist()==[ 'NOT-A-PLANET' ]
+    assert merged['names'].tolist()==cat2['names'][matched].tolist()
+    for k in MERGE_FIELDS:
+        assert np.array_equal( merged[k], loop[k][matched] )
+    for k in cat2.dtype.names:
+        assert merged[k].tolist()==cat2[k][matched].tolist()
+
+    merged, unmatched = tepcat.merge( cat2, cat1, on_missing='nan', quiet=True )
+    assert len( merged )==len( cat2 )
+    for k in MERGE_FIELDS:
+        assert np.array_equal( merged[k][matched], loop[k][matched] )
+        assert np.all( np.isnan( merged[k][~matched] ) )
+
+    with pytest.raises( ValueError ):
+        tepcat.merge( cat2, cat1, on_missing='raise', quiet=True )
+    with pytest.raises( ValueError ):
+        tepcat.merge( cat2, cat1, on_missing='ignore', quiet=True )
+
+
+def test_cache_is_rebuilt_when_inputs_change( workdir, monkeypatch ):
+    cdir = str( workdir/'cache' )
+    kwargs = { 'download_latest':False, 'quiet':True, 'cache_dir':cdir }
+    z0 = tepcat.load( cache=False, **kwargs )
+    assert os.path.isdir( cdir )==False
+    tepcat.load( cache=True, **kwargs ) # builds the cache entry
+    z1 = tepcat.load( cache=True, **kwargs )
+    assert isinstance( z1['sn_tr'], np.memmap )
+    assert sorted( z1.keys() )==sorted( z0.keys() )
+    for k in z0:
+        assert z1[k].tolist()==z0[k].tolist()
+    assert len( tepcat.cache_info( cdir ) )==1
+
+    # Changed tables are a different entry:
+    with open( 'tepcat1.txt', 'r' ) as f:
+        lines = f.readlines()
+    with open( 'tepcat1.txt', 'w' ) as f:
+        f.writelines( lines[:-1] )
+    tepcat.load( cache=True, **kwargs )
+    assert len( tepcat.cache_info( cdir ) )==2
+
+    # So are changed physical constants:
+    monkeypatch.setattr( tepcat, 'RSUN_SI', 1.01*tepcat.RSUN_SI )
+    z2 = tepcat.load( cache=True, **kwargs )
+    assert isinstance( z2['aRs'], np.memmap )==False
+    assert len( tepcat.cache_info( cdir ) )==3
+    ix = ( z2['names']==tepcat.REF_PLANET )
+    assert np.isclose( z2['aRs'][ix][0], z0['aRs'][z0['names']==tepcat.REF_PLANET][0]/1.01 )
+
+    tepcat.clear_cache( cdir )
+    assert tepcat.cache_info( cdir )==[]
+
+
+def test_grid_matches_scalar_routines( workdir ):
+    z = tepcat.load( download_latest=False, quiet=True, cache=False )
+    ix = np.flatnonzero( z['names']==tepcat.REF_PLANET )[0]
+    tref = z['tstar'][ix]
+    kref = z['kmags'][ix]
+    wav = np.array( [ 1., tepcat.KBAND_UM, 5., 12. ] )
+    ecdepth = tepcat.calc_ecdepth_grid( z['tplanet'], z['tstar'], z['RpRs'], wav, chunk_size=100 )
+    fratio = tepcat.calc_fratio_grid( wav, z['tstar'], z['kmags'], tref, kref, chunk_size=100 )
+    assert ecdepth.shape==( len( z['names'] ), len( wav ) )
+    assert fratio.shape==( len( z['names'] ), len( wav ) )
+    for j, w in enumerate( wav ):
+        scalar = tepcat.calc_ecdepth( z['tplanet'], z['tstar'], z['RpRs'], w )
+        assert np.allclose( ecdepth[:,j], scalar, rtol=1e-10, atol=0 )
+        scalar = tepcat.calc_fratio( w, z['tstar'], z['kmags'], tref, kref )
+        assert np.allclose( fratio[:,j], scalar, rtol=1e-10, atol=0 )
+
+    sn_em = tepcat.calc_sn_em_grid( z, wav )
+    assert np.allclose( sn_em[:,1], z['sn_em'], rtol=1e-10, atol=0 )
+    assert np.allclose( sn_em[ix], 1 )
+    sn_em32 = tepcat.calc_sn_em_grid( z, wav, dtype=np.float32, chunk_size=100 )
+    assert sn_em32.dtype==np.float32
+    assert np.allclose( sn_em32, sn_em, rtol=1e-6, atol=0 )
+
+
+def test_cache_is_opt_in_and_writable( workdir, capsys ):
+    tepcat.load( download_latest=False, quiet=True )
+    assert os.path.exists( tepcat.CACHE_DIR )==False
+    kwargs = { 'download_latest':False, 'quiet':True, 'cache':True }
+    z0 = tepcat.load( **kwargs )
+    capsys.readouterr()
+    z1 = tepcat.load( **kwargs )
+    assert ( 'Finished' in capsys.readouterr().out )==False
+    z1['kmags'][0] += 1 # changes this copy only
+    assert tepcat.load( **kwargs )['kmags'][0]==z0['kmags'][0]
+
+
+def test_iterate_and_top_k_match_load( workdir ):
+    z = tepcat.load( download_latest=False, quiet=True, cache=False )
+    chunks = list( tepcat.iterate( chunk_size=100 ) )
+    assert len( chunks )>1
+    streamed = {}
+    for k in tepcat.TEPCAT_KEYS:
+        streamed[k] = np.concatenate( [ chunk[k] for chunk in chunks ] )
+    ixs = np.argsort( streamed['sn_tr'] )[::-1]
+    for k in tepcat.TEPCAT_KEYS:
+        np.testing.assert_array_equal( streamed[k][ixs], z[k] )
+
+    best = tepcat.top_k( 10, chunk_size=100 )
+    for k in tepcat.TEPCAT_KEYS:
+        np.testing.assert_array_equal( best[k], z[k][:10] )
+    best = tepcat.top_k( 5, metric='sn_em', chunk_size=100 )
+    ixs = np.argsort( z['sn_em'] )[::-1][:5]
+    assert best['names'].tolist()==z['names'][ixs].tolist()
+    assert len( tepcat.top_k( 10**6, chunk_size=100 )['names'] )==len( z['names'] )
+
+
+def test_top_k_edge_cases( workdir ):
+    assert tepcat.top_k( 0 ) is None
+    assert tepcat.top_k( -1 ) is None
+    z = tepcat.load( download_latest=False, quiet=True, cache=False )
+    best = tepcat.top_k( 3, chunk_size=2 ) # k larger than a chunk
+    assert best['names'].tolist()==z['names'][:3].tolist()
+    # Blank lines in the second table, including before the reference planet:
+    with open( 'tepcat2.txt', 'r' ) as f:
+        lines = f.readlines()
+    with open( 'tepcat2.txt', 'w' ) as f:
+        f.writelines( lines[:2]+[ '\n', '   \n' ]+lines[2:]+[ '\n' ] )
+    streamed = np.concatenate( [ chunk['names'] for chunk in tepcat.iterate( chunk_size=100 ) ] )
+    assert sorted( streamed.tolist() )==sorted( z['names'].tolist() )
+    assert tepcat.top_k( 10, chunk_size=100 )['names'].tolist()==z['names'][:10].tolist()